@@ -10,7 +10,7 @@ from django.http.response import HttpResponse
 
 from authentication.participant_authentication import (authenticate_participant,
     authenticate_participant_registration, minimal_validation)
-from config.settings import UPLOAD_LOGGING_ENABLED
+from config.settings import ASYNC_UPLOAD_INGESTION, UPLOAD_LOGGING_ENABLED
 from constants.celery_constants import ANDROID_FIREBASE_CREDENTIALS, IOS_FIREBASE_CREDENTIALS
 from constants.message_strings import (DEVICE_IDENTIFIERS_HEADER, INVALID_EXTENSION_ERROR,
     NO_FILE_ERROR, UNKNOWN_ERROR)
@@ -20,8 +20,8 @@ from libs.encryption import (DecryptionKeyInvalidError, DeviceDataDecryptor,
     IosDecryptionKeyDuplicateError, IosDecryptionKeyNotFoundError, RemoteDeleteFileScenario)
 from libs.http_utils import determine_os_api
 from libs.internal_types import ParticipantRequest
-from libs.participant_file_uploads import (upload_and_create_file_to_process_and_log,
-    upload_problem_file)
+from libs.participant_file_uploads import (store_pending_upload,
+    upload_and_create_file_to_process_and_log, upload_problem_file)
 from libs.push_notification_helpers import repopulate_all_survey_scheduled_events
 from libs.s3 import get_client_public_key_string, s3_upload
 from libs.sentry import make_sentry_client, SentryTypes
@@ -83,6 +83,10 @@ def upload(request: ParticipantRequest, OS_API=""):
         log("400, FileToProcess.test_file_path_exists")
         return abort(400)
     
+    # decryption happens later, in an upload ingestion task.
+    if ASYNC_UPLOAD_INGESTION:
+        return store_pending_upload(s3_file_location, participant, get_uploaded_file(request))
+    
     # attempt to decrypt, some scenarios delete remote files even if decryption fails
     try:
         file_contents = get_uploaded_file(request)
@@ -224,7 +228,7 @@ def register_user(request: ParticipantRequest, OS_API=""):
                       beiwe_version)).encode()
     
     s3_upload(file_name, file_contents, participant)
-    FileToProcess.append_file_for_processing(file_name, participant)
+    FileToProcess.append_file_for_processing(file_name, participant, file_size=len(file_contents))
     
     # set up device.
     participant.device_id = device_id
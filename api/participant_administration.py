@@ -14,7 +14,7 @@ from database.study_models import Study
 from database.user_models import Participant, ParticipantFieldValue
 from libs.internal_types import ResearcherRequest
 from libs.push_notification_helpers import repopulate_all_survey_scheduled_events
-from libs.s3 import create_client_key_pair, s3_upload
+from libs.s3 import create_client_key_pair, invalidate_client_private_key, s3_upload
 from libs.streaming_bytes_io import StreamingStringsIO
 
 
@@ -70,6 +70,7 @@ def reset_device(request: ResearcherRequest):
     
     participant.device_id = ""
     participant.save()
+    invalidate_client_private_key(patient_id)
     messages.success(request, f'For patient {patient_id}, device was reset; password is untouched.')
     # FIXME: this was originally request.referrer
     return redirect(f'/view_study/{study_id}/')
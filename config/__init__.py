@@ -66,6 +66,15 @@ for mandatory_var in MANDATORY_VARS:
 # Environment variable type can be unpredictable, sanitize the numerical ones.
 settings.CONCURRENT_NETWORK_OPS = int(settings.CONCURRENT_NETWORK_OPS)
 settings.FILE_PROCESS_PAGE_SIZE = int(settings.FILE_PROCESS_PAGE_SIZE)
+settings.FILE_PARSING_PROCESSES = int(settings.FILE_PARSING_PROCESSES)
+settings.FILE_PROCESS_PAGE_BUDGET_MB = int(settings.FILE_PROCESS_PAGE_BUDGET_MB)
+settings.FILE_PROCESS_MAX_PAGE_SIZE = int(settings.FILE_PROCESS_MAX_PAGE_SIZE)
+settings.UNCOMPRESSED_UPLOAD_BUDGET_MB = int(settings.UNCOMPRESSED_UPLOAD_BUDGET_MB)
+settings.DATA_PROCESSING_WORKER_MAX_MB = int(settings.DATA_PROCESSING_WORKER_MAX_MB)
+settings.DATA_PROCESSING_WORKER_MAX_TASKS = int(settings.DATA_PROCESSING_WORKER_MAX_TASKS)
+settings.CHUNK_CACHE_MB = int(settings.CHUNK_CACHE_MB)
+settings.PRIVATE_KEY_CACHE_SECONDS = int(settings.PRIVATE_KEY_CACHE_SECONDS)
+settings.PRIVATE_KEY_CACHE_SIZE = int(settings.PRIVATE_KEY_CACHE_SIZE)
 
 # email addresses are parsed from a comma separated list, strip whitespace.
 if settings.SYSADMIN_EMAILS:
@@ -73,6 +82,12 @@ if settings.SYSADMIN_EMAILS:
         _email_address.strip() for _email_address in settings.SYSADMIN_EMAILS.split(",")
     ]
 
+# data stream names are also a comma separated list.
+settings.VECTORIZED_BINIFICATION_STREAMS = {
+    _data_stream.strip() for _data_stream in settings.VECTORIZED_BINIFICATION_STREAMS.split(",")
+    if _data_stream.strip()
+}
+
 #
 # Stick any warning about environment variables that may have changed here
 #
@@ -66,6 +66,99 @@ CONCURRENT_NETWORK_OPS = getenv("CONCURRENT_NETWORK_OPS") or cpu_count() * 2
 #   Expects an integer number.
 FILE_PROCESS_PAGE_SIZE = getenv("FILE_PROCESS_PAGE_SIZE", 100)
 
+# Pages of files to process are sized so that the files on a page add up to about this many
+# megabytes, using the file sizes recorded at upload.  Pages of large files (e.g. accelerometer)
+# are made smaller and pages of small files larger, up to FILE_PROCESS_MAX_PAGE_SIZE files.  Files
+# with no recorded size are counted as 1/FILE_PROCESS_PAGE_SIZE of the budget.  Processing uses
+# several times this much memory.  Set to 0 to always use pages of FILE_PROCESS_PAGE_SIZE files.
+#   Expects an integer number.
+FILE_PROCESS_PAGE_BUDGET_MB = getenv("FILE_PROCESS_PAGE_BUDGET_MB", 200)
+
+# The largest number of files on a page of files to process when pages are sized by memory budget.
+#   Expects an integer number.
+FILE_PROCESS_MAX_PAGE_SIZE = getenv("FILE_PROCESS_MAX_PAGE_SIZE", 1000)
+
+# Number of worker processes used to parse and sort downloaded files into hourly chunks on data
+# processing servers.  Parsing is cpu-bound, so without worker processes a data processing task
+# uses a single core no matter how many network operations are running.  Each worker process uses
+# additional memory.  Set to 0 (the default) to parse files in the data processing task itself.
+#   Expects an integer number.
+FILE_PARSING_PROCESSES = getenv("FILE_PARSING_PROCESSES", 0)
+
+# Processed data is held in memory until it is uploaded. Compressing it saves memory but costs CPU,
+# so pending uploads are only compressed after this many megabytes of uncompressed data are pending.
+# Lower this value if data processing servers run out of memory.
+#   Expects an integer number.
+UNCOMPRESSED_UPLOAD_BUDGET_MB = getenv("UNCOMPRESSED_UPLOAD_BUDGET_MB", 256)
+
+# Data processing worker processes are reused for many tasks.  After a task, a worker process exits
+# (and celery replaces it) if its memory usage is over this many megabytes.  Python rarely returns
+# memory to the operating system, so a worker that processed a large backlog stays large.
+#   Expects an integer number.
+DATA_PROCESSING_WORKER_MAX_MB = getenv("DATA_PROCESSING_WORKER_MAX_MB", 1024)
+
+# A data processing worker process also exits after running this many tasks.  Set to 1 to exit
+# after every task.
+#   Expects an integer number.
+DATA_PROCESSING_WORKER_MAX_TASKS = getenv("DATA_PROCESSING_WORKER_MAX_TASKS", 100)
+
+# When new data arrives for an hour that already has a chunk, data processing normally downloads,
+# merges, and re-uploads the whole chunk.  When enabled, the new data is uploaded as a small delta
+# segment instead, and the segments are merged into their chunks by an hourly compaction task.  The
+# data access api merges segments into chunks on download.  Compacted segment files are not deleted
+# from S3, configure a lifecycle rule to expire objects under the CHUNK_DELTAS folder (after a week).
+# Chunk reads only look for segments while this is enabled, after disabling it remaining segments
+# are merged by the next compaction task.
+#   Expects (case-insensitive) "true" to enable, otherwise it is disabled.
+CHUNK_DELTA_SEGMENTS = getenv("CHUNK_DELTA_SEGMENTS", "false").lower() == "true"
+
+# Data processing servers can keep recently written chunks on local disk, so that new data for a
+# chunk (usually the current hour) is merged without downloading the chunk from S3 again.  This is
+# the size of that cache in megabytes, set to 0 (the default) to disable it.  Note that the cache
+# contains (compressed) decrypted data.
+#   Expects an integer number.
+CHUNK_CACHE_MB = getenv("CHUNK_CACHE_MB", 0)
+
+# The folder that contains the chunk cache.
+CHUNK_CACHE_DIRECTORY = getenv("CHUNK_CACHE_DIRECTORY", "/tmp/beiwe_chunk_cache")
+
+# Data streams that are sorted into hourly chunks using a NumPy implementation, which is much faster
+# on high-frequency sensor data.  Output is identical.  Only accelerometer, devicemotion, gyro, and
+# magnetometer are eligible, other values are ignored. (NumPy is installed on data processing
+# servers as a dependency of Forest; if it is missing this setting has no effect.)
+#   Expects a comma separated list of data stream names, provide an empty value to disable.
+VECTORIZED_BINIFICATION_STREAMS = getenv(
+    "VECTORIZED_BINIFICATION_STREAMS", "accelerometer,devicemotion,gyro,magnetometer"
+)
+
+#
+# Data upload options
+
+# Frontend servers keep participants' decryption keys in memory so that the many small files a
+# device uploads at once don't each require retrieving the key from S3.  Keys are kept for this
+# many seconds, set to 0 to disable.
+#   Expects an integer number.
+PRIVATE_KEY_CACHE_SECONDS = getenv("PRIVATE_KEY_CACHE_SECONDS", 300)
+
+# The number of participants' decryption keys kept in memory by each frontend server process.
+#   Expects an integer number.
+PRIVATE_KEY_CACHE_SIZE = getenv("PRIVATE_KEY_CACHE_SIZE", 1000)
+
+# The upload endpoint checks whether an uploaded file already exists on S3 (so that it can rename
+# duplicates).  When enabled this uses the database instead of listing files on S3.  The database
+# only knows about files uploaded since it started recording them, run the backfill_raw_upload_paths
+# script before enabling this.
+#   Expects (case-insensitive) "true" to enable, otherwise it is disabled.
+RAW_UPLOAD_PATH_INDEX = getenv("RAW_UPLOAD_PATH_INDEX", "false").lower() == "true"
+
+# When enabled, the upload endpoint stores the encrypted file on S3 and responds immediately, files
+# are decrypted by upload ingestion tasks on the data processing servers (queued every 5 minutes).
+# Uploaded data reaches data processing a few minutes later than it otherwise would.  Ingested files
+# are not deleted from S3, configure a lifecycle rule to expire objects under the PENDING_UPLOADS
+# folder (after a month).
+#   Expects (case-insensitive) "true" to enable, otherwise it is disabled.
+ASYNC_UPLOAD_INGESTION = getenv("ASYNC_UPLOAD_INGESTION", "false").lower() == "true"
+
 #
 # Push Notification directives
 
@@ -28,6 +28,9 @@ DISPLAY_TIME_FORMAT = "%Y-%m-%d %-I:%M%p (%Z)"
 # file path for s3 for problem uploads
 PROBLEM_UPLOADS = "PROBLEM_UPLOADS"
 
+# file path for s3 for uploads that have not been decrypted yet (see ASYNC_UPLOAD_INGESTION)
+PENDING_UPLOADS = "PENDING_UPLOADS"
+
 # file path for custom ondeploy script
 CUSTOM_ONDEPLOY_SCRIPT_EB = "CUSTOM_ONDEPLOY_SCRIPT/EB"
 CUSTOM_ONDEPLOY_SCRIPT_PROCESSING = "CUSTOM_ONDEPLOY_SCRIPT/PROCESSING"
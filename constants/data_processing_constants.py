@@ -11,6 +11,13 @@ CHUNK_TIMESLICE_QUANTUM = 3600
 # the name of the s3 folder that contains chunked data
 CHUNKS_FOLDER = "CHUNKED_DATA"
 
+# the name of the s3 folder that contains delta segments of chunks (see CHUNK_DELTA_SEGMENTS)
+CHUNK_DELTAS_FOLDER = "CHUNK_DELTAS"
+
+# High-frequency data streams that never require data fixes before binification, these can be binified
+# by the vectorized (NumPy) binification code.
+VECTORIZABLE_DATA_STREAMS = {ACCELEROMETER, DEVICEMOTION, GYRO, MAGNETOMETER}
+
 # These reference dicts contain the output headers that should exist for each data stream, per-os.
 #  A value of None means that the os cannot generate that data (or the dictionary needs to be updated)
 
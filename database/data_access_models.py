@@ -2,7 +2,8 @@ from collections import Counter
 from datetime import datetime, timedelta
 from typing import Dict
 
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, models, transaction
 from django.utils import timezone
 
 from constants.common_constants import API_TIME_FORMAT, EARLIEST_POSSIBLE_DATA_DATETIME
@@ -12,6 +13,7 @@ from constants.data_stream_constants import (CHUNKABLE_FILES, IDENTIFIERS,
 from constants.user_constants import OS_TYPE_CHOICES
 from database.models import TimestampedModel
 from database.user_models import Participant
+from libs.file_processing.utility_functions_simple import s3_file_path_to_data_type
 from libs.security import chunk_hash
 
 
@@ -44,13 +46,32 @@ class ChunkRegistry(TimestampedModel):
     )
     
     def s3_retrieve(self):
+        """ The contents of the chunk, including delta segments that have not been compacted yet
+        (when CHUNK_DELTA_SEGMENTS is enabled). """
+        from config.settings import CHUNK_DELTA_SEGMENTS
+        from libs.file_processing.chunk_deltas import add_delta_segments
         from libs.s3 import s3_retrieve
-        return s3_retrieve(self.chunk_path, self.study.object_id, raw_path=True)
+        study_object_id = self.study.object_id
+        chunk_contents = s3_retrieve(self.chunk_path, study_object_id, raw_path=True)
+        if not CHUNK_DELTA_SEGMENTS:
+            return chunk_contents
+        return add_delta_segments(self.pk, chunk_contents, study_object_id)
     
     @classmethod
     def register_chunked_data(
             cls, data_type, time_bin, chunk_path, file_contents, study_id, participant_id, survey_id=None
     ):
+        chunk = cls.new_chunked_data(
+            data_type, time_bin, chunk_path, file_contents, study_id, participant_id, survey_id
+        )
+        chunk.save()
+        return chunk
+    
+    @classmethod
+    def new_chunked_data(
+            cls, data_type, time_bin, chunk_path, file_contents, study_id, participant_id, survey_id=None
+    ):
+        """ Returns an unsaved ChunkRegistry, for use with bulk_create. """
         if data_type not in CHUNKABLE_FILES:
             raise UnchunkableDataTypeError
         
@@ -58,7 +79,7 @@ class ChunkRegistry(TimestampedModel):
         time_bin = int(time_bin) * CHUNK_TIMESLICE_QUANTUM
         time_bin = timezone.make_aware(datetime.utcfromtimestamp(time_bin), timezone.utc)
         
-        cls.objects.create(
+        return cls(
             is_chunkable=True,
             chunk_path=chunk_path,
             chunk_hash=chunk_hash_str,
@@ -72,13 +93,13 @@ class ChunkRegistry(TimestampedModel):
     
     @classmethod
     def register_unchunked_data(cls, data_type, unix_timestamp, chunk_path, study_id, participant_id,
-                                file_contents, survey_id=None):
+                                file_size, survey_id=None):
         time_bin = timezone.make_aware(datetime.utcfromtimestamp(unix_timestamp), timezone.utc)
         
         if data_type in CHUNKABLE_FILES:
             raise ChunkableDataTypeError
         
-        cls.objects.create(
+        return cls.objects.create(
             is_chunkable=False,
             chunk_path=chunk_path,
             chunk_hash='',
@@ -87,18 +108,21 @@ class ChunkRegistry(TimestampedModel):
             study_id=study_id,
             participant_id=participant_id,
             survey_id=survey_id,
-            file_size=len(file_contents),
+            file_size=file_size,
         )
     
     @classmethod
-    def update_registered_unchunked_data(cls, data_type, chunk_path, file_contents):
+    def update_registered_unchunked_data(cls, data_type, chunk_path, file_size):
         """ Updates the data in case a user uploads an unchunkable file more than once,
-        and updates the file size just in case it changed. """
+        and updates the file size just in case it changed.  Returns the chunk and its previous
+        file size. """
         if data_type in CHUNKABLE_FILES:
             raise ChunkableDataTypeError
         chunk = cls.objects.get(chunk_path=chunk_path)
-        chunk.file_size = len(file_contents)
+        previous_file_size = chunk.file_size
+        chunk.file_size = file_size
         chunk.save()
+        return chunk, previous_file_size
     
     @classmethod
     def get_chunks_time_range(cls, study_id, user_ids=None, data_types=None, start=None, end=None):
@@ -136,6 +160,26 @@ class ChunkRegistry(TimestampedModel):
         return cls.objects.exclude(time_bin__lt=EARLIEST_POSSIBLE_DATA_DATETIME)
 
 
+class ChunkDelta(TimestampedModel):
+    """ When CHUNK_DELTA_SEGMENTS is enabled new data for an existing chunk is uploaded as a small,
+    separate, sorted csv file (a delta segment) instead of being merged into the chunk.  The chunk's
+    data is the chunk file merged with its delta segments, until the deltas are compacted into the
+    chunk file.  (see libs.file_processing.chunk_deltas) """
+    chunk = models.ForeignKey(ChunkRegistry, on_delete=models.CASCADE, related_name="deltas")
+    s3_path = models.CharField(max_length=256, unique=True)
+    file_size = models.IntegerField()  # Size (in bytes) of the uncompressed file
+    
+    def add_to_chunk(self, file_contents: bytes):
+        """ Updates this delta and its chunk for newly uploaded delta contents, does not save. The
+        chunk hash is chained so that it changes whenever data is added (data access api clients use
+        it to detect changed files). """
+        self.file_size = len(file_contents)
+        chunk = self.chunk
+        chunk.chunk_hash = chunk_hash(chunk.chunk_hash.encode() + file_contents).decode()
+        # the chunk gains the delta's lines, but not its header.
+        chunk.file_size = (chunk.file_size or 0) + len(file_contents) - file_contents.find(b"\n")
+
+
 class FileToProcess(TimestampedModel):
     # todo: this should have a max length of 66 characters on audio recordings
     s3_file_path = models.CharField(max_length=256, blank=False, unique=True)
@@ -143,6 +187,18 @@ class FileToProcess(TimestampedModel):
     participant = models.ForeignKey('Participant', on_delete=models.PROTECT, related_name='files_to_process')
     os_type = models.CharField(max_length=16, choices=OS_TYPE_CHOICES, blank=True, null=False, default="")
     deleted = models.BooleanField(default=False)
+    # Files are processed in separate units of work per participant per data type.  Blank until it
+    # has been determined from the file path, see populate_data_types.
+    data_type = models.CharField(max_length=32, blank=True, default="")
+    # size of the (decrypted) file in bytes, used to prioritize data processing. Null on files
+    # created before the field existed.
+    file_size = models.PositiveIntegerField(null=True, blank=True)
+    
+    class Meta:
+        # data processing pages through a participant's files of a data type in primary key order.
+        indexes = [
+            models.Index(fields=["participant", "data_type", "id"], name="ftp_participant_type_id_idx")
+        ]
     
     def s3_retrieve(self):
         from libs.s3 import s3_retrieve
@@ -167,15 +223,31 @@ class FileToProcess(TimestampedModel):
         ).exists()
     
     @classmethod
-    def append_file_for_processing(cls, file_path: str, participant: Participant):
+    def append_file_for_processing(cls, file_path: str, participant: Participant, file_size: int = None):
         # normalize the file path, grab the study id, passthrough kwargs to create; create.
         cls.objects.create(
             s3_file_path=cls.normalize_s3_file_path(file_path, participant.study.object_id),
             participant=participant,
             study=participant.study,
             os_type=participant.os_type,
+            data_type=s3_file_path_to_data_type(file_path),
+            file_size=file_size,
         )
     
+    @classmethod
+    def populate_data_types(cls):
+        """ Fills in the data type of files to process that were created without one (e.g. by
+        bulk_create, or before the field existed).  Files of unknown type stay blank, they are
+        processed (and fail) as their own unit of work. """
+        files_to_process = []
+        for file_to_process in cls.objects.filter(data_type="").only("pk", "s3_file_path"):
+            try:
+                file_to_process.data_type = s3_file_path_to_data_type(file_to_process.s3_file_path)
+            except Exception:
+                continue
+            files_to_process.append(file_to_process)
+        cls.objects.bulk_update(files_to_process, ["data_type"], batch_size=1000)
+    
     @classmethod
     def reprocess_originals_from_chunk_path(cls, chunk_path):
         """ Takes a processed file (chunk) s3 path, identifies the original source files,
@@ -254,6 +326,69 @@ class FileToProcess(TimestampedModel):
         )
 
 
+class RawUploadPath(TimestampedModel):
+    """ The S3 paths of uploaded (raw, decrypted) files, so that the upload endpoint can detect a
+    duplicate upload without listing files on S3.  Files uploaded before this model existed are
+    added by scripts/backfill_raw_upload_paths.py.  (see RAW_UPLOAD_PATH_INDEX) """
+    # normalized like FileToProcess paths, starts with the study object id.
+    s3_file_path = models.CharField(max_length=256, unique=True)
+    participant = models.ForeignKey(
+        "Participant", on_delete=models.CASCADE, related_name="raw_upload_paths"
+    )
+    
+    @classmethod
+    def path_exists(cls, file_path: str, study_object_id: str) -> bool:
+        return cls.objects.filter(
+            s3_file_path=FileToProcess.normalize_s3_file_path(file_path, study_object_id)
+        ).exists()
+    
+    @classmethod
+    def add_path(cls, file_path: str, participant: Participant):
+        # (a path that is already present is fine, e.g. split ios files are merged into one file.)
+        cls.objects.bulk_create(
+            [cls(
+                s3_file_path=FileToProcess.normalize_s3_file_path(file_path, participant.study.object_id),
+                participant=participant,
+            )],
+            ignore_conflicts=True,
+        )
+
+
+class FileProcessingLock(TimestampedModel):
+    """ Only one data processing task may process a participant's files of a data type at a time,
+    a task holds this lock while it does so. """
+    # data processing tasks have a time limit of 3 hours, a lock older than this is left over from a
+    # task that was killed.
+    EXPIRY = timedelta(hours=4)
+    
+    participant = models.ForeignKey(
+        "Participant", on_delete=models.CASCADE, related_name="file_processing_locks"
+    )
+    data_type = models.CharField(max_length=32, blank=True)
+    
+    class Meta:
+        unique_together = ("participant", "data_type")
+    
+    @classmethod
+    def acquire(cls, participant_id: int, data_type: str) -> bool:
+        """ Returns True if the lock was acquired, False if it is already held. """
+        cls.objects.filter(
+            participant_id=participant_id, data_type=data_type,
+            created_on__lt=timezone.now() - cls.EXPIRY,
+        ).delete()
+        try:
+            with transaction.atomic():
+                cls.objects.create(participant_id=participant_id, data_type=data_type)
+        # full_clean catches an existing lock, the unique constraint catches a race.
+        except (IntegrityError, ValidationError):
+            return False
+        return True
+    
+    @classmethod
+    def release(cls, participant_id: int, data_type: str):
+        cls.objects.filter(participant_id=participant_id, data_type=data_type).delete()
+
+
 class IOSDecryptionKey(TimestampedModel):
     """ This model exists in order to solve an ios implementation bug where files would be
     split and a section would get uploaded without the decryption key, but the decryption key is
@@ -263,3 +398,20 @@ class IOSDecryptionKey(TimestampedModel):
     file_name = models.CharField(max_length=80, blank=False, unique=True, db_index=True)
     base64_encryption_key = models.CharField(max_length=24, blank=False)
     participant = models.ForeignKey("Participant", on_delete=models.CASCADE)
+
+
+class PendingUpload(TimestampedModel):
+    """ When ASYNC_UPLOAD_INGESTION is enabled the upload endpoint stores the (still encrypted) file a
+    device uploaded on S3 and creates one of these, decryption and the creation of the FileToProcess
+    happen later in an upload ingestion task.  (see libs.participant_file_uploads) """
+    participant = models.ForeignKey(
+        "Participant", on_delete=models.CASCADE, related_name="pending_uploads"
+    )
+    # the file path the device uploaded the file as, after the "_" to "/" replacement.
+    file_path = models.CharField(max_length=256, unique=True)
+    # the location of the encrypted file contents, under the PENDING_UPLOADS folder.
+    s3_path = models.CharField(max_length=256, unique=True)
+    file_size = models.IntegerField()  # Size (in bytes) of the encrypted file
+    # where the decrypted file was uploaded, and its size there, once ingestion gets that far.
+    decrypted_file_path = models.CharField(max_length=256, blank=True, default="")
+    decrypted_file_size = models.IntegerField(null=True, blank=True)
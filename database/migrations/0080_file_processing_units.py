@@ -0,0 +1,41 @@
+# Generated by Django 3.2.14 on 2026-10-18 18:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0079_delete_decryptionkeyerror'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileProcessingLock',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+                ('data_type', models.CharField(blank=True, max_length=32)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='filetoprocess',
+            name='data_type',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddIndex(
+            model_name='filetoprocess',
+            index=models.Index(fields=['participant', 'data_type', 'id'], name='ftp_participant_type_id_idx'),
+        ),
+        migrations.AddField(
+            model_name='fileprocessinglock',
+            name='participant',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='file_processing_locks', to='database.participant'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='fileprocessinglock',
+            unique_together={('participant', 'data_type')},
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.14 on 2026-10-18 18:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0080_file_processing_units'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filetoprocess',
+            name='file_size',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.14 on 2026-10-18 18:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0081_filetoprocess_file_size'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChunkDelta',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+                ('s3_path', models.CharField(max_length=256, unique=True)),
+                ('file_size', models.IntegerField()),
+                ('chunk', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deltas', to='database.chunkregistry')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
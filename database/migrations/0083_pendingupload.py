@@ -0,0 +1,29 @@
+# Generated by Django 3.2.14 on 2026-10-18 19:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0082_chunkdelta'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingUpload',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+                ('file_path', models.CharField(max_length=256, unique=True)),
+                ('s3_path', models.CharField(max_length=256, unique=True)),
+                ('file_size', models.IntegerField()),
+                ('participant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pending_uploads', to='database.participant')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.2.14 on 2026-10-18 19:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0083_pendingupload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RawUploadPath',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+                ('s3_file_path', models.CharField(max_length=256, unique=True)),
+                ('participant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='raw_upload_paths', to='database.participant')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.14 on 2026-10-18 19:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0084_rawuploadpath'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pendingupload',
+            name='decrypted_file_path',
+            field=models.CharField(blank=True, default='', max_length=256),
+        ),
+        migrations.AddField(
+            model_name='pendingupload',
+            name='decrypted_file_size',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
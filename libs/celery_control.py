@@ -1,6 +1,6 @@
 import json
 from datetime import timedelta
-from typing import List
+from typing import List, Tuple
 
 from celery import Celery
 from django.utils import timezone
@@ -155,22 +155,36 @@ def get_notification_active_job_ids() -> List[int] or None:
     return _get_job_ids(inspect().active(), "notifications")
 
 # Processing
-def get_processing_scheduled_job_ids() -> List[int] or None:
+def get_processing_scheduled_job_ids() -> List[Tuple[int, str]] or None:
     if processing_celery_app is FalseCeleryApp:
         print("call to get_processing_scheduled_job_ids in FalseCeleryApp, returning []")
         return []
     return _get_job_ids(inspect().scheduled(), "processing")
-def get_processing_reserved_job_ids() -> List[int] or None:
+def get_processing_reserved_job_ids() -> List[Tuple[int, str]] or None:
     if processing_celery_app is FalseCeleryApp:
         print("call to get_processing_reserved_job_ids in FalseCeleryApp, returning []")
         return []
     return _get_job_ids(inspect().reserved(), "processing")
-def get_processing_active_job_ids() -> List[int] or None:
+def get_processing_active_job_ids() -> List[Tuple[int, str]] or None:
     if processing_celery_app is FalseCeleryApp:
         print("call to get_processing_active_job_ids in FalseCeleryApp, returning []")
         return []
     return _get_job_ids(inspect().active(), "processing")
 
+def get_processing_worker_slots() -> int or None:
+    """ The total number of tasks that data processing workers can run at once, None if there is no
+    celery.  (With --autoscale this is the maximum number of processes.) """
+    if processing_celery_app is FalseCeleryApp:
+        print("call to get_processing_worker_slots in FalseCeleryApp, returning None")
+        return None
+    worker_stats = inspect().stats()
+    if worker_stats is None:
+        raise CeleryNotRunningException()
+    return sum(
+        stats["pool"]["max-concurrency"] for worker_name, stats in worker_stats.items()
+        if worker_name.endswith("processing")
+    )
+
 
 def get_revoked_job_ids():
     """ Returns a list of a tuple of two lists of usually ints. """
@@ -226,10 +240,10 @@ def _get_job_ids(celery_query_dict, celery_app_suffix):
         # 2020-11-24:: this job_arg value has started to return a list object, not a json string
         #  ... but only on one of 3 newly updated servers. ...  Buh?
         args = job_arg if isinstance(job_arg, list) else json.loads(job_arg)
-        # safety/sanity check, assert that there is only 1 integer id in a list and that it is a list.
+        # safety/sanity check, assert that there is an integer id first in a list and that it is a list.
         assert isinstance(args, list)
-        assert len(args) == 1
         assert isinstance(args[0], int)
-        all_args.append(args[0])
+        # data processing tasks are for a participant and a data type, those are returned as tuples.
+        all_args.append(args[0] if len(args) == 1 else tuple(args))
     
     return all_args
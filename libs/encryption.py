@@ -1,7 +1,12 @@
 import json
+from binascii import a2b_base64
+from collections import OrderedDict
+from threading import Lock
 from typing import List
 
 from Cryptodome.Cipher import AES
+from Cryptodome.PublicKey import RSA
+from Cryptodome.Util.strxor import strxor
 from django.forms import ValidationError
 
 from config.settings import STORE_DECRYPTION_LINE_ERRORS
@@ -29,6 +34,31 @@ class UncatchableError(Exception): pass
 
 ########################### User/Device Decryption #############################
 
+# Decrypted (RSA unwrapped) file keys by patient id, private key modulus and encrypted key, in least
+# recently used order.  iOS re-sends the same encrypted key when it splits or retries a file.  (A
+# participant's entries are not used once their key pair is replaced, and age out.)
+DECRYPTED_KEY_CACHE_SIZE = 1000
+decrypted_key_cache: "OrderedDict[tuple, bytes]" = OrderedDict()
+decrypted_key_cache_lock = Lock()
+
+# Lines of a file are decrypted in batches of about this many bytes, see decrypt_device_file.
+DECRYPTION_BATCH_BYTES = 1024 * 1024
+# binascii decodes standard base64, this is what base64.urlsafe_b64decode does before decoding.
+URLSAFE_TO_STANDARD_BASE64 = bytes.maketrans(b"-_", b"+/")
+
+
+def raw_rsa_decrypt(ciphertext: bytes, private_key: RSA.RsaKey) -> bytes:
+    """ Textbook RSA decryption, using the Chinese remainder theorem: two exponentiations with half
+    size numbers (mod p and mod q) instead of one mod n, which is about 3x faster.  The result is
+    identical to pow(ciphertext, d, n). """
+    ciphertext_int = int.from_bytes(ciphertext, 'big')
+    p, q = private_key.p, private_key.q
+    m_p = pow(ciphertext_int, private_key.d % (p - 1), p)
+    m_q = pow(ciphertext_int, private_key.d % (q - 1), q)
+    # private_key.u is the inverse of p mod q
+    plaintext_int = m_p + ((m_q - m_p) * private_key.u % q) * p
+    return plaintext_int.to_bytes(private_key.size_in_bytes(), 'big')
+
 
 class DeviceDataDecryptor():
     
@@ -99,11 +129,57 @@ class DeviceDataDecryptor():
         return file_data
     
     def decrypt_device_file(self) -> bytes:
-        """ Runs the line-by-line decryption of a file encrypted by a device. """
+        """ Runs the line-by-line decryption of a file encrypted by a device.
+        
+        Every line is encrypted with the same key and its own iv using AES CBC.  CBC decryption is
+        a block decryption followed by an xor with the previous block of ciphertext (the iv for the
+        first block), so instead of creating a cipher for every line, lines are decrypted in
+        batches: the ciphertext of a batch of lines is decrypted by one ECB cipher in a single
+        call, then xor'd with the ivs and previous blocks.  Lines that don't pass a quick check (a
+        single colon, a 16 byte iv, at least 16 bytes of data) go through decrypt_device_line, and
+        errors are handled exactly as they are line-by-line. """
+        try:
+            block_cipher = AES.new(self.aes_decryption_key, mode=AES.MODE_ECB)
+        except Exception:
+            # an invalid key fails on every line, decrypt_device_line reports that error.
+            block_cipher = None
+        
+        # decrypted lines (or None for lines in the current batch) in order.
+        decrypted_lines = []
+        batch_line_indexes, batch_ciphertexts, batch_previous_blocks = [], [], []
+        batch_bytes = 0
+        
         # we need to skip the first line (the decryption key), but need real index values
         lines = enumerate(self.file_lines)
         next(lines)
         for line_index, line in lines:
+            if block_cipher is not None and line is not None and line.count(b":") == 1:
+                try:
+                    iv, data = line.translate(URLSAFE_TO_STANDARD_BASE64).split(b":")
+                    iv, data = a2b_base64(iv), a2b_base64(data)
+                except Exception:
+                    iv = data = b""
+                if len(iv) == 16 and len(data) >= 16:
+                    # CBC data encryption requires alignment to a 16 bytes, we lose any data that
+                    # overflows that length.
+                    overflow_bytes = len(data) % 16
+                    if overflow_bytes:
+                        data = data[:-overflow_bytes]
+                    batch_line_indexes.append(len(decrypted_lines))
+                    decrypted_lines.append(None)
+                    batch_ciphertexts.append(data)
+                    batch_previous_blocks.append(iv)
+                    batch_previous_blocks.append(data[:-16])
+                    batch_bytes += len(data)
+                    if batch_bytes >= DECRYPTION_BATCH_BYTES:
+                        self.decrypt_batch(
+                            block_cipher, decrypted_lines, batch_line_indexes, batch_ciphertexts,
+                            batch_previous_blocks
+                        )
+                        batch_line_indexes, batch_ciphertexts, batch_previous_blocks = [], [], []
+                        batch_bytes = 0
+                    continue
+            
             self.line_index = line_index
             if line is None:
                 # this case causes weird behavior inside decrypt_device_line, so we test for it instead.
@@ -112,11 +188,33 @@ class DeviceDataDecryptor():
                 # print("encountered empty line of data, ignoring.")
                 continue
             try:
-                self.good_lines.append(self.decrypt_device_line(line))
+                decrypted_lines.append(self.decrypt_device_line(line))
             except Exception as error_orig:
                 self.handle_line_error(line, error_orig)
+        
+        if batch_ciphertexts:
+            self.decrypt_batch(
+                block_cipher, decrypted_lines, batch_line_indexes, batch_ciphertexts,
+                batch_previous_blocks
+            )
+        self.good_lines.extend(decrypted_lines)
         self.create_metadata_error()
     
+    @staticmethod
+    def decrypt_batch(
+        block_cipher, decrypted_lines: List[bytes], line_indexes: List[int],
+        ciphertexts: List[bytes], previous_blocks: List[bytes]
+    ):
+        """ Decrypts a batch of lines (see decrypt_device_file) into their places in decrypted_lines,
+        and removes the PKCS5 padding. """
+        plaintext = strxor(block_cipher.decrypt(b"".join(ciphertexts)), b"".join(previous_blocks))
+        start = 0
+        for line_index, ciphertext in zip(line_indexes, ciphertexts):
+            end = start + len(ciphertext)
+            # PKCS5 Padding: the last byte is the number of bytes at the end that are padding.
+            decrypted_lines[line_index] = plaintext[start:max(start, end - plaintext[end - 1])]
+            start = end
+    
     def extract_aes_key(self) -> bytes:
         """ The following code is a bit dumb. The decryption key is encoded as base64 twice,
         once to wrap output of the RSA encryption, and once wrapping the AES decryption key. 
@@ -166,14 +264,19 @@ class DeviceDataDecryptor():
         # PyCryptodome deprecated the old PyCrypto method RSA.decrypt() which could decrypt
         # textbook/raw RSA without key padding, which is what the Android & iOS apps write. This
         # (github.com/Legrandin/pycryptodome/issues/434#issuecomment-660701725) presents a
-        # plain-math implementation of RSA.decrypt(), which we use instead.
-        ciphertext_int = int.from_bytes(decoded_key, 'big')
-        plaintext_int = pow(
-            ciphertext_int, self.private_key_cipher.d, self.private_key_cipher.n
-        )
-        base64_key: bytes = plaintext_int.to_bytes(
-            self.private_key_cipher.size_in_bytes(), 'big'
-        ).lstrip(b'\x00')
+        # plain-math implementation of RSA.decrypt(), which we use instead. (see raw_rsa_decrypt)
+        cache_key = (self.participant.patient_id, self.private_key_cipher.n, decoded_key)
+        with decrypted_key_cache_lock:
+            if cache_key in decrypted_key_cache:
+                decrypted_key_cache.move_to_end(cache_key)
+                return decrypted_key_cache[cache_key]
+        
+        base64_key: bytes = raw_rsa_decrypt(decoded_key, self.private_key_cipher).lstrip(b'\x00')
+        
+        with decrypted_key_cache_lock:
+            decrypted_key_cache[cache_key] = base64_key
+            while len(decrypted_key_cache) > DECRYPTED_KEY_CACHE_SIZE:
+                decrypted_key_cache.popitem(last=False)
         return base64_key
     
     def populate_ios_decryption_key(self, base64_key: bytes):
@@ -1,10 +1,16 @@
 import sys
 import traceback
-from typing import Tuple
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Tuple
 
-from database.data_access_models import ChunkRegistry
+from django.utils import timezone
+
+from database.data_access_models import ChunkDelta, ChunkRegistry
+from libs.file_processing.chunk_cache import cache_chunk
 from libs.file_processing.utility_functions_simple import decompress
 from libs.s3 import s3_upload
+from libs.security import chunk_hash
 
 
 # from datetime import datetime
@@ -12,15 +18,16 @@ from libs.s3 import s3_upload
 from libs.sentry import make_error_sentry, SentryTypes
 
 
-def batch_upload(upload: Tuple[ChunkRegistry or dict, str, bytes, str]):
+def batch_upload(upload: Tuple[ChunkRegistry or ChunkDelta or dict, str, bytes, bool, str]):
     """ Used for mapping an s3_upload function.  the tuple is unpacked, can only have one parameter. """
 
-    ret = {'exception': None, 'traceback': None}
+    ret = {'exception': None, 'traceback': None, 'chunk': None}
     with make_error_sentry(sentry_type=SentryTypes.data_processing):
         try:
-            chunk, chunk_path, new_contents, study_object_id = upload
+            chunk, chunk_path, new_contents, compressed, study_object_id = upload
             del upload
-            new_contents = decompress(new_contents)
+            if compressed:
+                new_contents = decompress(new_contents)
 
             if "b'" in chunk_path:
                 raise Exception(chunk_path)
@@ -33,14 +40,20 @@ def batch_upload(upload: Tuple[ChunkRegistry or dict, str, bytes, str]):
 
             s3_upload(chunk_path, new_contents, study_object_id, raw_path=True)
 
-            # if the chunk object is a chunk registry then we are updating an old one,
-            # otherwise we are creating a new one.
-            if isinstance(chunk, ChunkRegistry):
-                # If the contents are being appended to an existing ChunkRegistry object
-                chunk.file_size = len(new_contents)
-                chunk.update_chunk(new_contents)
+            # If the chunk object is a chunk registry then we are updating an old one, if it is a
+            # chunk delta we are adding a delta segment to an old one, otherwise we are creating a
+            # new one.  The database is updated in bulk once all of a page's uploads are done, see
+            # save_uploaded_chunks.
+            if isinstance(chunk, ChunkDelta):
+                chunk.add_to_chunk(new_contents)
             else:
-                ChunkRegistry.register_chunked_data(**chunk, file_contents=new_contents)
+                if isinstance(chunk, ChunkRegistry):
+                    chunk.file_size = len(new_contents)
+                    chunk.chunk_hash = chunk_hash(new_contents).decode()
+                else:
+                    chunk = ChunkRegistry.new_chunked_data(**chunk, file_contents=new_contents)
+                cache_chunk(chunk_path, chunk.chunk_hash, new_contents)
+            ret['chunk'] = chunk
 
         # it broke. print stacktrace for debugging
         except Exception as e:
@@ -52,3 +65,41 @@ def batch_upload(upload: Tuple[ChunkRegistry or dict, str, bytes, str]):
             raise
 
     return ret
+
+
+def save_uploaded_chunks(
+    uploaded_chunks: List[ChunkRegistry or ChunkDelta]
+) -> Dict[Tuple[datetime, str], int]:
+    """ Saves the ChunkRegistries and ChunkDeltas of successful uploads (see batch_upload) with one
+    query per table, instead of one query per chunk.  Returns the change in the ChunkRegistries'
+    file sizes, keyed by time bin and data type. """
+    now = timezone.now()
+    new_chunks, updated_chunks, new_deltas = [], [], []
+    for chunk in uploaded_chunks:
+        if isinstance(chunk, ChunkDelta):
+            new_deltas.append(chunk)
+            chunk = chunk.chunk
+        if chunk.pk is None:
+            new_chunks.append(chunk)
+        else:
+            # (bulk_update doesn't do auto_now)
+            chunk.last_updated = now
+            updated_chunks.append(chunk)
+    
+    file_size_changes = defaultdict(int)
+    previous_file_sizes = dict(
+        ChunkRegistry.objects.filter(pk__in=[chunk.pk for chunk in updated_chunks])
+            .values_list("pk", "file_size")
+    )
+    for chunk in updated_chunks:
+        file_size_changes[chunk.time_bin, chunk.data_type] += \
+            chunk.file_size - (previous_file_sizes.get(chunk.pk) or 0)
+    for chunk in new_chunks:
+        file_size_changes[chunk.time_bin, chunk.data_type] += chunk.file_size
+    
+    ChunkRegistry.objects.bulk_create(new_chunks, batch_size=500)
+    ChunkRegistry.objects.bulk_update(
+        updated_chunks, ["chunk_hash", "file_size", "last_updated"], batch_size=500
+    )
+    ChunkDelta.objects.bulk_create(new_deltas, batch_size=500)
+    return file_size_changes
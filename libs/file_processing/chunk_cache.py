@@ -0,0 +1,107 @@
+import os
+from hashlib import sha256
+from threading import get_ident, Lock
+from typing import Optional
+
+from config.settings import CHUNK_CACHE_DIRECTORY, CHUNK_CACHE_MB
+from libs.file_processing.utility_functions_simple import compress, decompress
+
+
+# The chunk cache is a folder of files named after chunk paths, each containing the chunk hash on
+# the first line followed by the compressed chunk.  All data processing worker processes on a server
+# share it.  Entries are written to a temporary file and renamed into place, and an entry is only
+# used if its hash matches the chunk's hash in the database, so a chunk that was updated by another
+# server (or an older write that finished late) is never used.
+
+# Evicting entries scans the whole folder, so it only happens after this fraction of the cache size
+# has been written.
+EVICTION_FRACTION = 10
+
+eviction_lock = Lock()
+bytes_written_since_eviction = 0
+
+
+def chunk_cache_enabled() -> bool:
+    return CHUNK_CACHE_MB > 0
+
+
+def cache_entry_path(chunk_path: str) -> str:
+    return os.path.join(CHUNK_CACHE_DIRECTORY, sha256(chunk_path.encode()).hexdigest())
+
+
+def get_cached_chunk(chunk_path: str, chunk_hash: str) -> Optional[bytes]:
+    """ Returns the contents of a chunk if the cache has its current version, otherwise None. """
+    if not chunk_cache_enabled():
+        return None
+
+    entry_path = cache_entry_path(chunk_path)
+    try:
+        with open(entry_path, "rb") as f:
+            if f.readline().rstrip(b"\n").decode() != chunk_hash:
+                return None
+            compressed_contents = f.read()
+        # eviction removes the least recently used entries first.
+        os.utime(entry_path)
+    except OSError:
+        return None
+    return decompress(compressed_contents)
+
+
+def cache_chunk(chunk_path: str, chunk_hash: str, contents: bytes):
+    """ Adds (or replaces) a chunk in the cache. The cache is optional, so errors (e.g. the disk being
+    full) are ignored. """
+    global bytes_written_since_eviction
+    if not chunk_cache_enabled():
+        return
+
+    compressed_contents = compress(contents)
+    entry_path = cache_entry_path(chunk_path)
+    temp_path = f"{entry_path}.{os.getpid()}.{get_ident()}.tmp"
+    try:
+        os.makedirs(CHUNK_CACHE_DIRECTORY, exist_ok=True)
+        with open(temp_path, "wb") as f:
+            f.write(chunk_hash.encode() + b"\n")
+            f.write(compressed_contents)
+        os.replace(temp_path, entry_path)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        return
+
+    bytes_written_since_eviction += len(compressed_contents)
+    if bytes_written_since_eviction > CHUNK_CACHE_MB * 1024 * 1024 // EVICTION_FRACTION:
+        # uploads run in threads, one eviction at a time is plenty.
+        if eviction_lock.acquire(blocking=False):
+            try:
+                bytes_written_since_eviction = 0
+                evict_cached_chunks()
+            finally:
+                eviction_lock.release()
+
+
+def evict_cached_chunks():
+    """ Removes the least recently used entries until the cache fits in CHUNK_CACHE_MB. """
+    entries = []
+    total_size = 0
+    with os.scandir(CHUNK_CACHE_DIRECTORY) as folder:
+        for entry in folder:
+            if entry.name.endswith(".tmp"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:  # removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+
+    entries.sort()
+    for _, size, path in entries:
+        if total_size <= CHUNK_CACHE_MB * 1024 * 1024:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total_size -= size
@@ -0,0 +1,116 @@
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List
+
+from django.db import transaction
+
+from constants.data_processing_constants import CHUNK_DELTAS_FOLDER, CHUNKS_FOLDER
+from constants.data_stream_constants import CHUNKABLE_FILES
+from database.data_access_models import ChunkDelta, ChunkRegistry
+from libs.file_processing.data_qty_stats import update_data_quantity_stats
+from libs.file_processing.utility_functions_simple import (merge_rows_into_chunk_lines,
+    split_chunk_lines)
+from libs.internal_types import StrOrParticipantOrStudy
+from libs.s3 import s3_retrieve, s3_upload
+from libs.security import generate_easy_alphanumeric_string
+
+
+def construct_s3_delta_path(chunk_path: str) -> str:
+    """ S3 file paths for delta segments are of this form:
+        CHUNK_DELTAS/study_id/patient_id/data_stream/time_bin/random_string.csv """
+    chunk_path = chunk_path.replace(CHUNKS_FOLDER, CHUNK_DELTAS_FOLDER, 1)
+    return f"{chunk_path[:-len('.csv')]}/{generate_easy_alphanumeric_string(16)}.csv"
+
+
+def merge_delta_segments(chunk_contents: bytes, delta_segments: List[bytes]) -> bytes:
+    """ Merges delta segments (oldest first) into the contents of a chunk, exactly like data
+    processing merges new data into a chunk.  The header of the most recent segment is used, data
+    processing has already validated it. """
+    header, lines, timestamps = split_chunk_lines(chunk_contents)
+    new_lines, new_timestamps = [], []
+    for delta_contents in delta_segments:
+        header, delta_lines, delta_timestamps = split_chunk_lines(delta_contents)
+        new_lines.extend(delta_lines)
+        new_timestamps.extend(delta_timestamps)
+
+    # merge_rows_into_chunk_lines joins the columns of new rows, a row of one "column" is the line.
+    merged_lines = merge_rows_into_chunk_lines(
+        lines, timestamps, [[line] for line in new_lines], new_timestamps
+    )
+    return header + b"\n" + b"\n".join(merged_lines)
+
+
+# chunks downloaded in bulk (data access api, forest) get their delta segments in one query per this
+# many chunks.
+DELTA_PATHS_BATCH_SIZE = 500
+
+
+def get_delta_paths(chunk_pks: Iterable[int]) -> Dict[int, List[str]]:
+    """ The S3 paths of the delta segments of chunks that have not been compacted, oldest first. """
+    delta_paths = defaultdict(list)
+    query = ChunkDelta.objects.filter(chunk_id__in=chunk_pks).order_by("pk")
+    for chunk_pk, s3_path in query.values_list("chunk_id", "s3_path"):
+        delta_paths[chunk_pk].append(s3_path)
+    return delta_paths
+
+
+def with_delta_paths(chunks: Iterable[dict]) -> Iterator[dict]:
+    """ Adds the delta segment paths of chunk dictionaries (with pk and data_type) as "delta_paths",
+    passes through an iterator lazily.  Unchunkable files never have delta segments. """
+    batch = []
+    for chunk in chunks:
+        batch.append(chunk)
+        if len(batch) >= DELTA_PATHS_BATCH_SIZE:
+            yield from _add_delta_paths(batch)
+            batch = []
+    yield from _add_delta_paths(batch)
+
+
+def _add_delta_paths(chunks: List[dict]) -> List[dict]:
+    chunk_pks = [chunk["pk"] for chunk in chunks if chunk["data_type"] in CHUNKABLE_FILES]
+    delta_paths = get_delta_paths(chunk_pks) if chunk_pks else {}
+    for chunk in chunks:
+        chunk["delta_paths"] = delta_paths.get(chunk["pk"], [])
+    return chunks
+
+
+def add_delta_segment_files(
+    chunk_contents: bytes, delta_paths: List[str], obj: StrOrParticipantOrStudy
+) -> bytes:
+    """ Merges delta segments, by S3 path, into the chunk contents. """
+    if not delta_paths:
+        return chunk_contents
+    return merge_delta_segments(
+        chunk_contents, [s3_retrieve(path, obj, raw_path=True) for path in delta_paths]
+    )
+
+
+def add_delta_segments(chunk_pk: int, chunk_contents: bytes, obj: StrOrParticipantOrStudy) -> bytes:
+    """ Merges a chunk's delta segments that have not been compacted yet into the chunk contents. """
+    return add_delta_segment_files(chunk_contents, get_delta_paths([chunk_pk])[chunk_pk], obj)
+
+
+def compact_chunk(chunk: ChunkRegistry):
+    """ Merges a chunk's delta segments into the chunk file. """
+    deltas = list(chunk.deltas.order_by("pk"))
+    if not deltas:
+        return
+
+    study_object_id = chunk.study.object_id
+    new_contents = merge_delta_segments(
+        s3_retrieve(chunk.chunk_path, study_object_id, raw_path=True),
+        [s3_retrieve(delta.s3_path, study_object_id, raw_path=True) for delta in deltas],
+    )
+    s3_upload(chunk.chunk_path, new_contents, study_object_id, raw_path=True)
+    
+    # Delta segments were counted at their full size, rows the chunk already had are dropped by the
+    # merge, so the chunk (and its data quantity stats) usually shrinks.  If the chunk has been
+    # uploaded but this fails the deltas will be merged in again, which is harmless because merging
+    # deduplicates rows. (The segment files are left in place, see CHUNK_DELTA_SEGMENTS.)
+    previous_file_size = chunk.file_size or 0
+    chunk.file_size = len(new_contents)
+    with transaction.atomic():
+        chunk.update_chunk(new_contents)
+        update_data_quantity_stats(
+            chunk.participant, {(chunk.time_bin, chunk.data_type): chunk.file_size - previous_file_size}
+        )
+        ChunkDelta.objects.filter(pk__in=[delta.pk for delta in deltas]).delete()
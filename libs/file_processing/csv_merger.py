@@ -2,21 +2,24 @@ from typing import Dict, List, Set, Tuple
 
 from botocore.exceptions import ReadTimeoutError
 from cronutils import ErrorHandler
-from constants.common_constants import RUNNING_TEST_OR_IN_A_SHELL
 
+from config.settings import CHUNK_DELTA_SEGMENTS, UNCOMPRESSED_UPLOAD_BUDGET_MB
+from constants.common_constants import RUNNING_TEST_OR_IN_A_SHELL
 from constants.data_processing_constants import (CHUNK_TIMESLICE_QUANTUM, CHUNKS_FOLDER,
     REFERENCE_CHUNKREGISTRY_HEADERS)
 from constants.data_stream_constants import SURVEY_DATA_FILES
-from database.data_access_models import ChunkRegistry
+from database.data_access_models import ChunkDelta, ChunkRegistry
 from database.study_models import Study
 from database.survey_models import Survey
 from database.system_models import GenericEvent
 from database.user_models import Participant
+from libs.file_processing.chunk_cache import chunk_cache_enabled, get_cached_chunk
+from libs.file_processing.chunk_deltas import construct_s3_delta_path
 from libs.file_processing.exceptions import BadHeaderException, ChunkFailedToExist
-from libs.file_processing.utility_functions_csvs import (construct_csv_string, csv_to_list,
-    unix_time_to_string)
+from libs.file_processing.utility_functions_csvs import construct_csv_string, unix_time_to_string
 from libs.file_processing.utility_functions_simple import (compress,
-    convert_unix_to_human_readable_timestamps, ensure_sorted_by_timestamp)
+    human_readable_timestamps_header, merge_rows_into_chunk_lines, sort_by_timestamp,
+    split_chunk_lines)
 from libs.s3 import s3_retrieve
 
 
@@ -32,8 +35,17 @@ class CsvMerger:
         self.failed_ftps = set()
         self.ftps_to_retire = set()
         
-        self.upload_these: List[Tuple[ChunkRegistry, str, bytes, str]] = []
-        # chunk, something?, file contents, study object id
+        self.upload_these: List[Tuple[ChunkRegistry or ChunkDelta or dict, str, bytes, bool, str]] = []
+        # chunk or chunk params, chunk path, file contents, whether contents are compressed, study object id
+        self.upload_ftps: List[List[int]] = []  # the pks of the files in each upload's bin
+        
+        # Pending uploads are kept uncompressed until they exceed the memory budget, compressed after.
+        self.uncompressed_budget = UNCOMPRESSED_UPLOAD_BUDGET_MB * 1024 * 1024
+        self.uncompressed_bytes = 0
+        self.bytes_before_compression = 0
+        self.bytes_after_compression = 0
+        self.chunk_cache_hits = 0
+        self.chunk_cache_misses = 0
         
         # Track the earliest and latest time bins, to return them at the end of the function
         self.earliest_time_bin: int = None
@@ -42,6 +54,15 @@ class CsvMerger:
         self.binified_data = binified_data
         self.error_handler = error_handler
         self.survey_id_dict = survey_id_dict
+        
+        # ChunkRegistry objects for every bin that already has a chunk, keyed by chunk path.
+        self.existing_chunks: Dict[str, ChunkRegistry] = {}
+        
+        # Database primary keys for new ChunkRegistries, keyed by object id / patient id. A page only
+        # ever contains data from one participant, so the study and participant are prepopulated.
+        self.study_pks: Dict[str, int] = {participant.study.object_id: participant.study_id}
+        self.participant_pks: Dict[str, int] = {participant.patient_id: participant.pk}
+        self.survey_pks: Dict[str, int] = {}
         self.iterate()
     
     def get_retirees(self) -> Tuple[Set[int], int, int, int]:
@@ -53,12 +74,29 @@ class CsvMerger:
     def iterate(self):
         # this function is the core loop. we iterate over all binified data and merge data into new
         # chunks, then handle ChunkRegistry parameter setup for the next stage of processing.
+        self.populate_existing_chunks()
         ftp_list: List[int]
-        for data_bin, (data_rows_list, ftp_list) in self.binified_data.items():
+        for data_bin, (data_rows_list, timestamps, ftp_list) in self.binified_data.items():
+            upload_count = len(self.upload_these)
             with self.error_handler:
-                self.inner_iterate(data_bin, data_rows_list, ftp_list)
+                self.inner_iterate(data_bin, data_rows_list, timestamps, ftp_list)
+            self.upload_ftps.extend([ftp_list] * (len(self.upload_these) - upload_count))
     
-    def inner_iterate(self, data_bin, data_rows_list, ftp_list: List[int]):
+    def populate_existing_chunks(self):
+        """ Determines which bins on this page already have a chunk using a single query, instead of
+        an exists-query and a get-query for every bin. """
+        chunk_paths = {
+            construct_s3_chunk_path(study_object_id, patient_id, data_stream, time_bin)
+            for study_object_id, patient_id, data_stream, time_bin, _ in self.binified_data
+        }
+        if not chunk_paths:
+            return
+        self.existing_chunks = {
+            chunk.chunk_path: chunk
+            for chunk in ChunkRegistry.objects.filter(chunk_path__in=chunk_paths)
+        }
+    
+    def inner_iterate(self, data_bin, data_rows_list, timestamps: List[int], ftp_list: List[int]):
         study_object_id: str
         patient_id: str
         data_stream: str
@@ -73,21 +111,21 @@ class CsvMerger:
             if self.latest_time_bin is None or time_bin > self.latest_time_bin:
                 self.latest_time_bin = time_bin
             
-            # data_rows_list may be a generator; here it is evaluated
-            updated_header = convert_unix_to_human_readable_timestamps(
-                original_header, data_rows_list
-            )
+            # the rows already have their human readable timestamp column, see parse_csv_file.
+            updated_header = human_readable_timestamps_header(original_header)
             chunk_path = construct_s3_chunk_path(study_object_id, patient_id, data_stream, time_bin)
             
             # two core cases
-            if ChunkRegistry.objects.filter(chunk_path=chunk_path).exists():
+            chunk = self.existing_chunks.get(chunk_path, None)
+            if chunk is not None:
                 self.chunk_exists_case(
-                    chunk_path, study_object_id, updated_header, data_rows_list, data_stream
+                    chunk, chunk_path, study_object_id, updated_header, data_rows_list, timestamps,
+                    data_stream
                 )
             else:
                 self.chunk_not_exists_case(
                     chunk_path, study_object_id, updated_header, patient_id, data_stream,
-                    original_header, time_bin, data_rows_list
+                    original_header, time_bin, data_rows_list, timestamps
                 )
         
         except Exception as e:
@@ -115,42 +153,62 @@ class CsvMerger:
     
     def chunk_not_exists_case(
         self, chunk_path: str, study_object_id: str, updated_header: str, patient_id: str,
-        data_stream: str, original_header: bytes, time_bin: int, rows: List[bytes]
+        data_stream: str, original_header: bytes, time_bin: int, rows: List[bytes],
+        timestamps: List[int]
     ):
-        ensure_sorted_by_timestamp(rows)
+        rows, _ = sort_by_timestamp(rows, timestamps)
         final_header = self.validate_one_header(updated_header, data_stream)
         new_contents = construct_csv_string(final_header, rows)
         if data_stream in SURVEY_DATA_FILES:
             # We need to keep a mapping of files to survey ids, that is handled here.
             survey_id_hash = study_object_id, patient_id, data_stream, original_header
-            survey_id = Survey.objects.filter(
-                object_id=self.survey_id_dict[survey_id_hash]
-            ).values_list("pk", flat=True).get()
+            survey_id = self.get_pk(
+                self.survey_pks, Survey, "object_id", self.survey_id_dict[survey_id_hash]
+            )
         else:
             survey_id = None
         
-        # this object will eventually get **kwarg'd into ChunkRegistry.register_chunked_data
+        # this object will eventually get **kwarg'd into ChunkRegistry.new_chunked_data
         chunk_params = {
-            "study_id": Study.objects.filter(object_id=study_object_id).values_list("pk", flat=True).get(),
-            "participant_id": Participant.objects.filter(patient_id=patient_id).values_list("pk", flat=True).get(),
+            "study_id": self.get_pk(self.study_pks, Study, "object_id", study_object_id),
+            "participant_id": self.get_pk(self.participant_pks, Participant, "patient_id", patient_id),
             "data_type": data_stream,
             "chunk_path": chunk_path,
             "time_bin": time_bin,
             "survey_id": survey_id
         }
         
-        self.upload_these.append(
-            (chunk_params, chunk_path, compress(new_contents), study_object_id)
-        )
+        self.append_upload(chunk_params, chunk_path, new_contents, study_object_id)
     
     def chunk_exists_case(
-        self, chunk_path: str, study_object_id: str, updated_header: str, rows: List[bytes],
-        data_stream: str
+        self, chunk: ChunkRegistry, chunk_path: str, study_object_id: str, updated_header: str,
+        rows: List[bytes], timestamps: List[int], data_stream: str
     ):
-        chunk = ChunkRegistry.objects.get(chunk_path=chunk_path)
+        if CHUNK_DELTA_SEGMENTS:
+            return self.delta_segment_case(
+                chunk, chunk_path, study_object_id, updated_header, rows, timestamps, data_stream
+            )
+        
+        # the chunk cache usually has the current hour's chunk, which is the one most often updated.
+        s3_file_data = get_cached_chunk(chunk_path, chunk.chunk_hash)
+        if s3_file_data is None:
+            self.chunk_cache_misses += 1
+            s3_file_data = self.download_chunk(chunk, chunk_path, study_object_id)
+        else:
+            self.chunk_cache_hits += 1
+        
+        old_header, old_lines, old_timestamps = split_chunk_lines(s3_file_data)
+        del s3_file_data
+        final_header = self.validate_two_headers(old_header, updated_header, data_stream)
+        
+        merged_lines = merge_rows_into_chunk_lines(old_lines, old_timestamps, rows, timestamps)
+        new_contents = final_header + b"\n" + b"\n".join(merged_lines)
         
+        self.append_upload(chunk, chunk_path, new_contents, study_object_id)
+    
+    def download_chunk(self, chunk: ChunkRegistry, chunk_path: str, study_object_id: str) -> bytes:
         try:
-            s3_file_data = s3_retrieve(chunk_path, study_object_id, raw_path=True)
+            return s3_retrieve(chunk_path, study_object_id, raw_path=True)
         except ReadTimeoutError as e:
             # The following check was correct for boto 2, still need to hit with boto3 test.
             if "The specified key does not exist." == str(e):
@@ -165,16 +223,56 @@ class CsvMerger:
                     % chunk_path
                 )
             raise  # Raise original error if not 404 s3 error
-        
-        old_header, old_rows = csv_to_list(s3_file_data)
-        final_header = self.validate_two_headers(old_header, updated_header, data_stream)
-        
-        old_rows = list(old_rows)
-        old_rows.extend(rows)
-        ensure_sorted_by_timestamp(old_rows)
-        new_contents = construct_csv_string(final_header, old_rows)
-        
-        self.upload_these.append((chunk, chunk_path, compress(new_contents), study_object_id))
+    
+    def delta_segment_case(
+        self, chunk: ChunkRegistry, chunk_path: str, study_object_id: str, updated_header: str,
+        rows: List[bytes], timestamps: List[int], data_stream: str
+    ):
+        """ Uploads the new rows as a delta segment of the chunk, without downloading the chunk. """
+        rows, _ = sort_by_timestamp(rows, timestamps)
+        final_header = self.validate_one_header(updated_header, data_stream)
+        delta_path = construct_s3_delta_path(chunk_path)
+        self.append_upload(
+            ChunkDelta(chunk=chunk, s3_path=delta_path), delta_path,
+            construct_csv_string(final_header, rows), study_object_id
+        )
+    
+    def append_upload(
+        self, chunk: ChunkRegistry or ChunkDelta or dict, chunk_path: str, new_contents: bytes,
+        study_object_id: str
+    ):
+        """ Compression only pays for itself when it saves memory we need, so the first
+        UNCOMPRESSED_UPLOAD_BUDGET_MB of pending uploads are not compressed. """
+        if self.uncompressed_bytes + len(new_contents) <= self.uncompressed_budget:
+            self.uncompressed_bytes += len(new_contents)
+            self.upload_these.append((chunk, chunk_path, new_contents, False, study_object_id))
+        else:
+            self.bytes_before_compression += len(new_contents)
+            new_contents = compress(new_contents)
+            self.bytes_after_compression += len(new_contents)
+            self.upload_these.append((chunk, chunk_path, new_contents, True, study_object_id))
+    
+    def print_upload_stats(self):
+        print(
+            f"{len(self.upload_these)} chunks to upload: {self.uncompressed_bytes} bytes held "
+            f"uncompressed, {self.bytes_before_compression} bytes compressed to "
+            f"{self.bytes_after_compression} bytes."
+        )
+        if chunk_cache_enabled():
+            print(
+                f"chunk cache: {self.chunk_cache_hits} hits, {self.chunk_cache_misses} misses."
+            )
+    
+    @staticmethod
+    def get_pk(cache: Dict[str, int], model, field_name: str, value: str) -> int:
+        """ Returns the primary key of the database object where field_name matches value, only
+        querying the database the first time a value is encountered. """
+        try:
+            return cache[value]
+        except KeyError:
+            pass
+        cache[value] = model.objects.filter(**{field_name: value}).values_list("pk", flat=True).get()
+        return cache[value]
     
     def validate_one_header(self, header: bytes, data_stream: str) -> bytes:
         real_header: bytes = REFERENCE_CHUNKREGISTRY_HEADERS[data_stream][self.participant.os_type]
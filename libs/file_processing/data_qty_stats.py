@@ -1,8 +1,11 @@
 from collections import defaultdict
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, Optional, Tuple
 
+from django.db.models import Case, F, IntegerField, Value, When
+from django.db.models.functions import Coalesce
 from django.db.models.query import QuerySet
+from django.utils import timezone
 from pytz import utc
 
 from constants.data_processing_constants import CHUNK_TIMESLICE_QUANTUM
@@ -65,6 +68,40 @@ def calculate_data_quantity_stats(
         SummaryStatisticDaily.objects.update_or_create(**data_quantity)
 
 
+def update_data_quantity_stats(
+    participant: Participant, file_size_changes: Dict[Tuple[datetime, str], int]
+):
+    """ Adds changes in the size of a participant's ChunkRegistries (in bytes, keyed by time bin and
+    data type) to their SummaryStatisticDaily data quantities.  Unlike calculate_data_quantity_stats
+    this doesn't read any ChunkRegistries, and makes at most two queries.  The increment happens in
+    the database, so it is safe with other data types of the participant being processed
+    concurrently. """
+    study_timezone = participant.study.timezone
+    daily_changes = defaultdict(lambda: defaultdict(int))
+    for (time_bin, data_type), change in file_size_changes.items():
+        if data_type in ALL_DATA_STREAMS and change:
+            daily_changes[data_type][time_bin.astimezone(study_timezone).date()] += change
+    if not daily_changes:
+        return
+    
+    days = {day for changes in daily_changes.values() for day in changes}
+    SummaryStatisticDaily.objects.bulk_create(
+        [SummaryStatisticDaily(participant=participant, date=day) for day in days],
+        ignore_conflicts=True,
+    )
+    SummaryStatisticDaily.objects.filter(participant=participant, date__in=days).update(
+        last_updated=timezone.now(),
+        **{
+            f"beiwe_{data_type}_bytes": Coalesce(F(f"beiwe_{data_type}_bytes"), 0) + Case(
+                *(When(date=day, then=Value(change)) for day, change in changes.items()),
+                default=Value(0),
+                output_field=IntegerField(),
+            )
+            for data_type, changes in daily_changes.items()
+        }
+    )
+
+
 def utc_datetime_of_local_midnight_date(local_date, local_timezone):
     local_midnight = datetime.combine(local_date, datetime.min.time()).replace(tzinfo=local_timezone)
     return local_midnight.astimezone(utc)
@@ -6,7 +6,7 @@ import traceback
 from constants.data_stream_constants import CHUNKABLE_FILES
 from database.data_access_models import FileToProcess
 from libs.file_processing.utility_functions_simple import s3_file_path_to_data_type
-from libs.s3 import s3_retrieve
+from libs.s3 import s3_get_size, s3_retrieve
 
 
 class SomeException(Exception): pass
@@ -14,18 +14,25 @@ class SomeException2(Exception): pass
 
 
 class FileForProcessing():
-    def __init__(self, file_to_process: FileToProcess):
+    def __init__(self, file_to_process: FileToProcess, file_size: int = None):
+        """ Unchunkable files are registered as-is, only their size is needed, they are not
+        downloaded.  Provide file_size if it is known (recorded at upload), otherwise it is
+        retrieved from S3. """
         self.file_to_process: FileToProcess = file_to_process
         self.data_type: str = s3_file_path_to_data_type(file_to_process.s3_file_path)
         self.chunkable: bool = self.data_type in CHUNKABLE_FILES
         self.file_contents: bytes = None
+        self.file_size: int = file_size
 
         # state tracking
         self.exception: Exception or None = None
         self.traceback: str or None = None
 
         # magically populate at instantiation for now due to networking paradigm.
-        self.download_file_contents()
+        if self.chunkable:
+            self.download_file_contents()
+        elif self.file_size is None:
+            self.retrieve_file_size()
 
     def clear_file_content(self):
         del self.file_contents
@@ -46,6 +53,20 @@ class FileForProcessing():
             self.exception = e
             raise SomeException(e)
 
+    def retrieve_file_size(self):
+        """ Same error handling as download_file_contents, but only gets the file size. """
+        try:
+            self.file_size = s3_get_size(
+                self.file_to_process.s3_file_path,
+                self.file_to_process.study.object_id,
+                raw_path=True
+            )
+        except Exception as e:
+            traceback.print_exc()
+            self.traceback = sys.exc_info()
+            self.exception = e
+            raise SomeException(e)
+
     def raise_data_processing_error(self):
         """
         If we encountered any errors in retrieving the files for processing, they have been
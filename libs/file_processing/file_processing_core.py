@@ -1,30 +1,64 @@
-from collections import defaultdict
-from multiprocessing.pool import ThreadPool
-from typing import DefaultDict
+from collections import Counter, defaultdict, deque
+from multiprocessing.pool import AsyncResult, ThreadPool
+from threading import Lock, Semaphore
+from time import perf_counter
+from typing import DefaultDict, Dict, List, Optional, Set, Tuple
 
 from cronutils.error_handler import ErrorHandler
 from django.core.exceptions import ValidationError
+from django.db import connection, transaction
 
-from config.settings import CONCURRENT_NETWORK_OPS
+from config.settings import (CONCURRENT_NETWORK_OPS, FILE_PARSING_PROCESSES,
+    FILE_PROCESS_MAX_PAGE_SIZE, FILE_PROCESS_PAGE_BUDGET_MB, FILE_PROCESS_PAGE_SIZE,
+    VECTORIZED_BINIFICATION_STREAMS)
+from constants.data_processing_constants import VECTORIZABLE_DATA_STREAMS
 from constants.data_stream_constants import (ACCELEROMETER, ANDROID_LOG_FILE, CALL_LOG, IDENTIFIERS,
     SURVEY_DATA_FILES, SURVEY_TIMINGS, WIFI)
 from constants.user_constants import ANDROID_API
-from database.data_access_models import ChunkRegistry, FileToProcess
+from database.data_access_models import ChunkDelta, ChunkRegistry, FileToProcess
 from database.user_models import Participant
-from libs.file_processing.batched_network_operations import batch_upload
+from libs.file_processing.batched_network_operations import batch_upload, save_uploaded_chunks
 from libs.file_processing.csv_merger import CsvMerger
 from libs.file_processing.data_fixes import (fix_app_log_file, fix_call_log_csv, fix_identifier_csv,
     fix_survey_timings, fix_wifi_csv)
-from libs.file_processing.data_qty_stats import calculate_data_quantity_stats
-from libs.file_processing.exceptions import BadTimecodeError
+from libs.file_processing.data_qty_stats import update_data_quantity_stats
 from libs.file_processing.file_for_processing import FileForProcessing
 from libs.file_processing.utility_functions_csvs import clean_java_timecode, csv_to_list
-from libs.file_processing.utility_functions_simple import (binify_from_timecode,
-    resolve_survey_id_from_file_name)
+from libs.file_processing.utility_functions_simple import (binify_from_timestamp,
+    convert_unix_to_human_readable_timestamps, resolve_survey_id_from_file_name,
+    s3_file_path_to_data_type, sort_by_timestamp)
+from libs.file_processing.vectorized_binification import (binify_csv_contents,
+    vectorized_binification_available)
+
+
+# billiard is celery's fork of multiprocessing. Its pools can be created inside of celery's worker
+# processes, multiprocessing refuses to create child processes of daemonic processes.
+try:
+    from billiard.pool import Pool as ProcessPool
+except ImportError:
+    from multiprocessing.pool import Pool as ProcessPool
+
+
+# data streams that are binified by the vectorized binification code.
+VECTORIZED_DATA_STREAMS = VECTORIZABLE_DATA_STREAMS.intersection(VECTORIZED_BINIFICATION_STREAMS) \
+    if vectorized_binification_available() else set()
 
 
 """########################## Hourly Update Tasks ###########################"""
 
+def create_parse_pool() -> Optional[ProcessPool]:
+    """ The worker processes that parse files for process_user_file_chunks_page, None if
+    FILE_PARSING_PROCESSES is 0.  Create it once per data processing task, before any threads are
+    started, and terminate it when the task is done. """
+    if FILE_PARSING_PROCESSES <= 0:
+        return None
+    # The worker processes must not inherit this process' database connection, Django reconnects on
+    # the next query.  (Inside a transaction, e.g. in tests, the connection has to be kept.)
+    if not connection.in_atomic_block:
+        connection.close()
+    return ProcessPool(FILE_PARSING_PROCESSES)
+
+
 # This is useful for testing and profiling behavior. Replaces the imported threadpool with this
 # dummy class and poof! Single-threaded so the "threaded" network operations have real stack traces!
 # class ThreadPool():
@@ -36,9 +70,182 @@ from libs.file_processing.utility_functions_simple import (binify_from_timecode,
 #     def __init__(self, *args,**kwargs): pass
 
 
+class PipelineStats:
+    """ Timings and queue depths of each stage of process_user_file_chunks_page, used for tuning
+    CONCURRENT_NETWORK_OPS and FILE_PARSING_PROCESSES. Time spent waiting on the download and upload
+    stages is time the processing thread was blocked on the network, time spent waiting on parsing
+    is time blocked on worker processes, parse and merge time is cpu (and database) time. """
+    
+    def __init__(self):
+        self.files_downloaded = 0
+        self.files_parsed = 0
+        self.chunks_uploaded = 0
+        self.download_wait_seconds = 0.0
+        self.parse_seconds = 0.0
+        self.parse_wait_seconds = 0.0
+        self.merge_seconds = 0.0
+        self.upload_wait_seconds = 0.0
+        # downloaded files waiting to be parsed, and uploads submitted but not finished.
+        self.max_download_queue_depth = 0
+        self.max_parse_queue_depth = 0
+        self.max_upload_queue_depth = 0
+        self._lock = Lock()
+    
+    def download_finished(self):
+        # called from download threads
+        with self._lock:
+            self.files_downloaded += 1
+    
+    def print_stats(self):
+        print(
+            f"pipeline: {self.files_parsed} files, {self.chunks_uploaded} chunks. "
+            f"download wait {self.download_wait_seconds:.2f}s (max queue {self.max_download_queue_depth}), "
+            f"parse {self.parse_seconds:.2f}s, parse wait {self.parse_wait_seconds:.2f}s (max queue "
+            f"{self.max_parse_queue_depth}), merge {self.merge_seconds:.2f}s, "
+            f"upload wait {self.upload_wait_seconds:.2f}s (max queue {self.max_upload_queue_depth})."
+        )
+
+
+class PageUploads:
+    """ The chunk uploads of a page of files, and the database changes to make once they are done.
+    A page's uploads can finish while the next page downloads, see process_user_file_chunks_page. """
+    
+    def __init__(
+        self, participant: Participant, files_to_process: List[FileToProcess],
+        error_handler: ErrorHandler, stats: PipelineStats
+    ):
+        self.participant = participant
+        self.files_to_process = files_to_process
+        self.error_handler = error_handler
+        self.stats = stats
+        self.upload_pool = ThreadPool(CONCURRENT_NETWORK_OPS)
+        self.pending_uploads: deque = deque()
+        self.uploaded_chunks: List[ChunkRegistry or ChunkDelta] = []
+        # files that were processed (or registered), and files with data in a failed upload
+        self.ftps_to_remove: Set[int] = set()
+        self.failed_upload_ftps: Set[int] = set()
+        # every file on the page has failed until the page's changes are saved.
+        self.failed_pks = {file_to_process.pk for file_to_process in files_to_process}
+        self.finished = False
+    
+    def submit(self, upload: tuple, ftp_pks: List[int], queue_limit: int):
+        """ Uploads a chunk on the upload pool, blocks while there are queue_limit uploads pending. """
+        while len(self.pending_uploads) >= queue_limit:
+            self.check_upload()
+        self.pending_uploads.append((self.upload_pool.apply_async(batch_upload, (upload,)), ftp_pks))
+        self.stats.chunks_uploaded += 1
+        depth = len(self.pending_uploads)
+        self.stats.max_upload_queue_depth = max(self.stats.max_upload_queue_depth, depth)
+    
+    def check_upload(self):
+        """ Waits for the oldest pending upload to finish.  The (unsaved) chunk of a successful upload
+        is added to uploaded_chunks.  The error of a failed upload is raised on the error handler, and
+        the files of its bin are added to failed_upload_ftps so they are retried. """
+        async_result, ftp_pks = self.pending_uploads.popleft()
+        with self.error_handler:
+            try:
+                err_ret = async_result.get()
+                if err_ret['exception']:
+                    print(err_ret['traceback'])
+                    raise err_ret['exception']
+            except Exception:
+                self.failed_upload_ftps.update(ftp_pks)
+                raise
+            self.uploaded_chunks.append(err_ret['chunk'])
+    
+    def finish(self) -> Set[int]:
+        """ Waits for the remaining uploads, then saves the page's changes.  Returns the primary keys
+        of files on the page that failed to process.  Does nothing if the page is already finished. """
+        if self.finished:
+            return self.failed_pks
+        self.finished = True
+        
+        t_start = perf_counter()
+        try:
+            while self.pending_uploads:
+                self.check_upload()
+        finally:
+            self.terminate()
+        self.stats.upload_wait_seconds += perf_counter() - t_start
+        self.stats.print_stats()
+        
+        # a file with data in a bin that failed to upload is retried (its other bins were saved,
+        # merging them again deduplicates the rows).
+        ftps_to_remove = self.ftps_to_remove - self.failed_upload_ftps
+        
+        # Save the page's chunks, update the data quantity stats with the change in size of those
+        # chunks, and actually delete the processed FTPs from the database, together, so that files
+        # are never retired without their data being registered and counted exactly once. Every file
+        # on the page that was not processed successfully (errored, failed to merge, or failed to
+        # upload) has failed.
+        with transaction.atomic():
+            file_size_changes = save_uploaded_chunks(self.uploaded_chunks)
+            update_data_quantity_stats(self.participant, file_size_changes)
+            FileToProcess.objects.filter(pk__in=ftps_to_remove).delete()
+        
+        self.failed_pks -= ftps_to_remove
+        return self.failed_pks
+    
+    def terminate(self):
+        """ Stops the upload pool, uploads that are still pending are abandoned. """
+        self.finished = True
+        self.upload_pool.close()
+        self.upload_pool.terminate()
+
+
+def files_to_process_after(participant: Participant, after_pk: int, data_type: str = None):
+    """ The participant's files to process with a primary key greater than after_pk, in primary key
+    order, optionally only those of a data type.  Pages of files are selected by primary key (keyset
+    pagination) instead of by offset, so getting a page is an index range scan, and files that
+    failed to process are skipped over by moving past them instead of counting them. """
+    query = participant.files_to_process.exclude(deleted=True).filter(pk__gt=after_pk)
+    if data_type is not None:
+        query = query.filter(data_type=data_type)
+    return query.order_by("pk")
+
+
+def memory_budgeted_page_size(participant: Participant, after_pk: int, data_type: str = None) -> int:
+    """ The number of files on the next page of files to process after after_pk, such that their
+    combined size fits in FILE_PROCESS_PAGE_BUDGET_MB.  Always at least 1. """
+    if not FILE_PROCESS_PAGE_BUDGET_MB:
+        return FILE_PROCESS_PAGE_SIZE
+    
+    budget = FILE_PROCESS_PAGE_BUDGET_MB * 1024 * 1024
+    unknown_file_size = budget // FILE_PROCESS_PAGE_SIZE
+    # same query as the page query in process_user_file_chunks_page, but only the sizes.
+    file_sizes = list(
+        files_to_process_after(participant, after_pk, data_type)
+        .values_list("file_size", flat=True)[:FILE_PROCESS_MAX_PAGE_SIZE]
+    )
+    
+    page_bytes = 0
+    for page_size, file_size in enumerate(file_sizes):
+        page_bytes += unknown_file_size if file_size is None else file_size
+        if page_bytes > budget:
+            return max(page_size, 1)
+    return max(len(file_sizes), 1)
+
+
 def do_process_user_file_chunks(
-        page_size: int, error_handler: ErrorHandler, position: int, participant: Participant
-):
+        page_size: int, error_handler: ErrorHandler, after_pk: int, participant: Participant,
+        stats: PipelineStats = None, data_type: str = None, parse_pool: ProcessPool = None
+) -> Tuple[Optional[int], Set[int]]:
+    """ Processes a page of files and waits for its uploads (see process_user_file_chunks_page).
+    Returns the primary key of the last file on the page (None if there were no files), and the
+    primary keys of files on the page that failed to process. """
+    last_pk, page_uploads = process_user_file_chunks_page(
+        page_size, error_handler, after_pk, participant, stats, data_type, parse_pool
+    )
+    if page_uploads is None:
+        return None, set()
+    return last_pk, page_uploads.finish()
+
+
+def process_user_file_chunks_page(
+        page_size: int, error_handler: ErrorHandler, after_pk: int, participant: Participant,
+        stats: PipelineStats = None, data_type: str = None, parse_pool: ProcessPool = None,
+        previous_page: PageUploads = None,
+) -> Tuple[Optional[int], Optional[PageUploads]]:
     """Run through the files to process, pull their data, put it into s3 bins. Run the file through
     the appropriate logic path based on file type.
 
@@ -51,64 +258,166 @@ def do_process_user_file_chunks(
     beforehand.  The debug log cannot be correctly sorted by time for all elements, because it
     was not actually expected to be used by researchers, but is apparently quite useful.
 
+    Processing is a pipeline: files are parsed in the order their downloads finish, the bins of a
+    data stream are merged as soon as every file of that data stream on the page has been parsed,
+    and the merged chunks are uploaded on a second pool.  This function returns without waiting for
+    the uploads, so that they run while the next page downloads: pass the returned PageUploads as
+    the previous_page of the next page, it is finished (its uploads are waited for and its chunks
+    are saved) before the next page merges anything.  Both network stages are bounded so that a
+    slow stage doesn't pile up file contents in memory.  If a parse_pool (see create_parse_pool) is
+    provided csv files are parsed in its worker processes.
+    
     Any errors are themselves concatenated using the passed in error handler.
 
-    In a single call to this function, page_size files will be processed,at the position specified.
-    This is expected to exclude files that have previously errored in file processing.
-    (some conflicts can be most easily resolved by just delaying a file until the next processing
-    period, and it solves )
+    In a single call to this function, page_size files with a primary key greater than after_pk
+    (of data_type, if provided) will be processed.  Returns the primary key of the last file on the
+    page, which is where the next page starts, and the page's PageUploads (None, None if there were
+    no files).  PageUploads.finish returns the primary keys of files on the page that failed to
+    process.  Those files are left in place so they will be retried the next time this participant
+    is processed (some conflicts can be most easily resolved by just delaying a file until the next
+    processing period).
     """
-    # Declare a defaultdict of a tuple of 2 lists
-    all_binified_data = defaultdict(lambda: ([], []))
-    ftps_to_remove = set()
-    # The ThreadPool enables downloading multiple files simultaneously from the network, and continuing
-    # to download files as other files are being processed, making the code as a whole run faster.
-    # In principle we could make a global pool that is free-memory aware.
-    pool = ThreadPool(CONCURRENT_NETWORK_OPS)
+    stats = stats or PipelineStats()
     survey_id_dict = {}
     
     # A Django query with a slice (e.g. .all()[x:y]) makes a LIMIT query, so it
-    # only gets from the database those FTPs that are in the slice.
-    # print(participant.as_unpacked_native_python())
-    print(len(participant.files_to_process.exclude(deleted=True).all()))
-    print(page_size)
-    print(position)
-    
-    # TODO: investigate, comment.  ordering by path results in files grouped by type and
-    # chronological order, which is perfect for download efficiency... right? would it break anthing?
-    files_to_process = participant.files_to_process \
-        .exclude(deleted=True)  #.order_by("s3_file_path", "created_on")
-    
-    # This pool pulls in data for each FileForProcessing on a background thread and instantiates it.
-    # Instantiating a FileForProcessing object queries S3 for the File's data. (network request))
-    files_for_processing = pool.map(
-        FileForProcessing, files_to_process[position: position + page_size], chunksize=1
+    # only gets from the database those FTPs that are in the slice.  The study is needed to download
+    # a file, it is fetched with the page instead of with a query on every download thread.
+    files_to_process = list(
+        files_to_process_after(participant, after_pk, data_type).select_related("study")[:page_size]
     )
+    if not files_to_process:
+        if previous_page:
+            previous_page.finish()
+        return None, None
+    print(f"processing {len(files_to_process)} files after pk {after_pk}")
     
-    for file_for_processing in files_for_processing:
-        with error_handler:
-            process_one_file(
-                file_for_processing, survey_id_dict, all_binified_data, ftps_to_remove
+    # A file only contains data for its own data stream, so once every file of a data stream has
+    # been parsed the bins for that data stream are complete and can be merged and uploaded.
+    binified_data_by_stream = defaultdict(lambda: defaultdict(lambda: ([], [], [])))
+    files_remaining = Counter(s3_file_path_to_data_type(ftp.s3_file_path) for ftp in files_to_process)
+    
+    # Downloads and uploads each get CONCURRENT_NETWORK_OPS threads, at most twice that many files
+    # may be downloaded-but-unparsed (or uploads submitted-but-unfinished) at once.  Files waiting on
+    # a worker process are limited to twice the number of worker processes, and hold a download slot.
+    queue_limit = CONCURRENT_NETWORK_OPS * 2
+    parse_limit = FILE_PARSING_PROCESSES * 2
+    download_slots = Semaphore(queue_limit + parse_limit)
+    download_pool = ThreadPool(CONCURRENT_NETWORK_OPS)
+    page_uploads = PageUploads(participant, files_to_process, error_handler, stats)
+    ftps_to_remove = page_uploads.ftps_to_remove
+    pending_parses = deque()
+    
+    def throttled_files_to_process():
+        # the download pool pulls from this generator, it blocks until a slot is released by parsing.
+        for file_to_process in files_to_process:
+            download_slots.acquire()
+            yield file_to_process
+    
+    def download(file_to_process: FileToProcess) -> FileForProcessing:
+        # Instantiating a FileForProcessing object queries S3 for the File's data. (network request)
+        # Unchunkable files (audio, images) are only registered, they are not downloaded. Their size
+        # is recorded at upload, or retrieved from S3 (much cheaper than the file).
+        file_for_processing = FileForProcessing(file_to_process, file_to_process.file_size)
+        stats.download_finished()
+        return file_for_processing
+    
+    def finish_file(data_type: str):
+        stats.files_parsed += 1
+        download_slots.release()
+        files_remaining[data_type] -= 1
+        if files_remaining[data_type] == 0 and data_type in binified_data_by_stream:
+            # the previous page's chunks have to be saved before this page's data is merged into them.
+            if previous_page:
+                previous_page.finish()
+            ftps_to_remove.update(
+                merge_and_upload_binified_data(
+                    binified_data_by_stream.pop(data_type), error_handler, survey_id_dict,
+                    participant, page_uploads, queue_limit, stats
+                )[0]
             )
-    pool.close()
-    pool.terminate()
     
-    # there are several failure modes and success modes, information for what to do with different
-    # files percolates back to here.  Delete various database objects accordingly.
-    more_ftps_to_remove, number_bad_files, earliest_time_bin, latest_time_bin = upload_binified_data(
-        all_binified_data, error_handler, survey_id_dict, participant
-    )
-    ftps_to_remove.update(more_ftps_to_remove)
+    def finish_parse(file_to_process: FileToProcess, data_type: str, pending_parse: AsyncResult):
+        t_start = perf_counter()
+        with error_handler:
+            try:
+                newly_binified_data, survey_id_hash = pending_parse.get()
+            finally:
+                stats.parse_wait_seconds += perf_counter() - t_start
+            newly_binified_data = expand_compact_binified_data(newly_binified_data)
+            add_parsed_csv(
+                file_to_process, newly_binified_data, survey_id_hash, survey_id_dict,
+                binified_data_by_stream[data_type], ftps_to_remove
+            )
+        finish_file(data_type)
     
-    # Update the data quantity stats, if it actually processed any files
-    if len(files_to_process) > 0:
-        calculate_data_quantity_stats(participant,
-                                      earliest_time_bin_number=earliest_time_bin,
-                                      latest_time_bin_number=latest_time_bin)
+    try:
+        files_for_processing = download_pool.imap_unordered(
+            download, throttled_files_to_process(), chunksize=1
+        )
+        while True:
+            t_start = perf_counter()
+            try:
+                file_for_processing = next(files_for_processing)
+            except StopIteration:
+                break
+            finally:
+                stats.download_wait_seconds += perf_counter() - t_start
+            stats.max_download_queue_depth = max(
+                stats.max_download_queue_depth,
+                stats.files_downloaded - stats.files_parsed - len(pending_parses),
+            )
+            
+            t_start = perf_counter()
+            data_type = file_for_processing.data_type
+            if parse_pool and file_for_processing.chunkable and not file_for_processing.exception:
+                # hand the file to a worker process, it is finished once its result is collected.
+                file_to_process = file_for_processing.file_to_process
+                parse_job = parse_pool.apply_async(
+                    parse_csv_file_compact, csv_parsing_args(file_for_processing)
+                )
+                del file_for_processing
+                stats.parse_seconds += perf_counter() - t_start
+                pending_parses.append((file_to_process, data_type, parse_job))
+                stats.max_parse_queue_depth = max(stats.max_parse_queue_depth, len(pending_parses))
+                if len(pending_parses) >= parse_limit:
+                    finish_parse(*pending_parses.popleft())
+            else:
+                with error_handler:
+                    process_one_file(
+                        file_for_processing,
+                        survey_id_dict,
+                        binified_data_by_stream[data_type],
+                        ftps_to_remove,
+                    )
+                del file_for_processing
+                stats.parse_seconds += perf_counter() - t_start
+                finish_file(data_type)
+            
+            # collect any files that the worker processes have finished, in order.
+            while pending_parses and pending_parses[0][2].ready():
+                finish_parse(*pending_parses.popleft())
+        
+        while pending_parses:
+            finish_parse(*pending_parses.popleft())
+        
+        # (a page without any chunkable data didn't merge anything.)
+        if previous_page:
+            previous_page.finish()
+    except BaseException:
+        # the page's files are retried, whatever it already uploaded is merged again then.
+        page_uploads.terminate()
+        raise
+    finally:
+        # unblock the download pool's task feeder if we bailed out early, otherwise it never exits.
+        for _ in files_to_process:
+            download_slots.release()
+        download_pool.close()
+        download_pool.terminate()
     
-    # Actually delete the processed FTPs from the database
-    FileToProcess.objects.filter(pk__in=ftps_to_remove).delete()
-    return number_bad_files
+    # there are several failure modes and success modes, information for what to do with different
+    # files percolates back to here, the database is updated accordingly when the page is finished.
+    return files_to_process[-1].pk, page_uploads
 
 
 def process_one_file(
@@ -133,18 +442,25 @@ def process_chunkable_file(
     ftps_to_remove: set
 ):
     newly_binified_data, survey_id_hash = process_csv_data(file_for_processing)
-    
+    add_parsed_csv(
+        file_for_processing.file_to_process, newly_binified_data, survey_id_hash, survey_id_dict,
+        all_binified_data, ftps_to_remove
+    )
+
+
+def add_parsed_csv(
+    file_to_process: FileToProcess, newly_binified_data: Dict, survey_id_hash: tuple,
+    survey_id_dict: dict, all_binified_data: DefaultDict, ftps_to_remove: set
+):
+    """ Adds the output of parse_csv_file to the page's binified data. """
     # survey answers store the survey id in the file name (truly ancient design decision).
-    if file_for_processing.data_type in SURVEY_DATA_FILES:
-        survey_id_dict[survey_id_hash] = resolve_survey_id_from_file_name(
-            file_for_processing.file_to_process.s3_file_path)
+    if survey_id_hash and survey_id_hash[2] in SURVEY_DATA_FILES:
+        survey_id_dict[survey_id_hash] = resolve_survey_id_from_file_name(file_to_process.s3_file_path)
     
     if newly_binified_data:
-        append_binified_csvs(
-            all_binified_data, newly_binified_data, file_for_processing.file_to_process
-        )
+        append_binified_csvs(all_binified_data, newly_binified_data, file_to_process)
     else:  # delete empty files from FilesToProcess
-        ftps_to_remove.add(file_for_processing.file_to_process.id)
+        ftps_to_remove.add(file_to_process.id)
 
 
 def process_unchunkable_file(file_for_processing: FileForProcessing, ftps_to_remove: set):
@@ -153,16 +469,22 @@ def process_unchunkable_file(file_for_processing: FileForProcessing, ftps_to_rem
         file_for_processing.file_to_process.s3_file_path.rsplit("/", 1)[-1][:-4]
     )
     # Since we aren't binning the data by hour, just create a ChunkRegistry that
-    # points to the already existing S3 file.
+    # points to the already existing S3 file.  (The data quantity stats are updated in the same
+    # transaction, the file may be processed again if a later file on the page fails.)
+    participant = file_for_processing.file_to_process.participant
     try:
-        ChunkRegistry.register_unchunked_data(
-            file_for_processing.data_type,
-            timestamp,
-            file_for_processing.file_to_process.s3_file_path,
-            file_for_processing.file_to_process.study.pk,
-            file_for_processing.file_to_process.participant.pk,
-            file_for_processing.file_contents,
-        )
+        with transaction.atomic():
+            chunk = ChunkRegistry.register_unchunked_data(
+                file_for_processing.data_type,
+                timestamp,
+                file_for_processing.file_to_process.s3_file_path,
+                file_for_processing.file_to_process.study.pk,
+                participant.pk,
+                file_for_processing.file_size,
+            )
+            update_data_quantity_stats(
+                participant, {(chunk.time_bin, chunk.data_type): chunk.file_size or 0}
+            )
         ftps_to_remove.add(file_for_processing.file_to_process.id)
     except ValidationError as ve:
         if len(ve.messages) != 1:
@@ -173,42 +495,45 @@ def process_unchunkable_file(file_for_processing: FileForProcessing, ftps_to_rem
         # we detect this specific case and update the registry with the new file size
         # (hopefully it doesn't actually change)
         if 'Chunk registry with this Chunk path already exists.' in ve.messages:
-            ChunkRegistry.update_registered_unchunked_data(
-                file_for_processing.data_type,
-                file_for_processing.file_to_process.s3_file_path,
-                file_for_processing.file_contents,
-            )
+            with transaction.atomic():
+                chunk, previous_file_size = ChunkRegistry.update_registered_unchunked_data(
+                    file_for_processing.data_type,
+                    file_for_processing.file_to_process.s3_file_path,
+                    file_for_processing.file_size,
+                )
+                update_data_quantity_stats(
+                    participant,
+                    {(chunk.time_bin, chunk.data_type): (chunk.file_size or 0) - (previous_file_size or 0)}
+                )
             ftps_to_remove.add(file_for_processing.file_to_process.id)
         else:
             # any other errors, add
             raise
 
 
-def upload_binified_data(binified_data, error_handler, survey_id_dict, participant):
+def merge_and_upload_binified_data(
+    binified_data: DefaultDict, error_handler: ErrorHandler, survey_id_dict: dict,
+    participant: Participant, page_uploads: PageUploads, queue_limit: int, stats: PipelineStats
+) -> Tuple[Set[int], int, int, int]:
     """ Takes in binified csv data and handles uploading/downloading+updating
-        older data to/from S3 for each chunk.
+        older data to/from S3 for each chunk.  Uploads are submitted to the page's upload pool,
+        blocking while there are queue_limit uploads pending.
         Returns a set of concatenations that have succeeded and can be removed.
         Returns the number of failed FTPS so that we don't retry them.
         Returns the earliest and latest time bins handled
         Raises any errors on the passed in ErrorHandler."""
-    # failed_ftps = set([])
-    # ftps_to_retire = set([])
-    # upload_these = []
-    
-    # # Track the earliest and latest time bins, to return them at the end of the function
-    # earliest_time_bin = None
-    # latest_time_bin = None
+    t_start = perf_counter()
     uploads = CsvMerger(binified_data, error_handler, survey_id_dict, participant)
+    uploads.print_upload_stats()
+    stats.merge_seconds += perf_counter() - t_start
     
-    pool = ThreadPool(CONCURRENT_NETWORK_OPS)
-    errors = pool.map(batch_upload, uploads.upload_these, chunksize=1)
-    for err_ret in errors:
-        if err_ret['exception']:
-            print(err_ret['traceback'])
-            raise err_ret['exception']
+    t_start = perf_counter()
+    for upload, ftp_pks in zip(uploads.upload_these, uploads.upload_ftps):
+        page_uploads.submit(upload, ftp_pks, queue_limit)
+    uploads.upload_these = []  # the pool holds the references now
+    uploads.upload_ftps = []
+    stats.upload_wait_seconds += perf_counter() - t_start
     
-    pool.close()
-    pool.terminate()
     # The things in ftps to retire that are not in failed ftps.
     # len(failed_ftps) will become the number of files to skip in the next iteration.
     return uploads.get_retirees()
@@ -216,32 +541,40 @@ def upload_binified_data(binified_data, error_handler, survey_id_dict, participa
 
 """############################## Standard CSVs #############################"""
 
-def binify_csv_rows(rows_list: list, study_id: str, user_id: str, data_type: str, header: bytes) -> DefaultDict[tuple, list]:
-    """ Assumes a clean csv with element 0 in the rows column as a unix(ish) timestamp.
+def binify_csv_rows(
+    rows_list: list, study_id: str, user_id: str, data_type: str, header: bytes
+) -> DefaultDict[tuple, Tuple[list, List[int]]]:
+    """ Assumes a clean csv with element 0 in the rows column as a unix millisecond timestamp.
         Sorts data points into the appropriate bin based on the rounded down hour
-        value of the entry's unix(ish) timestamp. (based CHUNK_TIMESLICE_QUANTUM)
-        Returns a dict of form {(study_id, user_id, data_type, time_bin, header):rows_lists}. """
-    ret = defaultdict(list)
+        value of the entry's unix timestamp. (based CHUNK_TIMESLICE_QUANTUM)
+        The timestamp is parsed exactly once here and is carried alongside the rows for the rest of
+        processing (sorting and human-readable time conversion).
+        Returns a dict of form {(study_id, user_id, data_type, time_bin, header):(rows, timestamps)}. """
+    ret = defaultdict(lambda: ([], []))
     for row in rows_list:
         # discovered August 7 2017, looks like there was an empty line at the end
         # of a file? row was a [''].
         if row and row[0]:
             # this is the first thing that will hit corrupted timecode values errors (origin of which is unknown).
             try:
-                timecode = binify_from_timecode(row[0])
-            except BadTimecodeError:
+                timestamp = int(row[0])
+            except ValueError:
                 continue
-            ret[(study_id, user_id, data_type, timecode, header)].append(row)
+            rows, timestamps = ret[(study_id, user_id, data_type, binify_from_timestamp(timestamp), header)]
+            rows.append(row)
+            timestamps.append(timestamp)
     return ret
 
-def append_binified_csvs(old_binified_rows: DefaultDict[tuple, list],
-                         new_binified_rows: DefaultDict[tuple, list],
+
+def append_binified_csvs(old_binified_rows: DefaultDict[tuple, tuple],
+                         new_binified_rows: DefaultDict[tuple, tuple],
                          file_for_processing:  FileToProcess):
     """ Appends binified rows to an existing binified row data structure.
         Should be in-place. """
-    for data_bin, rows in new_binified_rows.items():
+    for data_bin, (rows, timestamps) in new_binified_rows.items():
         old_binified_rows[data_bin][0].extend(rows)  # Add data rows
-        old_binified_rows[data_bin][1].append(file_for_processing.pk)  # Add ftp
+        old_binified_rows[data_bin][1].extend(timestamps)  # Add their timestamps
+        old_binified_rows[data_bin][2].append(file_for_processing.pk)  # Add ftp
 
 
 # TODO: stick on FileForProcessing
@@ -249,40 +582,127 @@ def process_csv_data(file_for_processing: FileForProcessing):
     """ Constructs a binified dict of a given list of a csv rows,
         catches csv files with known problems and runs the correct logic.
         Returns None If the csv has no data in it. """
+    parsing_args = csv_parsing_args(file_for_processing)
+    # Memory saving measure: the contents are only referenced by the parsing code from here on
+    file_for_processing.clear_file_content()
+    return parse_csv_file(*parsing_args)
+
+
+def csv_parsing_args(file_for_processing: FileForProcessing) -> tuple:
+    """ The parameters of parse_csv_file for a file, these are all plain values (no database
+    objects) so they can be sent to a worker process. """
+    file_to_process = file_for_processing.file_to_process
+    return (
+        file_for_processing.file_contents,
+        file_for_processing.data_type,
+        file_to_process.os_type,
+        file_to_process.s3_file_path,
+        file_to_process.study.object_id,
+        file_to_process.participant.patient_id,
+    )
+
+
+def parse_csv_file(
+    file_contents: bytes, data_type: str, os_type: str, s3_file_path: str, study_object_id: str,
+    patient_id: str
+) -> Tuple[Optional[Dict[tuple, Tuple[list, List[int]]]], Optional[tuple]]:
+    """ The cpu-bound part of processing a csv: data fixes, parsing, binification, and adding the
+    human readable timestamp column.  Rows in each bin are sorted by timestamp.
+    This can run in a worker process, it does not touch the database and returns a plain dict.
+    Returns (None, None) if the csv has no data in it. """
+    
+    survey_id_hash = None
+    binified_data = None
+    if data_type in VECTORIZED_DATA_STREAMS:
+        binified_data, survey_id_hash = parse_csv_file_vectorized(
+            file_contents, data_type, study_object_id, patient_id
+        )
+    
+    if binified_data is None:
+        binified_data, survey_id_hash = parse_csv_file_python(
+            file_contents, data_type, os_type, s3_file_path, study_object_id, patient_id
+        )
+    del file_contents
+    
+    if not binified_data:
+        return None, None
     
-    if file_for_processing.file_to_process.os_type == ANDROID_API:
+    original_header = survey_id_hash[3]
+    ret = {}
+    for data_bin, (rows, timestamps) in binified_data.items():
+        rows, timestamps = sort_by_timestamp(rows, timestamps)
+        convert_unix_to_human_readable_timestamps(original_header, rows, timestamps)
+        ret[data_bin] = rows, timestamps
+    return ret, survey_id_hash
+
+
+def parse_csv_file_compact(
+    file_contents: bytes, data_type: str, os_type: str, s3_file_path: str, study_object_id: str,
+    patient_id: str
+) -> Tuple[Optional[Dict[tuple, Tuple[bytes, List[int]]]], Optional[tuple]]:
+    """ parse_csv_file for worker processes.  The result is pickled to send it back, so the rows of
+    each bin are returned already joined into one bytes object, which pickles several times faster
+    (and smaller) than a list of rows of column values.  See expand_compact_binified_data. """
+    binified_data, survey_id_hash = parse_csv_file(
+        file_contents, data_type, os_type, s3_file_path, study_object_id, patient_id
+    )
+    if binified_data is None:
+        return None, None
+    return {
+        data_bin: (b"\n".join([b",".join(row) for row in rows]), timestamps)
+        for data_bin, (rows, timestamps) in binified_data.items()
+    }, survey_id_hash
+
+
+def expand_compact_binified_data(
+    compact_binified_data: Optional[Dict[tuple, Tuple[bytes, List[int]]]]
+) -> Optional[Dict[tuple, Tuple[list, List[int]]]]:
+    """ The output of parse_csv_file_compact in the form of parse_csv_file.  Each row is a single
+    "column" of the joined line, rows are only ever joined with commas from here on so that is
+    identical.  (Rows never contain newlines, they were split on them.) """
+    if compact_binified_data is None:
+        return None
+    return {
+        data_bin: ([[line] for line in lines.split(b"\n")], timestamps)
+        for data_bin, (lines, timestamps) in compact_binified_data.items()
+    }
+
+
+def parse_csv_file_python(
+    file_contents: bytes, data_type: str, os_type: str, s3_file_path: str, study_object_id: str,
+    patient_id: str
+):
+    if os_type == ANDROID_API:
         # Do fixes for Android
-        if file_for_processing.data_type == ANDROID_LOG_FILE:
-            file_for_processing.file_contents = fix_app_log_file(
-                file_for_processing.file_contents, file_for_processing.file_to_process.s3_file_path
-            )
+        if data_type == ANDROID_LOG_FILE:
+            file_contents = fix_app_log_file(file_contents, s3_file_path)
         
-        header, csv_rows_list = csv_to_list(file_for_processing.file_contents)
-        if file_for_processing.data_type != ACCELEROMETER:
+        header, csv_rows_list = csv_to_list(file_contents)
+        if data_type != ACCELEROMETER:
             # If the data is not accelerometer data, convert the generator to a list.
             # For accelerometer data, the data is massive and so we don't want it all
             # in memory at once.
             csv_rows_list = list(csv_rows_list)
         
-        if file_for_processing.data_type == CALL_LOG:
+        if data_type == CALL_LOG:
             header = fix_call_log_csv(header, csv_rows_list)
-        if file_for_processing.data_type == WIFI:
-            header = fix_wifi_csv(header, csv_rows_list, file_for_processing.file_to_process.s3_file_path)
+        if data_type == WIFI:
+            header = fix_wifi_csv(header, csv_rows_list, s3_file_path)
     else:
         # Do fixes for iOS
-        header, csv_rows_list = csv_to_list(file_for_processing.file_contents)
+        header, csv_rows_list = csv_to_list(file_contents)
         
-        if file_for_processing.data_type != ACCELEROMETER:
+        if data_type != ACCELEROMETER:
             csv_rows_list = list(csv_rows_list)
     
     # Memory saving measure: this data is now stored in its entirety in csv_rows_list
-    file_for_processing.clear_file_content()
+    del file_contents
     
     # Do these fixes for data whether from Android or iOS
-    if file_for_processing.data_type == IDENTIFIERS:
-        header = fix_identifier_csv(header, csv_rows_list, file_for_processing.file_to_process.s3_file_path)
-    if file_for_processing.data_type == SURVEY_TIMINGS:
-        header = fix_survey_timings(header, csv_rows_list, file_for_processing.file_to_process.s3_file_path)
+    if data_type == IDENTIFIERS:
+        header = fix_identifier_csv(header, csv_rows_list, s3_file_path)
+    if data_type == SURVEY_TIMINGS:
+        header = fix_survey_timings(header, csv_rows_list, s3_file_path)
     
     header = b",".join([column_name.strip() for column_name in header.split(b",")])
     if csv_rows_list:
@@ -290,18 +710,32 @@ def process_csv_data(file_for_processing: FileForProcessing):
             # return item 1: the data as a defaultdict
             binify_csv_rows(
                 csv_rows_list,
-                file_for_processing.file_to_process.study.object_id,
-                file_for_processing.file_to_process.participant.patient_id,
-                file_for_processing.data_type,
+                study_object_id,
+                patient_id,
+                data_type,
                 header
             ),
             # return item 2: the tuple that we use as a key for the defaultdict
             (
-                file_for_processing.file_to_process.study.object_id,
-                file_for_processing.file_to_process.participant.patient_id,
-                file_for_processing.data_type,
+                study_object_id,
+                patient_id,
+                data_type,
                 header
             )
         )
     else:
         return None, None
+
+
+def parse_csv_file_vectorized(file_contents: bytes, data_type: str, study_object_id: str, patient_id: str):
+    """ The parse_csv_file logic for data streams that have no data fixes, using the vectorized
+        binification code. Returns (None, None) if the file must go through the pure-python code
+        path. """
+    header_end = file_contents.find(b"\n")
+    header = file_contents if header_end == -1 else file_contents[:header_end]
+    header = b",".join([column_name.strip() for column_name in header.split(b",")])
+    
+    binified_data = binify_csv_contents(file_contents, study_object_id, patient_id, data_type, header)
+    if binified_data is None:
+        return None, None
+    return binified_data, (study_object_id, patient_id, data_type, header)
@@ -1,10 +1,12 @@
-from typing import List
+from bisect import bisect_left
+from itertools import islice
+from typing import List, Tuple
 
 import zstd
 
 from constants.data_processing_constants import CHUNK_TIMESLICE_QUANTUM
 from constants.data_stream_constants import IDENTIFIERS, IOS_LOG_FILE, UPLOAD_FILE_TYPE_MAPPING
-from libs.file_processing.utility_functions_csvs import clean_java_timecode, unix_time_to_string
+from libs.file_processing.utility_functions_csvs import unix_time_to_string
 
 
 def normalize_s3_file_path(s3_file_path: str) -> str:
@@ -42,44 +44,108 @@ def resolve_survey_id_from_file_name(name: str) -> str:
     return name.rsplit("/", 2)[1]
 
 
-def ensure_sorted_by_timestamp(l: list):
-    """ In-place sorting is fast, but we (may) need to purge rows that are broken.
-        Purging broken rows is A) exceedingly uncommon, B) potentially VERY slow."""
-    try:
-        # first value should be a timestamp integer-like string, we get a ValueError if it isn't.
-        l.sort(key=lambda x: int(x[0]))
-    except ValueError:
-        # get bad rows, pop them off, sort again
-        bad_rows = []
-        for i, row in enumerate(l, 0):  # enumerate in this context needs to start at 0
-            try:
-                int(row[0])
-            except ValueError:
-                bad_rows.append(i)
-        for bad_row in reversed(bad_rows):
-            l.pop(bad_row)  # SLOW.
-        l.sort(key=lambda x: int(x[0]))
-
-
-def convert_unix_to_human_readable_timestamps(header: bytes, rows: list) -> List[bytes]:
+def split_chunk_lines(file_contents: bytes) -> Tuple[bytes, List[bytes], List[int]]:
+    """ Splits the contents of a chunk into its header, its lines, and a parallel list of the
+    lines' integer timestamps.  Lines are not split into columns, they are only ever rejoined.
+    Lines that do not have a valid timestamp are (rare, and) dropped. """
+    all_lines = file_contents.split(b"\n")
+    good_lines = []
+    timestamps = []
+    for line in islice(all_lines, 1, None):
+        comma = line.find(b",")
+        try:
+            timestamps.append(int(line if comma == -1 else line[:comma]))
+        except ValueError:
+            continue
+        good_lines.append(line)
+    return all_lines[0], good_lines, timestamps
+
+
+def sort_by_timestamp(rows: list, timestamps: List[int]) -> Tuple[list, List[int]]:
+    """ Sorts rows using the parallel list of already-parsed timestamps, returns new lists.
+    The sort is stable, rows with identical timestamps retain their order. """
+    order = sorted(range(len(timestamps)), key=timestamps.__getitem__)
+    return [rows[i] for i in order], [timestamps[i] for i in order]
+
+
+# lookup tables for the minutes-and-seconds ("MM:SS") and milliseconds (".mmm") components of a
+# human readable timestamp, indexed by the second of the hour and the millisecond of the second.
+MINUTE_SECOND_STRINGS = tuple(b"%02d:%02d" % divmod(second, 60) for second in range(3600))
+MILLISECOND_STRINGS = tuple(b".%03d" % millisecond for millisecond in range(1000))
+
+
+def merge_rows_into_chunk_lines(
+    lines: List[bytes], timestamps: List[int], new_rows: List[list], new_timestamps: List[int]
+) -> List[bytes]:
+    """ Merges new rows into the lines of an existing chunk, returns the merged, deduplicated lines.
+    
+    The lines of an existing chunk are already sorted and deduplicated, so they are treated as a
+    sorted run: only the new rows are sorted, and only the old lines at or after the earliest new
+    timestamp are merged with them.  (Usually new data is more recent than old data, and the merge
+    is just a concatenation.)  Duplicate rows always have identical timestamps, so deduplication
+    only needs to happen inside windows of identical timestamps in the merged region.
+    Rows with identical timestamps are ordered old-then-new, the same as a stable sort. """
+    new_rows, new_timestamps = sort_by_timestamp(new_rows, new_timestamps)
+    new_lines = [b",".join(row) for row in new_rows]
+    del new_rows
+    
+    if any(a > b for a, b in zip(timestamps, islice(timestamps, 1, None))):
+        # case: the chunk was not sorted (should not occur), sort it and merge/deduplicate everything.
+        lines, timestamps = sort_by_timestamp(lines, timestamps)
+        merge_start = 0
+    else:
+        merge_start = bisect_left(timestamps, new_timestamps[0]) if new_timestamps else len(lines)
+    
+    merged_lines = lines[:merge_start]
+    tail_lines, tail_timestamps = sort_by_timestamp(
+        lines[merge_start:] + new_lines, timestamps[merge_start:] + new_timestamps
+    )
+    
+    window_timestamp = None
+    seen = set()
+    for line, timestamp in zip(tail_lines, tail_timestamps):
+        if timestamp != window_timestamp:
+            window_timestamp = timestamp
+            seen.clear()
+        if line not in seen:
+            seen.add(line)
+            merged_lines.append(line)
+    return merged_lines
+
+
+def convert_unix_to_human_readable_timestamps(
+    header: bytes, rows: list, timestamps: List[int]
+) -> bytes:
     """ Adds a new column to the end which is the unix time represented in
-    a human readable time format.  Returns an appropriately modified header. """
-    for row in rows:
-        unix_millisecond = int(row[0])
-        time_string = unix_time_to_string(unix_millisecond // 1000)
-        # this line 0-pads millisecond values that have leading 0s.
-        time_string += b".%03d" % (unix_millisecond % 1000)
-        row.insert(1, time_string)
+    a human readable time format.  Returns an appropriately modified header.
+    
+    All rows in a bin share the same hour, so the "YYYY-MM-DDTHH:" component is only formatted when
+    the hour changes, the rest of the string comes from lookup tables. """
+    current_hour = None
+    hour_prefix = None
+    for row, unix_millisecond in zip(rows, timestamps):
+        unix_second, millisecond = divmod(unix_millisecond, 1000)
+        hour, second_of_hour = divmod(unix_second, 3600)
+        if hour != current_hour:
+            current_hour = hour
+            # strip the "00:00" minutes and seconds off the string of the start of the hour.
+            hour_prefix = unix_time_to_string(hour * 3600)[:-5]
+        row.insert(
+            1, hour_prefix + MINUTE_SECOND_STRINGS[second_of_hour] + MILLISECOND_STRINGS[millisecond]
+        )
+    return human_readable_timestamps_header(header)
+
+
+def human_readable_timestamps_header(header: bytes) -> bytes:
+    """ The header of a csv after convert_unix_to_human_readable_timestamps has added its column. """
     header = header.split(b",")
     header.insert(1, b"UTC time")
     return b",".join(header)
 
 
-def binify_from_timecode(unix_ish_time_code_string: bytes) -> int:
-    """ Takes a unix-ish time code (accepts unix millisecond), and returns an
-        integer value of the bin it should go in. """
-    actually_a_timecode = clean_java_timecode(unix_ish_time_code_string)  # clean java time codes...
-    return actually_a_timecode // CHUNK_TIMESLICE_QUANTUM  # separate into nice, clean hourly chunks!
+def binify_from_timestamp(unix_millisecond: int) -> int:
+    """ Takes a unix millisecond timestamp, and returns an integer value of the bin it should go in. """
+    return unix_millisecond // 1000 // CHUNK_TIMESLICE_QUANTUM  # separate into nice, clean hourly chunks!
 
 
 def compress(data: bytes) -> bytes:
@@ -0,0 +1,104 @@
+from collections import defaultdict
+from typing import DefaultDict, List, Optional, Tuple
+
+from constants.data_processing_constants import CHUNK_TIMESLICE_QUANTUM
+
+
+# NumPy is a dependency of Forest, so it is present on data processing servers, but it is not a
+# requirement of the frontend servers.  Without it the pure-python binify_csv_rows is used.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+NEWLINE = ord(b"\n")
+COMMA = ord(b",")
+ZERO = ord(b"0")
+# int64 can hold any 18 digit number, millisecond timestamps are 13 digits.
+MAX_TIMESTAMP_DIGITS = 18
+
+
+def vectorized_binification_available() -> bool:
+    return numpy is not None
+
+
+def binify_csv_contents(
+    file_contents: bytes, study_id: str, user_id: str, data_type: str, header: bytes
+) -> Optional[DefaultDict[tuple, Tuple[list, List[int]]]]:
+    """ A NumPy implementation of binify_csv_rows that operates on the whole (decrypted) file.
+        The output is identical to running csv_to_list and binify_csv_rows on the file contents:
+        same bins, same bin order (order of first appearance), same row order within a bin, and the
+        same rows dropped for having an invalid timestamp.
+
+        Instead of parsing and appending rows one at a time, the line boundaries and the timestamp
+        column are located with vectorized byte comparisons, the timestamps are parsed as an int64
+        array, and the hour bins are computed with a single floor-divide.  Lines are then grouped by
+        bin using a stable argsort.  Only the final row split is done per-row in python.
+
+        Returns None if the file contains a timestamp that cannot be represented in an int64, the
+        caller should use the pure-python code path for that file. """
+    ret = defaultdict(lambda: ([], []))
+    # case: the file is just a header, or empty.
+    if file_contents.find(b"\n") == -1:
+        return ret
+
+    data = numpy.frombuffer(file_contents, dtype=numpy.uint8)
+    newlines = numpy.flatnonzero(data == NEWLINE)
+
+    # every line after the header starts after a newline and ends at the next newline (or the end
+    # of the file). The first column ends at the first comma on the line, or at the end of the line.
+    line_starts = newlines + 1
+    line_ends = numpy.append(newlines[1:], len(file_contents))
+    commas = numpy.append(numpy.flatnonzero(data == COMMA), len(file_contents))
+    field_ends = numpy.minimum(commas[numpy.searchsorted(commas, line_starts)], line_ends)
+    field_lengths = field_ends - line_starts
+
+    # Parse the first column one character position at a time, across every line at once.
+    valid = (field_lengths > 0) & (field_lengths <= MAX_TIMESTAMP_DIGITS)
+    timestamps = numpy.zeros(len(line_starts), dtype=numpy.int64)
+    last_byte = len(file_contents) - 1
+    for position in range(min(int(field_lengths.max()), MAX_TIMESTAMP_DIGITS)):
+        in_field = position < field_lengths
+        digits = data[numpy.minimum(line_starts + position, last_byte)].astype(numpy.int64) - ZERO
+        valid &= ~in_field | ((digits >= 0) & (digits <= 9))
+        timestamps = numpy.where(in_field, timestamps * 10 + digits, timestamps)
+
+    # Anything that isn't a plain string of digits goes through the same int() call that the python
+    # code path uses, which also accepts whitespace, signs, and underscores.  Empty or unparseable
+    # values are dropped.  This is rare.
+    keep = valid.copy()
+    for line_index in numpy.flatnonzero(~valid).tolist():
+        field = file_contents[line_starts[line_index]:field_ends[line_index]]
+        if not field:
+            continue
+        try:
+            timestamp = int(field)
+        except ValueError:
+            continue
+        if not -2**63 <= timestamp < 2**63:
+            return None
+        timestamps[line_index] = timestamp
+        keep[line_index] = True
+
+    kept_lines = numpy.flatnonzero(keep)
+    if len(kept_lines) == 0:
+        return ret
+    time_bins = timestamps[kept_lines] // 1000 // CHUNK_TIMESLICE_QUANTUM
+
+    # A stable sort groups lines by bin while retaining file order inside each bin.  The first
+    # element of each group is then that bin's first appearance in the file, which is the order
+    # that binify_csv_rows inserts bins into its dictionary.
+    order = numpy.argsort(time_bins, kind="stable")
+    unique_bins, group_starts = numpy.unique(time_bins[order], return_index=True)
+    group_ends = numpy.append(group_starts[1:], len(order))
+
+    for group in numpy.argsort(order[group_starts], kind="stable").tolist():
+        line_indexes = kept_lines[order[group_starts[group]:group_ends[group]]]
+        rows = [
+            file_contents[start:end].split(b",") for start, end in
+            zip(line_starts[line_indexes].tolist(), line_ends[line_indexes].tolist())
+        ]
+        time_bin = int(unique_bins[group])
+        ret[(study_id, user_id, data_type, time_bin, header)] = (rows, timestamps[line_indexes].tolist())
+    return ret
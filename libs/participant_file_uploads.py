@@ -1,20 +1,23 @@
+from typing import Tuple
+
 from django.core.exceptions import ValidationError
 from django.db import IntegrityError
 from django.http.response import HttpResponse
 from django.utils import timezone
 
-from config.settings import UPLOAD_LOGGING_ENABLED
-from constants.common_constants import PROBLEM_UPLOADS
+from config.settings import RAW_UPLOAD_PATH_INDEX, UPLOAD_LOGGING_ENABLED
+from constants.common_constants import PENDING_UPLOADS, PROBLEM_UPLOADS
 from constants.message_strings import (S3_FILE_PATH_UNIQUE_CONSTRAINT_ERROR_1,
     S3_FILE_PATH_UNIQUE_CONSTRAINT_ERROR_2)
-from database.data_access_models import FileToProcess
+from database.data_access_models import FileToProcess, PendingUpload, RawUploadPath
 from database.profiling_models import UploadTracking
 from database.system_models import GenericEvent
 from database.user_models import Participant
-from libs.encryption import DeviceDataDecryptor
+from libs.encryption import (DecryptionKeyInvalidError, DeviceDataDecryptor,
+    IosDecryptionKeyDuplicateError, IosDecryptionKeyNotFoundError, RemoteDeleteFileScenario)
 from libs.s3 import s3_retrieve, s3_upload, smart_s3_list_study_files
 from libs.security import generate_easy_alphanumeric_string
-from middleware.abort_middleware import abort
+from middleware.abort_middleware import abort, AbortError
 
 
 def log(*args, **kwargs):
@@ -25,29 +28,49 @@ def log(*args, **kwargs):
 def upload_and_create_file_to_process_and_log(
     s3_file_location: str, participant: Participant, decryptor: DeviceDataDecryptor
 ) -> HttpResponse:
-    
+    s3_file_location, file_size = upload_decrypted_file(s3_file_location, participant, decryptor)
+    create_file_to_process(s3_file_location, participant, file_size)
+    track_upload(s3_file_location, participant, decryptor)
+    return HttpResponse(status=200)
+
+
+def upload_decrypted_file(
+    s3_file_location: str, participant: Participant, decryptor: DeviceDataDecryptor
+) -> Tuple[str, int]:
+    """ Uploads a decrypted file, returns the path it was uploaded to and the size of the file there
+    (duplicates are renamed, split ios files are merged). """
+    original_file_location = s3_file_location
+    file_size = len(decryptor.decrypted_file)
     # test if the file exists on s3, handle ios duplicate file merge.
-    if not smart_s3_list_study_files(s3_file_location, participant):
+    if RAW_UPLOAD_PATH_INDEX:
+        file_exists = RawUploadPath.path_exists(s3_file_location, participant.study.object_id)
+    else:
+        file_exists = bool(smart_s3_list_study_files(s3_file_location, participant))
+    
+    if not file_exists:
         s3_upload(s3_file_location, decryptor.decrypted_file, participant)
     
     elif decryptor.used_ios_decryption_key_cache:
         # if the upload required the ios key cache that means we have a split file and need to merge them.
-        s3_upload(
-            s3_file_location,
-            b"\n".join([s3_retrieve(s3_file_location, participant), decryptor.decrypted_file]),
-            participant,
-        )
+        merged_file = b"\n".join([s3_retrieve(s3_file_location, participant), decryptor.decrypted_file])
+        file_size = len(merged_file)
+        s3_upload(s3_file_location, merged_file, participant)
     else:
-        old_file_location = s3_file_location
         s3_file_location = s3_duplicate_name(s3_file_location)
-        log(f"renamed duplicate '{old_file_location}' to '{s3_file_location}'")
+        log(f"renamed duplicate '{original_file_location}' to '{s3_file_location}'")
         s3_upload(s3_file_location, decryptor.decrypted_file, participant)
     
+    # (renamed duplicates are never looked up, the path the device uploaded is the one to record.)
+    RawUploadPath.add_path(original_file_location, participant)
+    return s3_file_location, file_size
+
+
+def create_file_to_process(s3_file_location: str, participant: Participant, file_size: int):
     # race condition: multiple _concurrent_ uploads with same file path. Behavior without try-except
     # is correct, but we don't care about reporting it. Just send the device a 500 error so it skips
     # the file, the followup attempt receives 200 code and deletes the file.
     try:
-        FileToProcess.append_file_for_processing(s3_file_location, participant)
+        FileToProcess.append_file_for_processing(s3_file_location, participant, file_size=file_size)
     except (IntegrityError, ValidationError) as e:
         # there are two error cases that can occur here (race condition with 2 concurrent uploads)
         if (
@@ -56,8 +79,10 @@ def upload_and_create_file_to_process_and_log(
         ):
             # don't abort 500, we want to limit 500 errors on the ELB in production (uhg)
             log("backoff for duplicate race condition.", str(e))
-            return abort(400)
-    
+            abort(400)
+
+
+def track_upload(s3_file_location: str, participant: Participant, decryptor: DeviceDataDecryptor):
     # record that an upload occurred
     UploadTracking.objects.create(
         file_path=s3_file_location,
@@ -65,7 +90,6 @@ def upload_and_create_file_to_process_and_log(
         timestamp=timezone.now(),
         participant=participant,
     )
-    return HttpResponse(status=200)
 
 
 def upload_problem_file(
@@ -82,6 +106,87 @@ def upload_problem_file(
     )
 
 
+def store_pending_upload(
+    s3_file_location: str, participant: Participant, file_contents: bytes
+) -> HttpResponse:
+    """ Stores an upload, still encrypted, for an upload ingestion task to decrypt (see
+    ASYNC_UPLOAD_INGESTION).  The device deletes its copy when it gets the 200. """
+    # Like an existing FileToProcess, a file of the same name that is waiting to be ingested gets a
+    # 400 so the device tries again later.  (split ios files have to be ingested in order.)
+    if PendingUpload.objects.filter(file_path=s3_file_location).exists():
+        log("400, pending upload exists")
+        return abort(400)
+    
+    s3_path = f"{PENDING_UPLOADS}/{participant.study.object_id}/" + s3_file_location \
+        + generate_easy_alphanumeric_string(10)
+    s3_upload(s3_path, file_contents, participant, raw_path=True)
+    try:
+        PendingUpload.objects.create(
+            participant=participant,
+            file_path=s3_file_location,
+            s3_path=s3_path,
+            file_size=len(file_contents),
+        )
+    except (IntegrityError, ValidationError) as e:
+        # same race condition as with FileToProcess, concurrent uploads of the same file.
+        log("backoff for duplicate pending upload race condition.", str(e))
+        return abort(400)
+    return HttpResponse(status=200)
+
+
+def ingest_pending_upload(pending_upload: PendingUpload) -> bool:
+    """ Does the rest of what the upload endpoint does for a stored upload: decryption, ios key
+    handling, and creating the FileToProcess.  Returns False if the upload has to wait (where the
+    endpoint would have sent a 400), it is left in place and ingested by a later task. """
+    if pending_upload.decrypted_file_path:
+        return create_pending_file_to_process(pending_upload)
+    
+    participant = pending_upload.participant
+    s3_file_location = pending_upload.file_path
+    if FileToProcess.test_file_path_exists(s3_file_location, participant.study.object_id):
+        log("FileToProcess.test_file_path_exists, ingesting later")
+        return False
+    
+    file_contents = s3_retrieve(pending_upload.s3_path, participant, raw_path=True)
+    try:
+        decryptor = DeviceDataDecryptor(s3_file_location, file_contents, participant)
+    except RemoteDeleteFileScenario:
+        log("RemoteDeleteFileScenario")  # errors were unrecoverable, drop the file.
+        pending_upload.delete()
+        return True
+    except (DecryptionKeyInvalidError, IosDecryptionKeyNotFoundError, IosDecryptionKeyDuplicateError) as e:
+        upload_problem_file(file_contents, participant, s3_file_location, e)
+        pending_upload.delete()
+        return True
+    
+    # (empty files are dropped)
+    if not decryptor.decrypted_file:
+        pending_upload.delete()
+        return True
+    
+    decrypted_file_path, file_size = upload_decrypted_file(s3_file_location, participant, decryptor)
+    track_upload(decrypted_file_path, participant, decryptor)
+    # a retry only has to create the FileToProcess, uploading again would make a renamed duplicate.
+    pending_upload.decrypted_file_path = decrypted_file_path
+    pending_upload.decrypted_file_size = file_size
+    pending_upload.save(update_fields=["decrypted_file_path", "decrypted_file_size", "last_updated"])
+    return create_pending_file_to_process(pending_upload)
+
+
+def create_pending_file_to_process(pending_upload: PendingUpload) -> bool:
+    """ Creates the FileToProcess of an ingested upload, returns False if it has to wait. """
+    try:
+        create_file_to_process(
+            pending_upload.decrypted_file_path,
+            pending_upload.participant,
+            pending_upload.decrypted_file_size,
+        )
+    except AbortError:
+        return False
+    pending_upload.delete()
+    return True
+
+
 def s3_duplicate_name(s3_file_path: str):
     """ when duplicates occur we add this string onto the end and try to proceed as normal. """
     return s3_file_path + "-duplicate-" + generate_easy_alphanumeric_string(10)
@@ -1,3 +1,6 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
 from typing import List
 
 import boto3
@@ -5,7 +8,7 @@ from botocore.client import BaseClient, Paginator
 from Cryptodome.PublicKey import RSA
 
 from config.settings import (BEIWE_SERVER_AWS_ACCESS_KEY_ID, BEIWE_SERVER_AWS_SECRET_ACCESS_KEY,
-    S3_BUCKET, S3_REGION_NAME)
+    PRIVATE_KEY_CACHE_SECONDS, PRIVATE_KEY_CACHE_SIZE, S3_BUCKET, S3_REGION_NAME)
 from database.study_models import Study
 from database.user_models import Participant
 from libs.aes import decrypt_server, encrypt_for_server
@@ -91,6 +94,22 @@ def s3_retrieve(key_path: str, obj: str, raw_path: bool = False, number_retries=
     return decrypt_server(encrypted_data, smart_get_study_encryption_key(obj))
 
 
+def s3_get_size(key_path: str, obj: StrOrParticipantOrStudy, raw_path: bool = False) -> int:
+    """ Returns the size of the decrypted contents of a file without downloading it. (Files are
+    encrypted in a mode that does not change their length, with a 16 byte IV prepended.) """
+    if not raw_path:
+        key_path = s3_construct_study_key_path(key_path, obj)
+    assert S3_BUCKET is not Exception, "libs.s3.s3_get_size called inside test"
+    try:
+        return conn.head_object(Bucket=S3_BUCKET, Key=key_path)["ContentLength"] - 16
+    except Exception as boto_error_unknowable_type:
+        # a HEAD request has no response body, a missing file is a generic 404 ClientError.
+        if boto_error_unknowable_type.__class__.__name__ == "ClientError" \
+                and "(404)" in str(boto_error_unknowable_type):
+            raise NoSuchKeyException(f"{S3_BUCKET}: {key_path}")
+        raise
+
+
 def s3_retrieve_plaintext(key_path: str, number_retries=3) -> bytes:
     """ Retrieves a file as-is as bytes. """
     return _do_retrieve(S3_BUCKET, key_path, number_retries=number_retries)['Body'].read()
@@ -165,11 +184,21 @@ def s3_delete(key_path: str):
 ################################################################################
 
 
+# Parsed private keys by patient id, in least recently used order, with the time they expire.  This
+# is per-process, invalidating a key only affects the current process, other processes keep using
+# their copy until it expires.  (A participant's key pair is never replaced by normal operation.)
+private_key_cache: "OrderedDict[str, tuple]" = OrderedDict()
+private_key_cache_lock = Lock()
+private_key_cache_hits = 0
+private_key_cache_misses = 0
+
+
 def create_client_key_pair(patient_id: str, study_id: str):
     """Generate key pairing, push to database, return sanitized key for client."""
     public, private = generate_key_pairing()
     s3_upload("keys/" + patient_id + "_private", private, study_id)
     s3_upload("keys/" + patient_id + "_public", public, study_id)
+    invalidate_client_private_key(patient_id)
 
 
 def get_client_public_key_string(patient_id: str, study_id: str) -> str:
@@ -185,9 +214,35 @@ def get_client_public_key(patient_id: str, study_id: str) -> RSA.RsaKey:
 
 
 def get_client_private_key(patient_id: str, study_id: str) -> RSA.RsaKey:
-    """Grabs a user's private key file from s3."""
-    key = s3_retrieve("keys/" + patient_id +"_private", study_id)
-    return get_RSA_cipher(key)
+    """Grabs a user's private key file from s3.  The key is kept in memory for
+    PRIVATE_KEY_CACHE_SECONDS, devices upload many files in quick succession. """
+    global private_key_cache_hits, private_key_cache_misses
+    now = monotonic()
+    with private_key_cache_lock:
+        if patient_id in private_key_cache:
+            key, expiry = private_key_cache[patient_id]
+            if now < expiry:
+                private_key_cache.move_to_end(patient_id)
+                private_key_cache_hits += 1
+                return key
+            del private_key_cache[patient_id]
+        private_key_cache_misses += 1
+    
+    key = get_RSA_cipher(s3_retrieve("keys/" + patient_id + "_private", study_id))
+    
+    if PRIVATE_KEY_CACHE_SECONDS > 0 and PRIVATE_KEY_CACHE_SIZE > 0:
+        with private_key_cache_lock:
+            private_key_cache[patient_id] = (key, now + PRIVATE_KEY_CACHE_SECONDS)
+            private_key_cache.move_to_end(patient_id)
+            while len(private_key_cache) > PRIVATE_KEY_CACHE_SIZE:
+                private_key_cache.popitem(last=False)
+    return key
+
+
+def invalidate_client_private_key(patient_id: str):
+    """ Removes a participant's private key from the in-memory cache of this process. """
+    with private_key_cache_lock:
+        private_key_cache.pop(patient_id, None)
 
 
 ###############################################################################
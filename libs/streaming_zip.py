@@ -6,6 +6,7 @@ from zipfile import ZIP_STORED, ZipFile
 from constants.data_stream_constants import (IMAGE_FILE, SURVEY_ANSWERS, SURVEY_TIMINGS,
     VOICE_RECORDING)
 from database.study_models import Study
+from libs.file_processing.chunk_deltas import add_delta_segment_files, with_delta_paths
 from libs.s3 import s3_retrieve
 from libs.streaming_bytes_io import StreamingBytesIO
 
@@ -57,11 +58,9 @@ def determine_file_name(chunk):
 
 def batch_retrieve_s3(chunk: dict) -> Tuple[dict, bytes]:
     """ Data is returned in the form (chunk_object, file_data). """
-    return chunk, s3_retrieve(
-        chunk["chunk_path"],
-        Study.objects.get(id=chunk["study_id"]),
-        raw_path=True,
-    )
+    study = Study.objects.get(id=chunk["study_id"])
+    file_contents = s3_retrieve(chunk["chunk_path"], study, raw_path=True)
+    return chunk, add_delta_segment_files(file_contents, chunk["delta_paths"], study)
 
 
 # Note: you cannot access the request context inside a generator function
@@ -87,7 +86,9 @@ def zip_generator(files_list, construct_registry=False):
         # is the size of the batches that are handed to the pool. We always want to add the next
         # file to retrieve to the pool asap, so we want a chunk size of 1.
         # (In the documentation there are comments about the timeout, it is irrelevant under this construction.)
-        chunks_and_content = pool.imap_unordered(batch_retrieve_s3, files_list, chunksize=1)
+        chunks_and_content = pool.imap_unordered(
+            batch_retrieve_s3, with_delta_paths(files_list), chunksize=1
+        )
         total_size = 0
         for chunk, file_contents in chunks_and_content:
             if construct_registry:
@@ -0,0 +1,29 @@
+from django.utils import timezone
+
+from database.data_access_models import RawUploadPath
+from database.user_models import Participant
+from libs.s3 import s3_list_files
+
+# Adds the S3 paths of files participants uploaded before the upload endpoint started recording them
+# in RawUploadPath, run this before enabling RAW_UPLOAD_PATH_INDEX.  Running it again is harmless.
+
+filters = {}
+
+# stick study object ids here to backfill particular studies
+study_object_ids = []
+if study_object_ids:
+    filters["study__object_id__in"] = study_object_ids
+
+query = Participant.objects.filter(**filters).values_list("pk", "patient_id", "study__object_id")
+
+print("start:", timezone.now())
+for participant_pk, patient_id, study_object_id in query.iterator():
+    # raw uploads are in the participant's folder, (participant keys are not)
+    raw_upload_paths = [
+        RawUploadPath(s3_file_path=s3_file_path, participant_id=participant_pk)
+        for s3_file_path in s3_list_files(f"{study_object_id}/{patient_id}/", as_generator=True)
+    ]
+    RawUploadPath.objects.bulk_create(raw_upload_paths, batch_size=1000, ignore_conflicts=True)
+    print(patient_id, len(raw_upload_paths))
+
+print("end:", timezone.now())
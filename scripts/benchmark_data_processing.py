@@ -0,0 +1,402 @@
+"""
+Benchmarks data processing (the chunking code in libs/file_processing) on synthetic device data.
+
+Usage:
+    python run_script.py benchmark_data_processing [--participants 4] [--hours 6] [--rounds 2] ...
+    (use --help for all options)
+
+This runs entirely on this machine, no network access is required:
+  - A fresh test database is created (the same way the test suite does) and destroyed afterwards,
+    nothing is written to the real database.
+  - S3 is replaced by a local stand-in that keeps objects in memory (or in a folder, see
+    --s3-folder).  Files are still encrypted and decrypted as they would be on S3.
+
+For every participant, hour, and data stream that the participant's OS supports, synthetic uploads
+are generated using the upload headers in REFERENCE_UPLOAD_HEADERS, at the sampling rates below.
+Each round uploads data for the same hours again (with new rows), so the first round creates
+chunks and later rounds merge into them.  Processing is run exactly like a data processing task,
+one participant and data stream at a time, and the throughput, peak memory, and the time spent in
+each stage of the processing pipeline are reported.
+
+The processing engine is configured the usual way, with environment variables, e.g. compare
+FILE_PARSING_PROCESSES=0 to FILE_PARSING_PROCESSES=4, or set VECTORIZED_BINIFICATION_STREAMS to an
+empty value to use the pure-python parsing code.  The settings in use are printed with the results.
+"""
+import argparse
+import contextlib
+import io
+import os
+import resource
+from collections import defaultdict
+from random import Random
+from sys import argv
+from time import perf_counter, sleep
+
+from cronutils.error_handler import ErrorHandler
+from django.db import connection
+
+from config.settings import (CHUNK_CACHE_MB, CHUNK_DELTA_SEGMENTS, CONCURRENT_NETWORK_OPS,
+    FILE_PARSING_PROCESSES)
+from constants.data_processing_constants import (REFERENCE_CHUNKREGISTRY_HEADERS,
+    REFERENCE_UPLOAD_HEADERS)
+from constants.data_stream_constants import (ACCELEROMETER, ANDROID_LOG_FILE, BLUETOOTH, CALL_LOG,
+    DATA_STREAM_TO_S3_FILE_NAME_STRING, DEVICEMOTION, GPS, GYRO, IDENTIFIERS, IOS_LOG_FILE,
+    MAGNETOMETER, POWER_STATE, PROXIMITY, REACHABILITY, SURVEY_TIMINGS, TEXTS_LOG, WIFI)
+from constants.user_constants import ANDROID_API, IOS_API
+from database.data_access_models import FileToProcess
+from database.study_models import Study
+from database.survey_models import Survey
+from database.user_models import Participant
+from libs import s3
+from libs.file_processing.file_processing_core import (create_parse_pool,
+    memory_budgeted_page_size, PipelineStats, process_user_file_chunks_page,
+    VECTORIZED_DATA_STREAMS)
+from libs.security import generate_easy_alphanumeric_string
+
+
+# 2020-09-13T12:00:00 UTC, an arbitrary hour.
+START_TIMESTAMP_MS = 1600000000000 // 3600000 * 3600000
+
+# Rows per second of each data stream, roughly what a participant's phone generates with the
+# default study settings. The identifiers file is always a single row, uploaded once per round.
+DEFAULT_SAMPLING_HZ = {
+    ACCELEROMETER: 10,
+    ANDROID_LOG_FILE: 1 / 20,
+    BLUETOOTH: 1 / 60,
+    CALL_LOG: 1 / 1800,
+    DEVICEMOTION: 10,
+    GPS: 1 / 10,
+    GYRO: 10,
+    IOS_LOG_FILE: 1 / 20,
+    MAGNETOMETER: 10,
+    POWER_STATE: 1 / 600,
+    PROXIMITY: 1 / 600,
+    REACHABILITY: 1 / 1200,
+    SURVEY_TIMINGS: 1 / 600,
+    TEXTS_LOG: 1 / 900,
+    WIFI: 1 / 60,
+}
+
+
+#
+## The local S3 stand-in
+#
+
+# libs.s3 identifies these boto errors by class name (boto generates them at runtime).
+class NoSuchKey(Exception): pass
+class ClientError(Exception): pass
+
+
+class LocalS3Client:
+    """ Replaces the boto3 client in libs.s3 (libs.s3.conn), implementing the calls that data
+    processing makes.  Objects are kept in memory, or in a folder if one is provided.  latency_ms
+    is added to every request, to approximate a real network round trip. """
+
+    def __init__(self, folder: str = None, latency_ms: float = 0):
+        self.folder = folder
+        self.latency_seconds = latency_ms / 1000
+        self.objects = {}
+
+    def put_object(self, Body: bytes, Bucket: str, Key: str, **kwargs):
+        self.wait()
+        if self.folder:
+            path = os.path.join(self.folder, Key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(Body)
+        else:
+            self.objects[Key] = Body
+
+    def get_object(self, Bucket: str, Key: str, **kwargs):
+        self.wait()
+        if self.folder:
+            try:
+                with open(os.path.join(self.folder, Key), "rb") as f:
+                    return {"Body": io.BytesIO(f.read())}
+            except FileNotFoundError:
+                raise NoSuchKey(Key)
+        try:
+            return {"Body": io.BytesIO(self.objects[Key])}
+        except KeyError:
+            raise NoSuchKey(Key)
+
+    def head_object(self, Bucket: str, Key: str, **kwargs):
+        self.wait()
+        try:
+            if self.folder:
+                return {"ContentLength": os.path.getsize(os.path.join(self.folder, Key))}
+            return {"ContentLength": len(self.objects[Key])}
+        except (KeyError, FileNotFoundError):
+            raise ClientError(f"An error occurred (404) when calling the HeadObject operation: {Key}")
+
+    def wait(self):
+        if self.latency_seconds:
+            sleep(self.latency_seconds)
+
+
+#
+## Synthetic data
+#
+
+def upload_header(data_stream: str, os_type: str) -> bytes:
+    header = REFERENCE_UPLOAD_HEADERS[data_stream][os_type]
+    # (the identifiers header is a string with a trailing newline)
+    if isinstance(header, str):
+        header = header.encode()
+    return header.strip()
+
+
+def synthetic_file(
+    data_stream: str, os_type: str, timestamps: list, file_timestamp_ms: int, rng: Random
+) -> bytes:
+    """ The contents of an upload with a row at each timestamp.  The timestamp goes in the column
+    named timestamp, other columns get random numbers.  Streams that the app writes differently
+    (log files, wifi, identifiers) are written the way the app writes them. """
+    header = upload_header(data_stream, os_type)
+
+    if data_stream == ANDROID_LOG_FILE:
+        # a line of text per event, preceded by a java timestamp. The first line is replaced.
+        return header + b"\n" + b"\n".join(
+            b"%d event number %d happened" % (timestamp, i) for i, timestamp in enumerate(timestamps)
+        )
+
+    columns = [column.strip() for column in header.split(b",")]
+    if data_stream == IDENTIFIERS:
+        # a single row, the timestamp is in the file name.
+        timestamps = timestamps[:1]
+
+    rows = []
+    for timestamp in timestamps:
+        rows.append(b",".join(
+            b"%d" % timestamp if column == b"timestamp" else b"%.6f" % rng.uniform(-10, 10)
+            for column in columns
+        ))
+
+    if data_stream == WIFI:
+        # every row gets the timestamp in the file name, the final newline is expected.
+        return header + b"\n" + b"\n".join(rows) + b"\n"
+    return header + b"\n" + b"\n".join(rows)
+
+
+def synthetic_file_path(
+    data_stream: str, participant: Participant, survey: Survey, file_timestamp_ms: int
+) -> str:
+    """ The path of an upload, relative to the study folder. """
+    if data_stream == IDENTIFIERS:
+        return f"{participant.patient_id}/identifiers_{file_timestamp_ms // 1000}.csv"
+    if data_stream == SURVEY_TIMINGS:
+        return f"{participant.patient_id}/surveyTimings/{survey.object_id}/{file_timestamp_ms}.csv"
+    folder = DATA_STREAM_TO_S3_FILE_NAME_STRING[data_stream]
+    return f"{participant.patient_id}/{folder}/{file_timestamp_ms}.csv"
+
+
+def upload_synthetic_data(
+    participants: list, survey: Survey, data_streams: list, sampling_hz: dict, hours: int,
+    files_per_hour: int, round_number: int, rng: Random
+) -> dict:
+    """ Uploads a round of synthetic data and creates its FilesToProcess.  Rows of later rounds are
+    offset by a few milliseconds, so they are new rows in the same chunks.  Returns the number of
+    files, rows, and bytes uploaded per data stream. """
+    uploaded = defaultdict(lambda: {"files": 0, "rows": 0, "bytes": 0})
+    file_ms = 3600000 // files_per_hour
+
+    for participant in participants:
+        for data_stream in data_streams:
+            if REFERENCE_UPLOAD_HEADERS[data_stream][participant.os_type] is None:
+                continue
+
+            if data_stream == IDENTIFIERS:
+                # once per round, the file name has a resolution of seconds.
+                file_timestamps = [START_TIMESTAMP_MS + round_number * 1000]
+                rows_per_file = 1
+            else:
+                file_timestamps = [
+                    START_TIMESTAMP_MS + file_ms * i + round_number for i in range(hours * files_per_hour)
+                ]
+                rows_per_file = max(1, round(sampling_hz[data_stream] * file_ms / 1000))
+
+            for file_timestamp in file_timestamps:
+                interval = file_ms // rows_per_file
+                timestamps = [file_timestamp + interval * i for i in range(rows_per_file)]
+                contents = synthetic_file(
+                    data_stream, participant.os_type, timestamps, file_timestamp, rng
+                )
+                path = synthetic_file_path(data_stream, participant, survey, file_timestamp)
+                s3.s3_upload(path, contents, participant.study)
+                FileToProcess.append_file_for_processing(path, participant, file_size=len(contents))
+                uploaded[data_stream]["files"] += 1
+                uploaded[data_stream]["rows"] += len(timestamps)
+                uploaded[data_stream]["bytes"] += len(contents)
+    return uploaded
+
+
+#
+## The benchmark
+#
+
+def process_all_files(stats: PipelineStats, error_handler: ErrorHandler) -> dict:
+    """ Processes every FileToProcess the way data processing tasks do, one participant and data
+    stream at a time.  Returns the seconds spent on each data stream. """
+    seconds_by_data_stream = defaultdict(float)
+    work_units = FileToProcess.objects.values_list("participant_id", "data_type") \
+        .distinct().order_by("participant_id", "data_type")
+
+    work_units = list(work_units)
+    parse_pool = create_parse_pool()
+    try:
+        for participant_id, data_type in work_units:
+            participant = Participant.objects.get(pk=participant_id)
+            t_start = perf_counter()
+            after_pk = 0
+            page_uploads = None
+            while True:
+                last_pk, page_uploads = process_user_file_chunks_page(
+                    page_size=memory_budgeted_page_size(participant, after_pk, data_type),
+                    error_handler=error_handler,
+                    after_pk=after_pk,
+                    participant=participant,
+                    stats=stats,
+                    data_type=data_type,
+                    parse_pool=parse_pool,
+                    previous_page=page_uploads,
+                )
+                if last_pk is None:
+                    break
+                after_pk = last_pk
+            seconds_by_data_stream[data_type] += perf_counter() - t_start
+    finally:
+        if parse_pool:
+            parse_pool.terminate()
+            parse_pool.join()
+    return seconds_by_data_stream
+
+
+def print_results(round_number: int, uploaded: dict, seconds_by_data_stream: dict, seconds: float):
+    files = sum(counts["files"] for counts in uploaded.values())
+    rows = sum(counts["rows"] for counts in uploaded.values())
+    total_bytes = sum(counts["bytes"] for counts in uploaded.values())
+    print(
+        f"round {round_number}: {files} files, {rows} rows, {total_bytes / 1024**2:.1f} MB in "
+        f"{seconds:.2f}s: {files / seconds:.1f} files/s, {rows / seconds:.0f} rows/s, "
+        f"{total_bytes / 1024**2 / seconds:.2f} MB/s"
+    )
+    for data_stream in sorted(uploaded):
+        counts = uploaded[data_stream]
+        stream_seconds = seconds_by_data_stream.get(data_stream, 0)
+        print(
+            f"\t{data_stream}: {counts['files']} files, {counts['rows']} rows, "
+            f"{counts['bytes'] / 1024**2:.2f} MB in {stream_seconds:.2f}s"
+            + (f", {counts['rows'] / stream_seconds:.0f} rows/s" if stream_seconds else "")
+        )
+
+
+def print_peak_memory():
+    # ru_maxrss is in kilobytes on linux. Parsing worker processes are children of this process.
+    self_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print(f"peak RSS: {self_mb:.0f} MB (largest child process, e.g. a parsing worker: {children_mb:.0f} MB)")
+
+
+def run_benchmark(options):
+    rng = Random(options.seed)
+    study = Study.create_with_object_id(
+        name="benchmark " + generate_easy_alphanumeric_string(),
+        encryption_key=generate_easy_alphanumeric_string(32),
+    )
+    survey = Survey.create_with_object_id(study=study, survey_type=Survey.TRACKING_SURVEY)
+    participants = []
+    for i in range(options.participants):
+        os_type = options.os_type or (ANDROID_API if i % 2 == 0 else IOS_API)
+        patient_id, _ = Participant.create_with_password(study=study, os_type=os_type)
+        participants.append(Participant.objects.get(patient_id=patient_id))
+
+    print(
+        f"{options.participants} participants, {options.hours} hours, {options.files_per_hour} "
+        f"files per hour, {options.rounds} rounds, S3 latency {options.s3_latency_ms}ms."
+    )
+    print(
+        f"FILE_PARSING_PROCESSES={FILE_PARSING_PROCESSES}, CONCURRENT_NETWORK_OPS="
+        f"{CONCURRENT_NETWORK_OPS}, CHUNK_DELTA_SEGMENTS={CHUNK_DELTA_SEGMENTS}, CHUNK_CACHE_MB="
+        f"{CHUNK_CACHE_MB}, vectorized streams: {','.join(sorted(VECTORIZED_DATA_STREAMS)) or 'none'}"
+    )
+
+    for round_number in range(1, options.rounds + 1):
+        uploaded = upload_synthetic_data(
+            participants, survey, options.data_streams, options.sampling_hz, options.hours,
+            options.files_per_hour, round_number, rng,
+        )
+
+        stats = PipelineStats()
+        error_handler = ErrorHandler()
+        output = contextlib.nullcontext() if options.verbose else \
+            contextlib.redirect_stdout(io.StringIO())
+        t_start = perf_counter()
+        with output:
+            seconds_by_data_stream = process_all_files(stats, error_handler)
+        seconds = perf_counter() - t_start
+
+        print()
+        print_results(round_number, uploaded, seconds_by_data_stream, seconds)
+        stats.print_stats()
+        if error_handler.errors:
+            print(f"{FileToProcess.objects.count()} files failed to process:")
+            print(error_handler)
+        FileToProcess.objects.all().delete()
+
+    print()
+    print_peak_memory()
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(
+        prog="python run_script.py benchmark_data_processing",
+        description="Benchmarks data processing on synthetic data, see the top of this file.",
+    )
+    parser.add_argument("--participants", type=int, default=2,
+                        help="number of participants, alternating android and ios (default 2)")
+    parser.add_argument("--os", dest="os_type", choices=[ANDROID_API, IOS_API],
+                        help="make every participant use this os")
+    parser.add_argument("--hours", type=int, default=3, help="hours of data per round (default 3)")
+    parser.add_argument("--files-per-hour", type=int, default=1,
+                        help="uploads per hour of each data stream (default 1)")
+    parser.add_argument("--rounds", type=int, default=2,
+                        help="rounds of uploads, rounds after the first merge into existing chunks (default 2)")
+    parser.add_argument("--streams", default=",".join(sorted(REFERENCE_CHUNKREGISTRY_HEADERS)),
+                        help="comma separated data streams (default all)")
+    parser.add_argument("--rate", action="append", default=[], metavar="STREAM=HZ",
+                        help="sampling rate of a data stream in rows per second, can be repeated")
+    parser.add_argument("--s3-folder", help="store the S3 stand-in's objects in this folder")
+    parser.add_argument("--s3-latency-ms", type=float, default=0,
+                        help="latency added to every S3 request (default 0)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the synthetic data")
+    parser.add_argument("--verbose", action="store_true", help="show data processing output")
+    # run_script.py passes its own arguments through.
+    options = parser.parse_args(argv[2:] if argv[1:2] == ["benchmark_data_processing"] else argv[1:])
+
+    options.data_streams = [stream.strip() for stream in options.streams.split(",") if stream.strip()]
+    for data_stream in options.data_streams:
+        if data_stream not in REFERENCE_CHUNKREGISTRY_HEADERS:
+            parser.error(f"unknown data stream '{data_stream}'")
+    options.sampling_hz = dict(DEFAULT_SAMPLING_HZ)
+    for rate in options.rate:
+        data_stream, _, hz = rate.partition("=")
+        if data_stream not in DEFAULT_SAMPLING_HZ:
+            parser.error(f"unknown data stream '{data_stream}' in --rate")
+        options.sampling_hz[data_stream] = float(hz)
+    return options
+
+
+def main():
+    options = parse_options()
+    s3.conn = LocalS3Client(options.s3_folder, options.s3_latency_ms)
+
+    old_database_name = connection.settings_dict["NAME"]
+    print("creating a benchmark database...")
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        run_benchmark(options)
+    finally:
+        connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+
+main()
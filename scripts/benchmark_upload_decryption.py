@@ -0,0 +1,140 @@
+"""
+Micro-benchmark of the decryption of files uploaded by devices (libs.encryption).
+
+Usage:
+    python run_script.py benchmark_upload_decryption [--lines 20000] [--repeat 5]
+
+Files are encrypted the way the apps encrypt them: the first line is the file's AES key, encrypted
+with the participant's RSA public key, and every other line is a CSV row encrypted with AES CBC and
+its own iv.  An Android file of accelerometer rows and an iOS file of (longer) devicemotion rows are
+decrypted with the batched decryption used by DeviceDataDecryptor and with the previous
+line-by-line decryption, and the lines per second of each are reported.  No network or database
+access is required.
+"""
+import argparse
+from os import urandom
+from random import Random
+from sys import argv
+from time import perf_counter
+
+from Cryptodome.Cipher import AES
+from Cryptodome.PublicKey import RSA
+
+from constants.user_constants import ANDROID_API, IOS_API
+from libs.encryption import decrypted_key_cache, DeviceDataDecryptor
+from libs.security import encode_base64
+
+
+class BenchmarkParticipant:
+    """ The parts of a Participant that DeviceDataDecryptor uses. """
+
+    def __init__(self, os_type: str, private_key: RSA.RsaKey):
+        self.patient_id = "benchmrk"
+        self.os_type = os_type
+        self.private_key = private_key
+
+    def get_private_key(self) -> RSA.RsaKey:
+        return self.private_key
+
+
+class BenchmarkDecryptor(DeviceDataDecryptor):
+
+    def populate_ios_decryption_key(self, base64_key: bytes):
+        pass  # (this writes to the database)
+
+
+class LineByLineDecryptor(BenchmarkDecryptor):
+    """ The previous implementation of decrypt_device_file, a cipher is created for every line. """
+
+    def decrypt_device_file(self):
+        lines = enumerate(self.file_lines)
+        next(lines)
+        for line_index, line in lines:
+            self.line_index = line_index
+            try:
+                self.good_lines.append(self.decrypt_device_line(line))
+            except Exception as error_orig:
+                self.handle_line_error(line, error_orig)
+        self.create_metadata_error()
+
+
+def encrypt_device_file(rows: list, public_key: RSA.RsaKey) -> bytes:
+    """ Encrypts rows the way the apps do. """
+    aes_key = urandom(16)
+    # the apps use textbook RSA on the base64 encoded key.
+    wrapped_key = pow(int.from_bytes(encode_base64(aes_key), "big"), public_key.e, public_key.n)
+    lines = [encode_base64(wrapped_key.to_bytes(public_key.size_in_bytes(), "big"))]
+    for row in rows:
+        iv = urandom(16)
+        padding_length = 16 - len(row) % 16
+        padded_row = row + bytes([padding_length]) * padding_length
+        ciphertext = AES.new(aes_key, mode=AES.MODE_CBC, IV=iv).encrypt(padded_row)
+        lines.append(encode_base64(iv) + b":" + encode_base64(ciphertext))
+    return b"\n".join(lines)
+
+
+def synthetic_rows(os_type: str, line_count: int, rng: Random) -> list:
+    if os_type == ANDROID_API:
+        # accelerometer
+        return [b"timestamp,accuracy,x,y,z"] + [
+            b"%d,unknown,%.6f,%.6f,%.6f" % (
+                1600000000000 + i * 100, rng.uniform(-10, 10), rng.uniform(-10, 10), rng.uniform(-10, 10)
+            ) for i in range(line_count)
+        ]
+    # devicemotion
+    return [b"timestamp,roll,pitch,yaw,rotation_rate_x,rotation_rate_y,rotation_rate_z,gravity_x,"
+            b"gravity_y,gravity_z,user_accel_x,user_accel_y,user_accel_z,"
+            b"magnetic_field_calibration_accuracy,magnetic_field_x,magnetic_field_y,magnetic_field_z"] + [
+        b"%d," % (1600000000000 + i * 100) + b",".join(b"%.6f" % rng.uniform(-10, 10) for _ in range(16))
+        for i in range(line_count)
+    ]
+
+
+def time_decryption(decryptor_class, file_contents: bytes, participant, repeat: int) -> float:
+    """ Returns the fastest of repeat runs, in seconds. """
+    best = None
+    for _ in range(repeat):
+        # the key decryption is cached, time only the lines.
+        decrypted_key_cache.clear()
+        t_start = perf_counter()
+        decryptor_class("benchmark.csv", file_contents, participant)
+        seconds = perf_counter() - t_start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python run_script.py benchmark_upload_decryption",
+        description="Benchmarks the decryption of files uploaded by devices, see the top of this file.",
+    )
+    parser.add_argument("--lines", type=int, default=20000, help="lines per file (default 20000)")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each, the fastest is reported (default 5)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the synthetic data")
+    # run_script.py passes its own arguments through.
+    options = parser.parse_args(argv[2:] if argv[1:2] == ["benchmark_upload_decryption"] else argv[1:])
+
+    print("generating a key pair...")
+    private_key = RSA.generate(2048)
+    rng = Random(options.seed)
+    for os_type in (ANDROID_API, IOS_API):
+        participant = BenchmarkParticipant(os_type, private_key)
+        rows = synthetic_rows(os_type, options.lines, rng)
+        file_contents = encrypt_device_file(rows, private_key.publickey())
+
+        decryptor = BenchmarkDecryptor("benchmark.csv", file_contents, participant)
+        assert decryptor.decrypted_file == b"\n".join(rows), "decryption failed"
+
+        line_by_line_seconds = time_decryption(
+            LineByLineDecryptor, file_contents, participant, options.repeat
+        )
+        batched_seconds = time_decryption(BenchmarkDecryptor, file_contents, participant, options.repeat)
+        print(
+            f"{os_type}: {len(rows)} lines, {len(file_contents) / 1024**2:.2f} MB encrypted. "
+            f"line by line: {len(rows) / line_by_line_seconds:.0f} lines/s, "
+            f"batched: {len(rows) / batched_seconds:.0f} lines/s "
+            f"({line_by_line_seconds / batched_seconds:.1f}x)"
+        )
+
+
+main()
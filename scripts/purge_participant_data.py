@@ -17,9 +17,9 @@ _imp.load_source("__init__", _current_folder_init)
 
 
 from config.settings import S3_BUCKET
-from constants.common_constants import API_TIME_FORMAT
-from constants.data_processing_constants import CHUNKS_FOLDER
-from database.data_access_models import ChunkRegistry
+from constants.common_constants import API_TIME_FORMAT, PENDING_UPLOADS
+from constants.data_processing_constants import CHUNK_DELTAS_FOLDER, CHUNKS_FOLDER
+from database.data_access_models import ChunkRegistry, PendingUpload, RawUploadPath
 from database.user_models import Participant
 from libs.s3 import conn as s3_conn, s3_list_files, s3_list_versions
 
@@ -135,8 +135,20 @@ def assemble_deletable_files(sorted_data):
         chunks_prefix = CHUNKS_FOLDER + "/" + prefix
         s3_chunks_files = s3_list_files(chunks_prefix, as_generator=True)
 
+        # delta segments are in a folder named after the chunk's time bin
+        deltas_prefix = CHUNK_DELTAS_FOLDER + "/" + prefix
+        s3_delta_files = s3_list_files(deltas_prefix, as_generator=True)
+
+        # uploads that have not been ingested yet, their file names have a random suffix.
+        pending_uploads_prefix = PENDING_UPLOADS + "/" + prefix
+        s3_pending_upload_files = s3_list_files(pending_uploads_prefix, as_generator=True)
+
         raw_files = assemble_raw_files(s3_files, expunge_start_unix_timestamp)
+        raw_files.extend(
+            assemble_raw_files(s3_pending_upload_files, expunge_start_unix_timestamp, name_suffix_length=10)
+        )
         chunked_files = assemble_chunked_files(s3_chunks_files, expunge_start_date)
+        chunked_files.extend(assemble_chunked_files(s3_delta_files, expunge_start_date, folder=True))
 
         print(
             patient_id,
@@ -150,11 +162,12 @@ def assemble_deletable_files(sorted_data):
     return deletable_file_paths
 
 
-def assemble_raw_files(s3_file_paths, expunge_timestamp):
+def assemble_raw_files(s3_file_paths, expunge_timestamp, name_suffix_length=0):
     ret = []
     for file_path in s3_file_paths:
         # there may be some corrupt file paths that has _ instead of /
-        extracted_timestamp_str = file_path.replace("_", "/").rsplit("/", 1)[1][:-4]
+        file_name = file_path[:len(file_path) - name_suffix_length]
+        extracted_timestamp_str = file_name.replace("_", "/").rsplit("/", 1)[1][:-4]
         extracted_timestamp_int = int(extracted_timestamp_str)
 
         if len(extracted_timestamp_str) == 10:
@@ -165,11 +178,14 @@ def assemble_raw_files(s3_file_paths, expunge_timestamp):
     return ret
 
 
-def assemble_chunked_files(s3_chunks_files, expunge_start_date):
+def assemble_chunked_files(s3_chunks_files, expunge_start_date, folder=False):
     ret = []
     for file_path in s3_chunks_files:
         # there may be some corrupt file paths that has _ instead of /
-        extracted_timestamp_str = file_path.replace("_", "/").rsplit("/", 1)[1][:-4]
+        if folder:
+            extracted_timestamp_str = file_path.replace("_", "/").rsplit("/", 2)[1]
+        else:
+            extracted_timestamp_str = file_path.replace("_", "/").rsplit("/", 1)[1][:-4]
         extracted_dt = datetime.strptime(extracted_timestamp_str, API_TIME_FORMAT)
 
         if expunge_start_date < extracted_dt:
@@ -205,3 +221,8 @@ print("\nAssembling the files to delete...")
 deletable_files = assemble_deletable_files(setup_data)
 
 delete_versions(deletable_files)
+
+# the upload endpoint must not treat new uploads of these files as duplicates.
+RawUploadPath.objects.filter(s3_file_path__in=deletable_files).delete()
+# and the upload ingestion tasks must not try to ingest deleted uploads.
+PendingUpload.objects.filter(s3_path__in=deletable_files).delete()
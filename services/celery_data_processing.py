@@ -1,11 +1,26 @@
+import gc
+from ctypes import CDLL
 from datetime import datetime, timedelta
+from math import sqrt
+from os import sysconf
+from typing import List, Optional
+
+from django.db import close_old_connections
+from django.db.models import Count, Min, Sum
+from django.utils import timezone
+
+from config.settings import DATA_PROCESSING_WORKER_MAX_MB, DATA_PROCESSING_WORKER_MAX_TASKS
 
-from config.settings import FILE_PROCESS_PAGE_SIZE
 from constants.celery_constants import DATA_PROCESSING_CELERY_QUEUE
+from database.data_access_models import (ChunkDelta, ChunkRegistry, FileProcessingLock,
+    FileToProcess, PendingUpload)
 from database.user_models import Participant
 from libs.celery_control import (FalseCeleryApp, get_processing_active_job_ids,
-    processing_celery_app, safe_apply_async)
-from libs.file_processing.file_processing_core import do_process_user_file_chunks
+    get_processing_worker_slots, processing_celery_app, safe_apply_async)
+from libs.file_processing.chunk_deltas import compact_chunk
+from libs.file_processing.file_processing_core import (create_parse_pool,
+    files_to_process_after, memory_budgeted_page_size, process_user_file_chunks_page)
+from libs.participant_file_uploads import ingest_pending_upload
 from libs.sentry import make_error_sentry, SentryTypes
 
 
@@ -29,91 +44,346 @@ def create_file_processing_tasks():
     expiry = (datetime.utcnow() + timedelta(minutes=5)).replace(second=30, microsecond=0)
     
     with make_error_sentry(sentry_type=SentryTypes.data_processing):
-        participant_set = set(
-            Participant.objects.filter(files_to_process__isnull=False)
-                .distinct()
-                # .order_by("id")  # For debugging, forces overlap conflicts.
-                .order_by("?")     # don't want a single user blocking everyone because they are at the front.
-                .values_list("id", flat=True)
-        )
+        # Work is split into units of a participant and a data type.  Chunks never contain data from
+        # more than one data type, so several workers can process one participant's files at once.
+        FileToProcess.populate_data_types()
         
         # sometimes celery just fails to exist, set should be redundant.
         active_set = set(get_processing_active_job_ids())
+        work_units_to_process = [
+            (backlog["participant_id"], backlog["data_type"]) for backlog in get_work_unit_backlogs()
+            if (backlog["participant_id"], backlog["data_type"]) not in active_set
+        ]
         
-        participants_to_process = participant_set - active_set
-        print("Queueing these participants:", ",".join(str(p) for p in participants_to_process))
+        # Only queue as many tasks as there are free workers, everything else waits for the next
+        # run (when priorities have been recalculated) instead of expiring in the queue.
+        worker_slots = get_processing_worker_slots()
+        if worker_slots is not None:
+            work_units_to_process = work_units_to_process[:max(worker_slots - len(active_set), 0)]
         
-        for participant_id in participants_to_process:
+        print("Queueing these participants and data types:", ",".join(
+            f"{participant_id} {data_type}" for participant_id, data_type in work_units_to_process
+        ))
+        
+        for participant_id, data_type in work_units_to_process:
             # Queue all users' file processing, and generate a list of currently running jobs
             # to use to detect when all jobs are finished running.
             safe_apply_async(
                 celery_process_file_chunks,
-                args=[participant_id],
+                args=[participant_id, data_type],
                 max_retries=0,
                 expires=expiry,
                 task_track_started=True,
                 task_publish_retry=False,
                 retry=False
             )
-        print(f"{len(participants_to_process)} users queued for processing")
+        print(f"{len(work_units_to_process)} participant data types queued for processing")
+
+
+# a backlog of this size waits about 1.4x as long before processing as a backlog of one small file.
+BACKLOG_WEIGHT_BYTES = 100 * 1024 * 1024
+
+
+def get_work_unit_backlogs() -> List[dict]:
+    """ The participant_id, data_type, file_count, backlog_bytes, and oldest_upload of the files to
+    process of every participant and data type, highest priority first. """
+    backlogs = list(
+        FileToProcess.objects.exclude(deleted=True)
+            .values("participant_id", "data_type")
+            .annotate(
+                file_count=Count("id"),
+                backlog_bytes=Sum("file_size"),
+                known_size_count=Count("file_size"),
+                oldest_upload=Min("created_on"),
+            )
+            .order_by()
+    )
+    for backlog in backlogs:
+        # files with no recorded size are counted as the average size of the others.
+        if backlog["known_size_count"]:
+            backlog["backlog_bytes"] = \
+                backlog["backlog_bytes"] * backlog["file_count"] // backlog["known_size_count"]
+        else:
+            backlog["backlog_bytes"] = 0
+        del backlog["known_size_count"]
+    
+    now = timezone.now()
+    backlogs.sort(key=lambda backlog: work_unit_priority(backlog, now), reverse=True)
+    return backlogs
+
+
+def work_unit_priority(backlog: dict, now: datetime) -> float:
+    """ Higher is sooner.  The longest waiting data is processed first, but waiting time is
+    discounted for large backlogs so that one participant with months of data to catch up on doesn't
+    hold up everyone else's (quick) updates.  Large backlogs still get processed, their priority
+    keeps increasing while they wait. """
+    wait_seconds = (now - backlog["oldest_upload"]).total_seconds()
+    return wait_seconds / sqrt(1 + backlog["backlog_bytes"] / BACKLOG_WEIGHT_BYTES)
 
 
 @processing_celery_app.task(queue=DATA_PROCESSING_CELERY_QUEUE)
-def celery_process_file_chunks(participant_id):
-    """ This is the function is queued up, it runs through all new uploads from a specific user and
-    'chunks' them. Handles logic for skipping bad files, raising errors. """
+def celery_process_file_chunks(participant_id: int, data_type: str):
+    """ This is the function is queued up, it runs through all new uploads of a data type from a
+    specific user and 'chunks' them. Handles logic for skipping bad files, raising errors. """
     
     # celery doesn't clean up after itself very well, either memory or open network connections.
-    # this probably has something to do with the fact that celery forks, so possibly picking
-    # a different mode would impact this.  Or we can just exit the python process.
+    # Worker processes are reused until they use too much memory (see recycle_worker_process).
+    global tasks_run_by_this_process
+    tasks_run_by_this_process += 1
+    locked = False
+    parse_pool = None
     try:
         time_start = datetime.now()
         participant = Participant.objects.get(id=participant_id)
         
-        number_bad_files = 0
+        # another task may already be processing these files (e.g. it was queued on a prior run and
+        # is still going)
+        locked = FileProcessingLock.acquire(participant_id, data_type)
+        if not locked:
+            print(f"{participant.patient_id} {data_type} is already being processed.")
+            return
+        
         error_sentry = make_error_sentry(
-            sentry_type=SentryTypes.data_processing, tags={'user_id': participant.patient_id}
+            sentry_type=SentryTypes.data_processing,
+            tags={'user_id': participant.patient_id, 'data_type': data_type},
+        )
+        print(
+            f"{datetime.now()} processing {data_type} files for {participant.patient_id}, "
+            f"{files_to_process_after(participant, 0, data_type).count()} files to process"
         )
-        print("processing files for {participant.patient_id}")
         
-        while True:
-            previous_number_bad_files = number_bad_files
-            starting_length = participant.files_to_process.exclude(deleted=True).count()
-            
-            print(f"{datetime.now()} processing {participant.patient_id}, {starting_length} files remaining")
-            number_bad_files += do_process_user_file_chunks(
-                page_size=FILE_PROCESS_PAGE_SIZE,
-                error_handler=error_sentry,
-                position=number_bad_files,
-                participant=participant,
-            )
-            # If no files were processed, quit processing
-            if participant.files_to_process.exclude(deleted=True).count() == starting_length:
-                if previous_number_bad_files == number_bad_files:
-                    # 2 Cases:
-                    #   1) every file broke, blow up. (would cause infinite loop otherwise).
-                    #   2) no new files.
+        # Pages of files are processed in primary key order, each page starts after the last file of
+        # the previous page, and a page's uploads finish while the next page downloads.  Files that
+        # fail are left in place, they are retried on the next task.
+        after_pk = 0
+        failed_pks = set()
+        page_uploads = None
+        parse_pool = create_parse_pool()  # (one set of worker processes for every page)
+        try:
+            while True:
+                last_pk, next_page_uploads = process_user_file_chunks_page(
+                    page_size=memory_budgeted_page_size(participant, after_pk, data_type),
+                    error_handler=error_sentry,
+                    after_pk=after_pk,
+                    participant=participant,
+                    data_type=data_type,
+                    parse_pool=parse_pool,
+                    previous_page=page_uploads,
+                )
+                if page_uploads:
+                    failed_pks.update(page_uploads.finish())
+                page_uploads = next_page_uploads
+                # no files remaining (files uploaded while processing have higher primary keys)
+                if last_pk is None:
                     break
-                else:
-                    continue
-            
-            # put maximum time limit per user
-            if (time_start - datetime.now()).total_seconds() > 60*60*3:
-                break
+                after_pk = last_pk
+                
+                # put maximum time limit per user
+                if (datetime.now() - time_start).total_seconds() > 60*60*3:
+                    break
+        finally:
+            if page_uploads:
+                failed_pks.update(page_uploads.finish())
+        
+        if failed_pks:
+            print(f"{len(failed_pks)} {data_type} files failed to process for {participant.patient_id}")
     except Exception as e:
         # raise the exception if not running in celery.
         if processing_celery_app is FalseCeleryApp:
             raise
         print(f"Error running data processing: {e}")
     finally:
+        if parse_pool:
+            parse_pool.terminate()
+            parse_pool.join()
+        if locked:
+            FileProcessingLock.release(participant_id, data_type)
         if processing_celery_app is not FalseCeleryApp:
-            # exit if running inside celery.
-            print(
-                "Data processing task completed. Exiting to clean up memory. You can safely ignore "
-                "the immediately following \"Worker exited prematurely: exitcode 0\" error message."
-            )
-            exit(0)
+            recycle_worker_process()
 
 
 # and mark it to not retry!
 celery_process_file_chunks.max_retries = 0
+
+
+def create_chunk_compaction_tasks():
+    """ Queues tasks that merge delta segments into their chunks (see CHUNK_DELTA_SEGMENTS), for
+    every participant and data type that has delta segments.  This is called hourly. """
+    expiry = datetime.utcnow() + timedelta(minutes=50)
+    
+    with make_error_sentry(sentry_type=SentryTypes.data_processing):
+        work_units = list(
+            ChunkDelta.objects.values_list("chunk__participant_id", "chunk__data_type")
+                .distinct().order_by()
+        )
+        active_set = set(get_processing_active_job_ids())
+        work_units_to_compact = [unit for unit in work_units if unit not in active_set]
+        
+        for participant_id, data_type in work_units_to_compact:
+            safe_apply_async(
+                celery_compact_chunk_deltas,
+                args=[participant_id, data_type],
+                max_retries=0,
+                expires=expiry,
+                task_track_started=True,
+                task_publish_retry=False,
+                retry=False
+            )
+        print(f"{len(work_units_to_compact)} participant data types queued for compaction")
+
+
+@processing_celery_app.task(queue=DATA_PROCESSING_CELERY_QUEUE)
+def celery_compact_chunk_deltas(participant_id: int, data_type: str):
+    """ Merges the delta segments of a participant's chunks of a data type into the chunks. """
+    global tasks_run_by_this_process
+    tasks_run_by_this_process += 1
+    locked = False
+    try:
+        # data processing must not add delta segments to a chunk while it is being compacted, this
+        # is the same lock.  If it is held, compaction happens on the next run.
+        locked = FileProcessingLock.acquire(participant_id, data_type)
+        if not locked:
+            print(f"participant {participant_id} {data_type} is being processed, not compacting.")
+            return
+        
+        error_sentry = make_error_sentry(
+            sentry_type=SentryTypes.data_processing,
+            tags={'participant_id': participant_id, 'data_type': data_type},
+        )
+        chunks = ChunkRegistry.objects.filter(
+            participant_id=participant_id, data_type=data_type, deltas__isnull=False
+        ).distinct()
+        for chunk in chunks:
+            with error_sentry:
+                compact_chunk(chunk)
+        print(f"compacted delta segments of participant {participant_id} {data_type}")
+    except Exception as e:
+        # raise the exception if not running in celery.
+        if processing_celery_app is FalseCeleryApp:
+            raise
+        print(f"Error running chunk compaction: {e}")
+    finally:
+        if locked:
+            FileProcessingLock.release(participant_id, data_type)
+        if processing_celery_app is not FalseCeleryApp:
+            recycle_worker_process()
+
+
+celery_compact_chunk_deltas.max_retries = 0
+
+
+# upload ingestion tasks hold a participant's FileProcessingLock of this name (it is not a data type)
+UPLOAD_INGESTION_LOCK = "upload_ingestion"
+
+
+def create_upload_ingestion_tasks():
+    """ Queues tasks that decrypt the uploads stored by the upload endpoint when ASYNC_UPLOAD_INGESTION
+    is enabled, for every participant that has pending uploads.  This is called every 5 minutes. """
+    expiry = (datetime.utcnow() + timedelta(minutes=5)).replace(second=30, microsecond=0)
+    
+    with make_error_sentry(sentry_type=SentryTypes.data_processing):
+        participant_ids = list(
+            PendingUpload.objects.values_list("participant_id", flat=True).distinct().order_by()
+        )
+        # ingestion tasks have one argument, active ingestion tasks are participant ids in this set.
+        active_set = set(get_processing_active_job_ids())
+        participant_ids = [pk for pk in participant_ids if pk not in active_set]
+        
+        for participant_id in participant_ids:
+            safe_apply_async(
+                celery_ingest_uploads,
+                args=[participant_id],
+                max_retries=0,
+                expires=expiry,
+                task_track_started=True,
+                task_publish_retry=False,
+                retry=False
+            )
+        print(f"{len(participant_ids)} participants queued for upload ingestion")
+
+
+@processing_celery_app.task(queue=DATA_PROCESSING_CELERY_QUEUE)
+def celery_ingest_uploads(participant_id: int):
+    """ Decrypts a participant's pending uploads, in the order they were uploaded, and creates their
+    FileToProcess objects. """
+    global tasks_run_by_this_process
+    tasks_run_by_this_process += 1
+    locked = False
+    try:
+        # split ios files have to be ingested in order, one task at a time.
+        locked = FileProcessingLock.acquire(participant_id, UPLOAD_INGESTION_LOCK)
+        if not locked:
+            print(f"participant {participant_id} uploads are already being ingested.")
+            return
+        
+        error_sentry = make_error_sentry(
+            sentry_type=SentryTypes.data_processing, tags={'participant_id': participant_id}
+        )
+        ingested = waiting = 0
+        for pending_upload in PendingUpload.objects.filter(participant_id=participant_id).order_by("pk"):
+            # failed uploads are left in place and retried by the next task.
+            with error_sentry:
+                if ingest_pending_upload(pending_upload):
+                    ingested += 1
+                else:
+                    waiting += 1
+        print(f"ingested {ingested} uploads of participant {participant_id}, {waiting} waiting")
+    except Exception as e:
+        # raise the exception if not running in celery.
+        if processing_celery_app is FalseCeleryApp:
+            raise
+        print(f"Error running upload ingestion: {e}")
+    finally:
+        if locked:
+            FileProcessingLock.release(participant_id, UPLOAD_INGESTION_LOCK)
+        if processing_celery_app is not FalseCeleryApp:
+            recycle_worker_process()
+
+
+celery_ingest_uploads.max_retries = 0
+
+
+tasks_run_by_this_process = 0
+
+
+def recycle_worker_process():
+    """ Exits (celery starts a new worker process) if this process has run too many tasks or is using
+    too much memory, otherwise releases as much memory as possible for the next task. """
+    # don't hand a broken database connection (e.g. after an error) to the next task.
+    close_old_connections()
+    # the data from the last task is garbage, but some of it may be in reference cycles.
+    gc.collect()
+    trim_malloc()
+    memory_mb = get_memory_usage_mb()
+    
+    if tasks_run_by_this_process >= DATA_PROCESSING_WORKER_MAX_TASKS:
+        reason = f"{tasks_run_by_this_process} tasks completed"
+    elif memory_mb is not None and memory_mb > DATA_PROCESSING_WORKER_MAX_MB:
+        reason = f"using {memory_mb:.0f}MB of memory"
+    else:
+        return
+    
+    print(
+        f"Data processing task completed, {reason}. Exiting to clean up memory. You can safely "
+        "ignore the immediately following \"Worker exited prematurely: exitcode 0\" error message."
+    )
+    exit(0)
+
+
+def get_memory_usage_mb() -> Optional[float]:
+    """ The resident memory (RSS) of this process, None if it can't be determined (not linux). """
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+
+def trim_malloc():
+    """ Python's allocator returns freed memory to the C allocator, which mostly holds onto it.
+    glibc's malloc_trim returns it to the operating system. """
+    try:
+        CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
@@ -19,6 +19,7 @@ from constants.forest_constants import (FOREST_ERROR_LOCATION_KEY, ForestTaskSta
 from database.data_access_models import ChunkRegistry
 from database.tableau_api_models import ForestTask, SummaryStatisticDaily
 from libs.celery_control import forest_celery_app, safe_apply_async
+from libs.file_processing.chunk_deltas import add_delta_segment_files, with_delta_paths
 from libs.s3 import s3_retrieve
 from libs.sentry import make_error_sentry, SentryTypes
 from libs.streaming_zip import determine_file_name
@@ -236,7 +237,10 @@ def create_local_data_files(task, chunks):
     with ThreadPool(4) as pool:
         for _ in pool.imap_unordered(
             func=batch_create_file,
-            iterable=[(task, chunk) for chunk in chunks.values("study__object_id", *CHUNK_FIELDS)],
+            iterable=[
+                (task, chunk)
+                for chunk in with_delta_paths(chunks.values("study__object_id", *CHUNK_FIELDS))
+            ],
         ):
             pass
 
@@ -246,6 +250,7 @@ def batch_create_file(singular_task_chunk: Tuple[ForestTask, Dict]):
     # weird unpack of variables, do s3_retrieve.
     task, chunk = singular_task_chunk
     contents = s3_retrieve(chunk["chunk_path"], chunk["study__object_id"], raw_path=True)
+    contents = add_delta_segment_files(contents, chunk["delta_paths"], chunk["study__object_id"])
     # file ops
     file_name = os.path.join(task.data_input_path, determine_file_name(chunk))
     os.makedirs(os.path.dirname(file_name), exist_ok=True)
@@ -9,7 +9,8 @@ from sys import argv
 
 from cronutils import run_tasks
 
-from services.celery_data_processing import create_file_processing_tasks
+from services.celery_data_processing import (create_chunk_compaction_tasks,
+    create_file_processing_tasks, create_upload_ingestion_tasks)
 from services.celery_forest import create_forest_celery_tasks
 from services.celery_push_notifications import create_push_notification_tasks
 from services.scripts_runner import create_task_ios_no_decryption_key_task, create_task_upload_logs
@@ -25,8 +26,9 @@ VALID_ARGS = [FIVE_MINUTES, HOURLY, FOUR_HOURLY, DAILY, WEEKLY, MONTHLY]
 
 TASKS = {
     FIVE_MINUTES:
-        [create_file_processing_tasks, create_push_notification_tasks, create_forest_celery_tasks],
-    HOURLY: [create_task_ios_no_decryption_key_task],
+        [create_upload_ingestion_tasks, create_file_processing_tasks, create_push_notification_tasks,
+         create_forest_celery_tasks],
+    HOURLY: [create_task_ios_no_decryption_key_task, create_chunk_compaction_tasks],
     FOUR_HOURLY: [],
     DAILY: [create_task_upload_logs],
     WEEKLY: [],
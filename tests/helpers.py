@@ -495,6 +495,16 @@ class DummyThreadPool():
         # does not use kwargs
         return map(func, iterable)
     
+    def map(self, func, iterable, **kwargs):
+        return list(map(func, iterable))
+    
+    def apply_async(self, func, args=(), kwds=None, **kwargs):
+        # like a real pool, an exception is raised when the result is retrieved.
+        try:
+            return DummyAsyncResult(func(*args, **(kwds or {})))
+        except Exception as e:
+            return DummyAsyncResult(None, e)
+    
     # @staticmethod
     def terminate(self):
         pass
@@ -504,6 +514,21 @@ class DummyThreadPool():
         pass
 
 
+class DummyAsyncResult():
+    """ the result of DummyThreadPool.apply_async, the function has already run. """
+    def __init__(self, value, exception: Exception = None) -> None:
+        self.value = value
+        self.exception = exception
+    
+    def get(self, *args, **kwargs):
+        if self.exception:
+            raise self.exception
+        return self.value
+    
+    def ready(self):
+        return True
+
+
 def render_test_html_file(response: HttpResponse, url: str):
     print("\nwriting url:", url)
     
@@ -2,11 +2,13 @@ import json
 from copy import copy
 from datetime import datetime
 from io import BytesIO
+from random import Random
 from typing import List
 from unittest.mock import MagicMock, patch
 
+from Cryptodome.Cipher import AES
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.db import models
+from django.db import IntegrityError, models
 from django.forms.fields import NullBooleanField
 from django.http.response import FileResponse, HttpResponse, HttpResponseRedirect
 from django.urls import reverse
@@ -14,6 +16,7 @@ from django.utils import timezone
 
 from api.tableau_api import FINAL_SERIALIZABLE_FIELDS
 from config.jinja2 import easy_url
+from config.settings import PRIVATE_KEY_CACHE_SECONDS
 from constants.celery_constants import (ANDROID_FIREBASE_CREDENTIALS, BACKEND_FIREBASE_CREDENTIALS,
     IOS_FIREBASE_CREDENTIALS)
 from constants.common_constants import API_DATE_FORMAT, BEIWE_PROJECT_ROOT
@@ -21,21 +24,26 @@ from constants.data_stream_constants import (ACCELEROMETER, ALL_DATA_STREAMS,
     COMPLETE_DATA_STREAM_DICT, SURVEY_TIMINGS)
 from constants.message_strings import (DEVICE_HAS_NO_REGISTERED_TOKEN, MESSAGE_SEND_FAILED_UNKNOWN,
     NEW_PASSWORD_8_LONG, NEW_PASSWORD_MISMATCH, NEW_PASSWORD_RULES_FAIL, PASSWORD_RESET_SUCCESS,
-    PUSH_NOTIFICATIONS_NOT_CONFIGURED, TABLEAU_API_KEY_IS_DISABLED, TABLEAU_NO_MATCHING_API_KEY,
-    WRONG_CURRENT_PASSWORD)
+    PUSH_NOTIFICATIONS_NOT_CONFIGURED, S3_FILE_PATH_UNIQUE_CONSTRAINT_ERROR_1,
+    TABLEAU_API_KEY_IS_DISABLED, TABLEAU_NO_MATCHING_API_KEY, WRONG_CURRENT_PASSWORD)
 from constants.testing_constants import (ADMIN_ROLES, ALL_TESTING_ROLES, ANDROID_CERT, BACKEND_CERT,
     IOS_CERT)
 from constants.user_constants import ALL_RESEARCHER_TYPES, IOS_API, ResearcherRole
-from database.data_access_models import ChunkRegistry, FileToProcess
+from database.data_access_models import ChunkRegistry, FileToProcess, PendingUpload, RawUploadPath
+from database.profiling_models import EncryptionErrorMetadata, LineEncryptionError
 from database.schedule_models import ArchivedEvent, Intervention
 from database.security_models import ApiKey
 from database.study_models import DeviceSettings, Study, StudyField
 from database.survey_models import Survey
 from database.system_models import FileAsText, GenericEvent
 from database.user_models import Participant, ParticipantFCMHistory, Researcher
+from libs import s3
 from libs.copy_study import format_study
+from libs.encryption import decrypted_key_cache, DeviceDataDecryptor, raw_rsa_decrypt
 from libs.rsa import get_RSA_cipher
-from libs.security import generate_easy_alphanumeric_string
+from libs.security import encode_base64, generate_easy_alphanumeric_string
+from libs.participant_file_uploads import ingest_pending_upload
+from services.celery_data_processing import create_upload_ingestion_tasks
 from tests.common import (BasicSessionTestCase, CommonTestCase, DataApiTest, ParticipantSessionTest,
     RedirectSessionApiTest, ResearcherSessionTest, SmartRequestsTestCase)
 from tests.helpers import DummyThreadPool
@@ -1582,12 +1590,14 @@ class TestResetDevice(RedirectSessionApiTest):
     def test_success(self):
         self.default_participant.update(device_id="12345")
         self.set_session_study_relation(ResearcherRole.researcher)
+        s3.private_key_cache[self.default_participant.patient_id] = ("a_private_key", float("inf"))
         self.smart_post(patient_id=self.default_participant.patient_id,
                         study_id=self.session_study.id)
         self.assert_present("device was reset; password is untouched",
                             self.get_redirect_content(self.session_study.id))
         self.default_participant.refresh_from_db()
         self.assertEqual(self.default_participant.device_id, "")
+        self.assertNotIn(self.default_participant.patient_id, s3.private_key_cache)
 
 
 class TestUnregisterParticipant(RedirectSessionApiTest):
@@ -2545,6 +2555,189 @@ class TestMobileUpload(ParticipantSessionTest):
             GenericEvent.objects.get().note
         )
     # TODO: add invalid decrypted key length test...
+    
+    @patch("libs.s3.monotonic")
+    @patch("libs.s3.s3_retrieve")
+    def test_private_key_cache(self, s3_retrieve: MagicMock, monotonic: MagicMock):
+        with open(f"{BEIWE_PROJECT_ROOT}/tests/files/private_key", 'rb') as f:
+            s3_retrieve.return_value = f.read()
+        monotonic.return_value = 1000
+        s3.private_key_cache.clear()
+        self.session_participant.get_private_key()
+        self.session_participant.get_private_key()
+        self.assertEqual(s3_retrieve.call_count, 1)
+        # invalidated, and expired
+        s3.invalidate_client_private_key(self.session_participant.patient_id)
+        self.session_participant.get_private_key()
+        monotonic.return_value = 1000 + PRIVATE_KEY_CACHE_SECONDS
+        self.session_participant.get_private_key()
+        self.assertEqual(s3_retrieve.call_count, 3)
+        s3.private_key_cache.clear()
+    
+    @patch("database.user_models.Participant.get_private_key")
+    def test_decrypted_key_cache(self, get_private_key: MagicMock):
+        get_private_key.return_value = self.PRIVATE_KEY
+        decrypted_key_cache.clear()
+        self.addCleanup(decrypted_key_cache.clear)
+        with patch("libs.encryption.raw_rsa_decrypt", wraps=raw_rsa_decrypt) as rsa_decrypt:
+            for _ in range(2):
+                DeviceDataDecryptor("whatever.csv", self.encrypted_header_file, self.session_participant)
+            self.assertEqual(rsa_decrypt.call_count, 1)
+            # after the participant's key pair is replaced the key is decrypted again. (a stand-in
+            # for the new private key, the decryption itself is done with the old one.)
+            get_private_key.return_value = MagicMock(n=self.PRIVATE_KEY.n + 1)
+            rsa_decrypt.side_effect = lambda ciphertext, _: raw_rsa_decrypt(ciphertext, self.PRIVATE_KEY)
+            decryptor = DeviceDataDecryptor(
+                "whatever.csv", self.encrypted_header_file, self.session_participant
+            )
+            self.assertEqual(rsa_decrypt.call_count, 2)
+        self.assertEqual(decryptor.good_lines, [b"timestamp,accuracy,x,y,z"])
+    
+    @patch("database.user_models.Participant.get_private_key")
+    def test_batched_line_decryption(self, get_private_key: MagicMock):
+        get_private_key.return_value = self.PRIVATE_KEY
+        aes_key = b"0123456789abcdef"
+        key = self.PUBLIC_KEY
+        wrapped_key = pow(int.from_bytes(encode_base64(aes_key), "big"), key.e, key.n)
+        
+        def encrypt_line(row: bytes, iv: bytes = b"fedcba9876543210") -> bytes:
+            padding_length = 16 - len(row) % 16
+            row += bytes([padding_length]) * padding_length
+            ciphertext = AES.new(aes_key, mode=AES.MODE_CBC, IV=iv).encrypt(row)
+            return encode_base64(iv) + b":" + encode_base64(ciphertext)
+        
+        lines = [
+            encode_base64(wrapped_key.to_bytes(key.size_in_bytes(), "big")),
+            encrypt_line(b"timestamp,accuracy,x,y,z"),
+            encrypt_line(b"1600000000000,unknown,1.0,1.5,-2.25", iv=b"0" * 16),
+            b"not a line",  # malformed
+            encrypt_line(b"1600000000001,unknown,1.0,1.5,-2.25"[:32]),  # a full block of padding
+            encode_base64(b"short") + b":" + encrypt_line(b"1600000000002").split(b":")[1],  # no iv
+            encrypt_line(b"1600000000003,unknown,1.0,1.5,-2.25") + b"AAAA",  # partial block
+        ]
+        decryptor = DeviceDataDecryptor("whatever.csv", b"\n".join(lines), self.session_participant)
+        self.assertEqual(
+            decryptor.good_lines,
+            [
+                b"timestamp,accuracy,x,y,z",
+                b"1600000000000,unknown,1.0,1.5,-2.25",
+                b"1600000000001,unknown,1.0,1.5,-2.25"[:32],
+                b"1600000000003,unknown,1.0,1.5,-2.25",
+            ]
+        )
+        self.assertEqual(decryptor.error_types, [LineEncryptionError.MALFORMED_CONFIG, LineEncryptionError.IV_MISSING])
+        self.assertEqual(EncryptionErrorMetadata.objects.get().number_errors, 2)
+    
+    @property
+    def encrypted_header_file(self) -> bytes:
+        """ An uploaded file that decrypts to b"timestamp,accuracy,x,y,z" """
+        aes_key = b"0123456789abcdef"
+        wrapped_key = pow(int.from_bytes(encode_base64(aes_key), "big"), self.PUBLIC_KEY.e, self.PUBLIC_KEY.n)
+        iv = b"fedcba9876543210"
+        row = b"timestamp,accuracy,x,y,z" + b"\x08" * 8
+        return encode_base64(wrapped_key.to_bytes(self.PUBLIC_KEY.size_in_bytes(), "big")) \
+            + b"\n" + encode_base64(iv) + b":" \
+            + encode_base64(AES.new(aes_key, mode=AES.MODE_CBC, IV=iv).encrypt(row))
+    
+    @patch("api.mobile_api.ASYNC_UPLOAD_INGESTION", True)
+    @patch("libs.participant_file_uploads.smart_s3_list_study_files")
+    @patch("libs.participant_file_uploads.s3_retrieve")
+    @patch("libs.participant_file_uploads.s3_upload")
+    @patch("database.user_models.Participant.get_private_key")
+    def test_async_upload_ingestion(
+        self, get_private_key: MagicMock, s3_upload: MagicMock, s3_retrieve: MagicMock,
+        smart_s3_list_study_files: MagicMock,
+    ):
+        get_private_key.return_value = self.PRIVATE_KEY
+        smart_s3_list_study_files.return_value = []
+        s3_files = {}
+        s3_upload.side_effect = lambda path, contents, *args, **kwargs: s3_files.update({path: contents})
+        s3_retrieve.side_effect = lambda path, *args, **kwargs: s3_files[path]
+        
+        file_contents = self.encrypted_header_file
+        file_name = f"{self.session_participant.patient_id}_accel_1600000000000.csv"
+        
+        # the endpoint only stores the encrypted file, a second upload of it has to wait.
+        self.smart_post_status_code(200, file_name=file_name, file=file_contents.decode())
+        self.assert_no_files_to_process
+        pending_upload = PendingUpload.objects.get()
+        self.assertEqual(s3_files[pending_upload.s3_path], file_contents)
+        self.smart_post_status_code(400, file_name=file_name, file=file_contents.decode())
+        
+        create_upload_ingestion_tasks()
+        self.assertFalse(PendingUpload.objects.exists())
+        self.assert_one_file_to_process
+        self.assertEqual(
+            s3_files[file_name.replace("_", "/")], b"timestamp,accuracy,x,y,z"
+        )
+    
+    @patch("libs.participant_file_uploads.RAW_UPLOAD_PATH_INDEX", True)
+    @patch("libs.participant_file_uploads.s3_retrieve")
+    @patch("libs.participant_file_uploads.s3_upload")
+    @patch("database.user_models.Participant.get_private_key")
+    def test_async_upload_ingestion_retry(
+        self, get_private_key: MagicMock, s3_upload: MagicMock, s3_retrieve: MagicMock
+    ):
+        get_private_key.return_value = self.PRIVATE_KEY
+        s3_retrieve.return_value = self.encrypted_header_file
+        s3_file_path = f"{self.session_participant.patient_id}/accel/1600000000000.csv"
+        pending_upload = PendingUpload.objects.create(
+            participant=self.session_participant,
+            file_path=s3_file_path,
+            s3_path="PENDING_UPLOADS/" + s3_file_path,
+            file_size=len(self.encrypted_header_file),
+        )
+        
+        # the FileToProcess is created concurrently after the decrypted file was uploaded.
+        with patch("libs.participant_file_uploads.FileToProcess.append_file_for_processing") as append:
+            append.side_effect = IntegrityError(S3_FILE_PATH_UNIQUE_CONSTRAINT_ERROR_1)
+            self.assertFalse(ingest_pending_upload(pending_upload))
+        pending_upload = PendingUpload.objects.get()
+        self.assertEqual(pending_upload.decrypted_file_path, s3_file_path)
+        
+        # the retry doesn't upload the file again (as a renamed duplicate).
+        self.assertTrue(ingest_pending_upload(pending_upload))
+        self.assertEqual(s3_upload.call_count, 1)
+        self.assertEqual(s3_upload.call_args[0][0], s3_file_path)
+        self.assertFalse(PendingUpload.objects.exists())
+        self.assertEqual(
+            FileToProcess.objects.get().s3_file_path, f"{self.session_study.object_id}/{s3_file_path}"
+        )
+        self.assertEqual(FileToProcess.objects.get().file_size, len(b"timestamp,accuracy,x,y,z"))
+    
+    @patch("libs.participant_file_uploads.RAW_UPLOAD_PATH_INDEX", True)
+    @patch("libs.participant_file_uploads.smart_s3_list_study_files")
+    @patch("libs.participant_file_uploads.s3_upload")
+    @patch("database.user_models.Participant.get_private_key")
+    def test_raw_upload_path_index(
+        self, get_private_key: MagicMock, s3_upload: MagicMock, smart_s3_list_study_files: MagicMock
+    ):
+        get_private_key.return_value = self.PRIVATE_KEY
+        file_name = f"{self.session_participant.patient_id}_accel_1600000000000.csv"
+        s3_file_path = file_name.replace("_", "/")
+        self.smart_post_status_code(200, file_name=file_name, file=self.encrypted_header_file.decode())
+        self.assertEqual(s3_upload.call_args[0][0], s3_file_path)
+        self.assertEqual(
+            RawUploadPath.objects.get().s3_file_path, f"{self.session_study.object_id}/{s3_file_path}"
+        )
+        
+        # a second upload is a duplicate, found without listing files on s3.
+        FileToProcess.objects.all().delete()
+        self.smart_post_status_code(200, file_name=file_name, file=self.encrypted_header_file.decode())
+        self.assertTrue(s3_upload.call_args[0][0].startswith(s3_file_path + "-duplicate-"))
+        self.assertEqual(RawUploadPath.objects.count(), 1)
+        smart_s3_list_study_files.assert_not_called()
+    
+    def test_raw_rsa_decrypt(self):
+        # the chinese remainder theorem implementation matches the plain math, including for
+        # (invalid) values larger than the modulus.
+        key = self.PRIVATE_KEY
+        size = key.size_in_bytes()
+        for ciphertext in [b"\x01", Random(0).getrandbits(size * 8).to_bytes(size, 'big'), b"\xff" * size]:
+            self.assertEqual(
+                raw_rsa_decrypt(ciphertext, key),
+                pow(int.from_bytes(ciphertext, 'big'), key.d, key.n).to_bytes(size, 'big'),
+            )
 
 
 class TestGraph(ParticipantSessionTest):
@@ -0,0 +1,711 @@
+import os
+from datetime import timedelta
+from random import Random
+from multiprocessing.pool import ThreadPool
+from tempfile import TemporaryDirectory
+from threading import Event
+from unittest import skipUnless
+from unittest.mock import patch
+
+from cronutils.error_handler import BundledError, ErrorHandler
+from django.utils import timezone
+
+from constants.data_processing_constants import CHUNK_DELTAS_FOLDER
+from constants.data_stream_constants import ACCELEROMETER, GPS, GYRO
+from database.data_access_models import (ChunkDelta, ChunkRegistry, FileProcessingLock,
+    FileToProcess)
+from database.tableau_api_models import SummaryStatisticDaily
+from libs.file_processing.chunk_cache import cache_chunk, cache_entry_path, get_cached_chunk
+from libs.file_processing.chunk_deltas import add_delta_segments, with_delta_paths
+from libs.file_processing.csv_merger import construct_s3_chunk_path
+from libs.file_processing.data_qty_stats import calculate_data_quantity_stats
+from libs.file_processing.file_for_processing import SomeException
+from libs.file_processing.file_processing_core import (binify_csv_rows, create_parse_pool,
+    do_process_user_file_chunks, memory_budgeted_page_size, PipelineStats, process_one_file)
+from libs.file_processing.utility_functions_csvs import (construct_csv_string, csv_to_list,
+    unix_time_to_string)
+from libs.file_processing.utility_functions_simple import (convert_unix_to_human_readable_timestamps,
+    merge_rows_into_chunk_lines, sort_by_timestamp, split_chunk_lines)
+from libs.file_processing.vectorized_binification import (binify_csv_contents,
+    vectorized_binification_available)
+from services.celery_data_processing import (create_chunk_compaction_tasks,
+    create_file_processing_tasks, get_memory_usage_mb, get_work_unit_backlogs,
+    recycle_worker_process)
+from tests.common import CommonTestCase
+from tests.helpers import DummyThreadPool
+
+
+# 2020-09-13T12:26:40 UTC, the accelerometer rows below are spread across 2 hours from here.
+SOME_TIMESTAMP_MS = 1600000000000
+ANDROID_ACCELEROMETER_HEADER = b"timestamp,accuracy,x,y,z"
+
+
+class FileProcessingTestCase(CommonTestCase):
+    """ Runs the chunking code against an in-memory dictionary instead of S3.  (The S3 functions
+    handle encryption, so this dictionary contains plaintext.) """
+    
+    def setUp(self) -> None:
+        self.s3_contents = {}
+        
+        def fake_s3_retrieve(key_path, obj, raw_path=False, number_retries=3):
+            return self.s3_contents[key_path]
+        
+        def fake_s3_upload(key_path, data_string, obj, raw_path=False):
+            self.s3_contents[key_path] = data_string
+        
+        def fake_s3_get_size(key_path, obj, raw_path=False):
+            return len(self.s3_contents[key_path])
+        
+        patchers = [
+            patch("libs.file_processing.file_for_processing.s3_retrieve", fake_s3_retrieve),
+            patch("libs.file_processing.file_for_processing.s3_get_size", fake_s3_get_size),
+            patch("libs.file_processing.csv_merger.s3_retrieve", fake_s3_retrieve),
+            patch("libs.file_processing.batched_network_operations.s3_upload", fake_s3_upload),
+            patch("libs.file_processing.chunk_deltas.s3_retrieve", fake_s3_retrieve),
+            patch("libs.file_processing.chunk_deltas.s3_upload", fake_s3_upload),
+            patch("libs.s3.s3_retrieve", fake_s3_retrieve),  # (ChunkRegistry.s3_retrieve)
+            patch("libs.file_processing.file_processing_core.ThreadPool", DummyThreadPool),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return super().setUp()
+    
+    def upload_file(self, data_stream_folder: str, timestamp_ms: int, contents: bytes) -> FileToProcess:
+        path = f"{self.session_study.object_id}/{self.default_participant.patient_id}/" \
+               f"{data_stream_folder}/{timestamp_ms}.csv"
+        self.s3_contents[path] = contents
+        return self.generate_file_to_process(path, os_type=self.default_participant.os_type)
+    
+    def upload_sized_file(self, data_stream_folder: str, timestamp_ms: int, file_size: int) -> FileToProcess:
+        # the size is recorded at upload, the contents don't matter.
+        ftp = self.upload_file(data_stream_folder, timestamp_ms, b"")
+        ftp.file_size = file_size
+        ftp.save()
+        return ftp
+    
+    def process(self, page_size: int = 100, parse_pool=None) -> int:
+        error_handler = ErrorHandler()
+        _, failed_pks = do_process_user_file_chunks(
+            page_size, error_handler, 0, self.default_participant, parse_pool=parse_pool
+        )
+        error_handler.raise_errors()
+        return len(failed_pks)
+    
+    def chunk_contents(self, timestamp_ms: int, data_stream: str = ACCELEROMETER) -> bytes:
+        return self.s3_contents[self.chunk_path(timestamp_ms, data_stream)]
+    
+    def chunk_path(self, timestamp_ms: int, data_stream: str = ACCELEROMETER) -> str:
+        return construct_s3_chunk_path(
+            self.session_study.object_id,
+            self.default_participant.patient_id,
+            data_stream,
+            timestamp_ms // 1000 // 3600,
+        )
+    
+    @staticmethod
+    def accelerometer_file(*timestamps_ms: int) -> bytes:
+        return ANDROID_ACCELEROMETER_HEADER + b"\n" + b"\n".join(
+            b"%d,unknown,%d.0,1.5,-2.25" % (t, i) for i, t in enumerate(timestamps_ms)
+        )
+
+
+class TestChunking(FileProcessingTestCase):
+    
+    def test_new_chunks(self):
+        hour_1 = SOME_TIMESTAMP_MS
+        hour_2 = SOME_TIMESTAMP_MS + 3600 * 1000
+        self.upload_file("accel", hour_1, self.accelerometer_file(hour_1 + 1, hour_1, hour_2))
+        self.assertEqual(self.process(), 0)
+        
+        self.assertEqual(FileToProcess.objects.count(), 0)
+        self.assertEqual(ChunkRegistry.objects.count(), 2)
+        self.assertEqual(
+            self.chunk_contents(hour_1),
+            b"timestamp,UTC time,accuracy,x,y,z\n"
+            b"1600000000000,2020-09-13T12:26:40.000,unknown,1.0,1.5,-2.25\n"
+            b"1600000000001,2020-09-13T12:26:40.001,unknown,0.0,1.5,-2.25"
+        )
+        self.assertEqual(
+            self.chunk_contents(hour_2),
+            b"timestamp,UTC time,accuracy,x,y,z\n"
+            b"1600003600000,2020-09-13T13:26:40.000,unknown,2.0,1.5,-2.25"
+        )
+        chunk = ChunkRegistry.objects.get(chunk_path=self.chunk_path(hour_2))
+        self.assertEqual(chunk.file_size, len(self.chunk_contents(hour_2)))
+        self.assertTrue(chunk.is_chunkable)
+    
+    def test_merge_into_existing_chunk(self):
+        self.upload_file("accel", SOME_TIMESTAMP_MS, self.accelerometer_file(SOME_TIMESTAMP_MS + 5))
+        self.process()
+        chunk = ChunkRegistry.objects.get()
+        original_hash = chunk.chunk_hash
+        
+        # a later upload containing a duplicate of the existing row and an earlier row.
+        self.upload_file(
+            "accel", SOME_TIMESTAMP_MS + 10, self.accelerometer_file(SOME_TIMESTAMP_MS + 5, SOME_TIMESTAMP_MS)
+        )
+        self.assertEqual(self.process(), 0)
+        
+        self.assertEqual(FileToProcess.objects.count(), 0)
+        chunk = ChunkRegistry.objects.get()
+        self.assertNotEqual(chunk.chunk_hash, original_hash)
+        self.assertEqual(
+            self.chunk_contents(SOME_TIMESTAMP_MS),
+            b"timestamp,UTC time,accuracy,x,y,z\n"
+            b"1600000000000,2020-09-13T12:26:40.000,unknown,1.0,1.5,-2.25\n"
+            b"1600000000005,2020-09-13T12:26:40.005,unknown,0.0,1.5,-2.25"
+        )
+        self.assertEqual(chunk.file_size, len(self.chunk_contents(SOME_TIMESTAMP_MS)))
+    
+    def test_data_quantity_stats(self):
+        hour_1 = SOME_TIMESTAMP_MS
+        hour_2 = SOME_TIMESTAMP_MS + 3600 * 1000
+        self.upload_file("accel", hour_1, self.accelerometer_file(hour_1, hour_2))
+        self.process()
+        self.upload_file("accel", hour_1 + 10, self.accelerometer_file(hour_1, hour_1 + 5, hour_2 + 5))
+        self.process()
+        
+        # both hours are on the same day, which has the total size of the chunks after the merge.
+        stats = SummaryStatisticDaily.objects.get(participant=self.default_participant)
+        self.assertEqual(
+            stats.beiwe_accelerometer_bytes,
+            sum(ChunkRegistry.objects.values_list("file_size", flat=True)),
+        )
+        self.assertIsNone(stats.beiwe_gps_bytes)
+    
+    @patch("libs.file_processing.csv_merger.CHUNK_DELTA_SEGMENTS", True)
+    def test_data_quantity_stats_with_delta_compaction(self):
+        hour_1 = SOME_TIMESTAMP_MS
+        hour_2 = SOME_TIMESTAMP_MS + 3600 * 1000
+        self.upload_file("accel", hour_1, self.accelerometer_file(hour_1, hour_2))
+        self.process()
+        # a duplicate row in each hour, the deltas are counted at their full size until compaction.
+        self.upload_file("accel", hour_1 + 10, self.accelerometer_file(hour_1, hour_1 + 5, hour_2))
+        self.process()
+        self.assertEqual(ChunkDelta.objects.count(), 2)
+        create_chunk_compaction_tasks()
+        self.assertFalse(ChunkDelta.objects.exists())
+        
+        incremental_bytes = SummaryStatisticDaily.objects.get().beiwe_accelerometer_bytes
+        calculate_data_quantity_stats(self.default_participant)
+        self.assertEqual(incremental_bytes, SummaryStatisticDaily.objects.get().beiwe_accelerometer_bytes)
+        self.assertEqual(incremental_bytes, sum(ChunkRegistry.objects.values_list("file_size", flat=True)))
+    
+    def test_failed_upload_keeps_only_its_files(self):
+        hour_1 = SOME_TIMESTAMP_MS
+        hour_2 = SOME_TIMESTAMP_MS + 3600 * 1000
+        self.upload_file("accel", hour_1, self.accelerometer_file(hour_1, hour_2))
+        
+        def s3_upload(key_path, data_string, obj, raw_path=False):
+            if key_path == self.chunk_path(hour_2):
+                raise ConnectionError("upload failed")
+            self.s3_contents[key_path] = data_string
+        
+        with patch("libs.file_processing.batched_network_operations.s3_upload", s3_upload):
+            with self.assertRaises(BundledError):
+                self.process()
+        # the chunk that was uploaded is saved, the file of the failed bin is retried later.
+        self.assertEqual(ChunkRegistry.objects.get().chunk_path, self.chunk_path(hour_1))
+        self.assertEqual(FileToProcess.objects.count(), 1)
+        hour_1_contents = self.chunk_contents(hour_1)
+        self.assertEqual(self.process(), 0)
+        self.assertEqual(ChunkRegistry.objects.count(), 2)
+        self.assertFalse(FileToProcess.objects.exists())
+        self.assertEqual(self.chunk_contents(hour_1), hour_1_contents)
+    
+    @patch("libs.file_processing.file_processing_core.CONCURRENT_NETWORK_OPS", 2)
+    def test_threaded_pipeline_with_failing_download(self):
+        # real thread pools, 2 download threads and 4 download slots for 6 files.
+        hours = [SOME_TIMESTAMP_MS + i * 3600 * 1000 for i in range(6)]
+        ftps = [self.upload_file("accel", hour, self.accelerometer_file(hour)) for hour in hours]
+        failing_paths = {ftps[1].s3_file_path}
+        second_thread_moved_on = Event()
+        
+        def s3_retrieve(key_path, obj, raw_path=False, number_retries=3):
+            # the first file finishes downloading after the second, the thread that downloaded the
+            # second file has moved on to the third.
+            if key_path == ftps[0].s3_file_path:
+                second_thread_moved_on.wait(5)
+            elif key_path == ftps[2].s3_file_path:
+                second_thread_moved_on.set()
+            if key_path in failing_paths:
+                raise ConnectionError("download failed")
+            return self.s3_contents[key_path]
+        
+        processed_pks = []
+        
+        def record_process_one_file(file_for_processing, *args, **kwargs):
+            processed_pks.append(file_for_processing.file_to_process.pk)
+            return process_one_file(file_for_processing, *args, **kwargs)
+        
+        with patch("libs.file_processing.file_processing_core.ThreadPool", ThreadPool), \
+                patch("libs.file_processing.file_for_processing.s3_retrieve", s3_retrieve), \
+                patch("libs.file_processing.file_processing_core.process_one_file", record_process_one_file):
+            # the failed download bails out of the page while the download threads are blocked on
+            # download slots, nothing is saved and every file is retried.
+            with self.assertRaises(SomeException):
+                self.process()
+            self.assertFalse(ChunkRegistry.objects.exists())
+            self.assertEqual(FileToProcess.objects.count(), 6)
+            self.assertEqual(processed_pks, [])
+            
+            failing_paths.clear()
+            second_thread_moved_on.clear()
+            self.assertEqual(self.process(), 0)
+        
+        # files are processed in the order their downloads finish, not in primary key order.
+        self.assertEqual(processed_pks[0], ftps[1].pk)
+        self.assertEqual(sorted(processed_pks), [ftp.pk for ftp in ftps])
+        self.assertFalse(FileToProcess.objects.exists())
+        self.assertEqual(ChunkRegistry.objects.count(), 6)
+        for hour in hours:
+            self.assertEqual(
+                self.chunk_contents(hour).splitlines()[1].split(b",")[0], str(hour).encode()
+            )
+    
+    @patch("config.settings.CHUNK_DELTA_SEGMENTS", True)
+    @patch("libs.file_processing.csv_merger.CHUNK_DELTA_SEGMENTS", True)
+    def test_delta_segments(self):
+        self.upload_file("accel", SOME_TIMESTAMP_MS, self.accelerometer_file(SOME_TIMESTAMP_MS + 5))
+        self.process()
+        chunk = ChunkRegistry.objects.get()
+        original_contents = self.chunk_contents(SOME_TIMESTAMP_MS)
+        original_hash = chunk.chunk_hash
+        
+        # same as test_merge_into_existing_chunk, but the chunk is not downloaded or changed.
+        self.upload_file(
+            "accel", SOME_TIMESTAMP_MS + 10, self.accelerometer_file(SOME_TIMESTAMP_MS + 5, SOME_TIMESTAMP_MS)
+        )
+        with patch("libs.file_processing.csv_merger.s3_retrieve") as s3_retrieve:
+            self.assertEqual(self.process(), 0)
+            s3_retrieve.assert_not_called()
+        self.assertEqual(self.chunk_contents(SOME_TIMESTAMP_MS), original_contents)
+        delta = ChunkDelta.objects.get()
+        self.assertTrue(delta.s3_path.startswith(CHUNK_DELTAS_FOLDER))
+        # bulk downloads look up the delta segments of many chunks in one query.
+        with self.assertNumQueries(2):
+            chunks = list(with_delta_paths(ChunkRegistry.objects.values("pk", "data_type")))
+        self.assertEqual(chunks[0]["delta_paths"], [delta.s3_path])
+        chunk = ChunkRegistry.objects.get()
+        self.assertNotEqual(chunk.chunk_hash, original_hash)
+        
+        merged_contents = (
+            b"timestamp,UTC time,accuracy,x,y,z\n"
+            b"1600000000000,2020-09-13T12:26:40.000,unknown,1.0,1.5,-2.25\n"
+            b"1600000000005,2020-09-13T12:26:40.005,unknown,0.0,1.5,-2.25"
+        )
+        self.assertEqual(
+            add_delta_segments(chunk.pk, original_contents, self.session_study), merged_contents
+        )
+        self.assertEqual(chunk.s3_retrieve(), merged_contents)
+        # with delta segments disabled chunk reads don't look for them.
+        with patch("config.settings.CHUNK_DELTA_SEGMENTS", False), self.assertNumQueries(0):
+            self.assertEqual(chunk.s3_retrieve(), original_contents)
+        create_chunk_compaction_tasks()
+        self.assertEqual(self.chunk_contents(SOME_TIMESTAMP_MS), merged_contents)
+        self.assertFalse(ChunkDelta.objects.exists())
+        chunk = ChunkRegistry.objects.get()
+        self.assertEqual(chunk.file_size, len(merged_contents))
+        self.assertEqual(
+            add_delta_segments(chunk.pk, merged_contents, self.session_study), merged_contents
+        )
+    
+    @patch("libs.file_processing.csv_merger.UNCOMPRESSED_UPLOAD_BUDGET_MB", 0)
+    def test_compressed_pending_uploads(self):
+        self.upload_file("accel", SOME_TIMESTAMP_MS, self.accelerometer_file(SOME_TIMESTAMP_MS))
+        self.assertEqual(self.process(), 0)
+        self.assertEqual(
+            self.chunk_contents(SOME_TIMESTAMP_MS),
+            b"timestamp,UTC time,accuracy,x,y,z\n"
+            b"1600000000000,2020-09-13T12:26:40.000,unknown,0.0,1.5,-2.25"
+        )
+    
+    def test_bad_timestamp_rows_are_dropped(self):
+        contents = self.accelerometer_file(SOME_TIMESTAMP_MS) + b"\n16000000000x0,unknown,1,2,3\n"
+        self.upload_file("accel", SOME_TIMESTAMP_MS, contents)
+        self.assertEqual(self.process(), 0)
+        self.assertEqual(
+            self.chunk_contents(SOME_TIMESTAMP_MS),
+            b"timestamp,UTC time,accuracy,x,y,z\n"
+            b"1600000000000,2020-09-13T12:26:40.000,unknown,0.0,1.5,-2.25"
+        )
+    
+    def test_unchunkable_files_are_not_downloaded(self):
+        # the size is recorded at upload, it isn't in s3 at all as far as this test is concerned.
+        tracked = self.upload_sized_file("voiceRecording", SOME_TIMESTAMP_MS, 1234)
+        del self.s3_contents[tracked.s3_file_path]
+        untracked = self.upload_file("voiceRecording", SOME_TIMESTAMP_MS + 1, b"x" * 100)
+        
+        with patch("libs.file_processing.file_for_processing.s3_retrieve") as s3_retrieve:
+            self.assertEqual(self.process(), 0)
+            s3_retrieve.assert_not_called()
+        self.assertEqual(FileToProcess.objects.count(), 0)
+        self.assertEqual(ChunkRegistry.objects.get(chunk_path=tracked.s3_file_path).file_size, 1234)
+        self.assertEqual(ChunkRegistry.objects.get(chunk_path=untracked.s3_file_path).file_size, 100)
+    
+    def test_failed_files_are_skipped(self):
+        hour_2 = SOME_TIMESTAMP_MS + 3600 * 1000
+        self.upload_file("accel", SOME_TIMESTAMP_MS, self.accelerometer_file(SOME_TIMESTAMP_MS))
+        self.process()
+        # the existing chunk is missing from s3, merging into it fails.
+        del self.s3_contents[self.chunk_path(SOME_TIMESTAMP_MS)]
+        bad = self.upload_file("accel", SOME_TIMESTAMP_MS + 1, self.accelerometer_file(SOME_TIMESTAMP_MS + 1))
+        good = self.upload_file("accel", hour_2, self.accelerometer_file(hour_2))
+        
+        # pages of 1 file, the second page starts after the failed file.
+        last_pk, failed_pks = do_process_user_file_chunks(1, ErrorHandler(), 0, self.default_participant)
+        self.assertEqual((last_pk, failed_pks), (bad.pk, {bad.pk}))
+        last_pk, failed_pks = do_process_user_file_chunks(1, ErrorHandler(), last_pk, self.default_participant)
+        self.assertEqual((last_pk, failed_pks), (good.pk, set()))
+        last_pk, failed_pks = do_process_user_file_chunks(1, ErrorHandler(), last_pk, self.default_participant)
+        self.assertEqual((last_pk, failed_pks), (None, set()))
+        self.assertEqual(list(FileToProcess.objects.values_list("pk", flat=True)), [bad.pk])
+    
+    @patch("libs.file_processing.file_processing_core.CONCURRENT_NETWORK_OPS", 1)
+    def test_pipeline_with_multiple_data_streams(self):
+        # more files than the queue limit, across two data streams with a shared hour.
+        for i in range(3):
+            self.upload_file("accel", SOME_TIMESTAMP_MS + i, self.accelerometer_file(SOME_TIMESTAMP_MS + i))
+            self.upload_file("gyro", SOME_TIMESTAMP_MS + i, self.accelerometer_file(SOME_TIMESTAMP_MS + i))
+        stats = PipelineStats()
+        _, failed_pks = do_process_user_file_chunks(100, ErrorHandler(), 0, self.default_participant, stats)
+        self.assertEqual(failed_pks, set())
+        self.assertEqual(FileToProcess.objects.count(), 0)
+        self.assertEqual(ChunkRegistry.objects.count(), 2)
+        self.assertEqual(stats.files_downloaded, 6)
+        self.assertEqual(stats.files_parsed, 6)
+        self.assertEqual(stats.chunks_uploaded, 2)
+        self.assertLessEqual(stats.max_download_queue_depth, 2)
+        self.assertEqual(self.chunk_contents(SOME_TIMESTAMP_MS, ACCELEROMETER).count(b"\n"), 3)
+        self.assertEqual(self.chunk_contents(SOME_TIMESTAMP_MS, GYRO).count(b"\n"), 3)
+    
+    @patch("libs.file_processing.file_processing_core.FILE_PARSING_PROCESSES", 2)
+    def test_worker_process_parsing(self):
+        hour_2 = SOME_TIMESTAMP_MS + 3600 * 1000
+        self.upload_file("accel", SOME_TIMESTAMP_MS, self.accelerometer_file(hour_2, SOME_TIMESTAMP_MS))
+        self.upload_file(
+            "gyro", SOME_TIMESTAMP_MS, self.accelerometer_file(SOME_TIMESTAMP_MS + 1, SOME_TIMESTAMP_MS)
+        )
+        self.upload_file("gyro", SOME_TIMESTAMP_MS + 1, ANDROID_ACCELEROMETER_HEADER)  # empty
+        parse_pool = create_parse_pool()
+        self.addCleanup(parse_pool.join)
+        self.addCleanup(parse_pool.terminate)
+        self.assertEqual(self.process(page_size=2, parse_pool=parse_pool), 0)
+        self.assertEqual(self.process(parse_pool=parse_pool), 0)
+        self.assertEqual(FileToProcess.objects.count(), 0)
+        self.assertEqual(ChunkRegistry.objects.count(), 3)
+        self.assertEqual(
+            self.chunk_contents(SOME_TIMESTAMP_MS),
+            b"timestamp,UTC time,accuracy,x,y,z\n"
+            b"1600000000000,2020-09-13T12:26:40.000,unknown,1.0,1.5,-2.25"
+        )
+        self.assertEqual(
+            self.chunk_contents(SOME_TIMESTAMP_MS, GYRO),
+            b"timestamp,UTC time,accuracy,x,y,z\n"
+            b"1600000000000,2020-09-13T12:26:40.000,unknown,1.0,1.5,-2.25\n"
+            b"1600000000001,2020-09-13T12:26:40.001,unknown,0.0,1.5,-2.25"
+        )
+    
+    def test_human_readable_timestamps(self):
+        timestamps = [
+            SOME_TIMESTAMP_MS, SOME_TIMESTAMP_MS + 59_999, SOME_TIMESTAMP_MS + 3600_000, 0, 999,
+            -1, -3600_001, 4102444799999,
+        ]
+        rows = [[b"%d" % t, b"a"] for t in timestamps]
+        header = convert_unix_to_human_readable_timestamps(b"timestamp,a", rows, timestamps)
+        self.assertEqual(header, b"timestamp,UTC time,a")
+        for row, t in zip(rows, timestamps):
+            reference = unix_time_to_string(t // 1000) + b".%03d" % (t % 1000)
+            self.assertEqual(row, [b"%d" % t, reference, b"a"])
+
+
+class TestChunkCache(FileProcessingTestCase):
+    
+    def setUp(self) -> None:
+        cache_directory = TemporaryDirectory()
+        self.addCleanup(cache_directory.cleanup)
+        for patcher in [
+            patch("libs.file_processing.chunk_cache.CHUNK_CACHE_DIRECTORY", cache_directory.name),
+            patch("libs.file_processing.chunk_cache.CHUNK_CACHE_MB", 1),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return super().setUp()
+    
+    def test_merge_uses_cache(self):
+        self.upload_file("accel", SOME_TIMESTAMP_MS, self.accelerometer_file(SOME_TIMESTAMP_MS + 5))
+        self.process()
+        self.upload_file("accel", SOME_TIMESTAMP_MS + 10, self.accelerometer_file(SOME_TIMESTAMP_MS))
+        with patch("libs.file_processing.csv_merger.s3_retrieve") as s3_retrieve:
+            self.assertEqual(self.process(), 0)
+            s3_retrieve.assert_not_called()
+        self.assertEqual(
+            self.chunk_contents(SOME_TIMESTAMP_MS),
+            b"timestamp,UTC time,accuracy,x,y,z\n"
+            b"1600000000000,2020-09-13T12:26:40.000,unknown,0.0,1.5,-2.25\n"
+            b"1600000000005,2020-09-13T12:26:40.005,unknown,0.0,1.5,-2.25"
+        )
+        chunk = ChunkRegistry.objects.get()
+        self.assertEqual(
+            get_cached_chunk(chunk.chunk_path, chunk.chunk_hash), self.chunk_contents(SOME_TIMESTAMP_MS)
+        )
+    
+    def test_outdated_entry(self):
+        self.upload_file("accel", SOME_TIMESTAMP_MS, self.accelerometer_file(SOME_TIMESTAMP_MS + 5))
+        self.process()
+        # e.g. the chunk was updated on another server.
+        ChunkRegistry.objects.update(chunk_hash="something else")
+        self.assertIsNone(get_cached_chunk(self.chunk_path(SOME_TIMESTAMP_MS), "something else"))
+        self.upload_file("accel", SOME_TIMESTAMP_MS + 10, self.accelerometer_file(SOME_TIMESTAMP_MS))
+        self.assertEqual(self.process(), 0)
+        self.assertEqual(self.chunk_contents(SOME_TIMESTAMP_MS).count(b"\n"), 2)
+    
+    def test_least_recently_used_eviction(self):
+        # random data doesn't compress, 3 of these don't fit in 1MB.
+        contents = {path: os.urandom(400 * 1024) for path in ("a", "b", "c")}
+        cache_chunk("a", "hash", contents["a"])
+        cache_chunk("b", "hash", contents["b"])
+        os.utime(cache_entry_path("a"), (1, 1))
+        os.utime(cache_entry_path("b"), (2, 2))
+        self.assertEqual(get_cached_chunk("a", "hash"), contents["a"])
+        cache_chunk("c", "hash", contents["c"])
+        self.assertEqual(get_cached_chunk("a", "hash"), contents["a"])
+        self.assertIsNone(get_cached_chunk("b", "hash"))
+        self.assertEqual(get_cached_chunk("c", "hash"), contents["c"])
+
+
+class TestPageSizing(FileProcessingTestCase):
+    
+    @patch("libs.file_processing.file_processing_core.FILE_PROCESS_PAGE_BUDGET_MB", 1)
+    def test_large_files(self):
+        ftps = [self.upload_sized_file("accel", SOME_TIMESTAMP_MS + i, 400 * 1024) for i in range(4)]
+        # the sizes come from the files to process themselves.
+        with self.assertNumQueries(1):
+            self.assertEqual(memory_budgeted_page_size(self.default_participant, 0), 2)
+        self.assertEqual(memory_budgeted_page_size(self.default_participant, ftps[2].pk), 1)
+    
+    @patch("libs.file_processing.file_processing_core.FILE_PROCESS_PAGE_BUDGET_MB", 1)
+    @patch("libs.file_processing.file_processing_core.FILE_PROCESS_MAX_PAGE_SIZE", 5)
+    def test_small_files(self):
+        ftps = [self.upload_sized_file("powerState", SOME_TIMESTAMP_MS + i, 1024) for i in range(6)]
+        self.assertEqual(memory_budgeted_page_size(self.default_participant, 0), 5)
+        self.assertEqual(memory_budgeted_page_size(self.default_participant, ftps[-1].pk), 1)
+    
+    @patch("libs.file_processing.file_processing_core.FILE_PROCESS_PAGE_BUDGET_MB", 1)
+    @patch("libs.file_processing.file_processing_core.FILE_PROCESS_PAGE_SIZE", 2)
+    def test_untracked_files(self):
+        for i in range(3):
+            self.upload_file("accel", SOME_TIMESTAMP_MS + i, b"")
+        self.assertEqual(memory_budgeted_page_size(self.default_participant, 0), 2)
+    
+    @patch("libs.file_processing.file_processing_core.FILE_PROCESS_PAGE_BUDGET_MB", 0)
+    @patch("libs.file_processing.file_processing_core.FILE_PROCESS_PAGE_SIZE", 7)
+    def test_budget_disabled(self):
+        self.upload_sized_file("accel", SOME_TIMESTAMP_MS, 400 * 1024 * 1024)
+        self.assertEqual(memory_budgeted_page_size(self.default_participant, 0), 7)
+
+
+class TestWorkUnits(FileProcessingTestCase):
+    
+    def test_populate_data_types(self):
+        accel = self.upload_file("accel", SOME_TIMESTAMP_MS, b"")
+        unknown = self.upload_file("not_a_data_stream", SOME_TIMESTAMP_MS, b"")
+        FileToProcess.populate_data_types()
+        accel.refresh_from_db()
+        unknown.refresh_from_db()
+        self.assertEqual(accel.data_type, ACCELEROMETER)
+        self.assertEqual(unknown.data_type, "")
+    
+    def test_lock(self):
+        participant_id = self.default_participant.pk
+        self.assertTrue(FileProcessingLock.acquire(participant_id, ACCELEROMETER))
+        self.assertFalse(FileProcessingLock.acquire(participant_id, ACCELEROMETER))
+        self.assertTrue(FileProcessingLock.acquire(participant_id, GYRO))
+        FileProcessingLock.release(participant_id, ACCELEROMETER)
+        self.assertTrue(FileProcessingLock.acquire(participant_id, ACCELEROMETER))
+        # a lock left over from a killed task expires.
+        FileProcessingLock.objects.filter(data_type=GYRO).update(
+            created_on=timezone.now() - FileProcessingLock.EXPIRY - timedelta(seconds=1)
+        )
+        self.assertTrue(FileProcessingLock.acquire(participant_id, GYRO))
+    
+    def test_create_file_processing_tasks(self):
+        # (celery is not running in tests, tasks run immediately)
+        self.upload_file("accel", SOME_TIMESTAMP_MS, self.accelerometer_file(SOME_TIMESTAMP_MS))
+        self.upload_file("gyro", SOME_TIMESTAMP_MS, self.accelerometer_file(SOME_TIMESTAMP_MS))
+        FileProcessingLock.acquire(self.default_participant.pk, GYRO)
+        create_file_processing_tasks()
+        
+        # the gyro files are locked by another task.
+        self.assertEqual(list(FileToProcess.objects.values_list("data_type", flat=True)), [GYRO])
+        self.assertEqual(ChunkRegistry.objects.get().data_type, ACCELEROMETER)
+        self.assertEqual(list(FileProcessingLock.objects.values_list("data_type", flat=True)), [GYRO])
+    
+    @patch("libs.file_processing.file_processing_core.FILE_PROCESS_PAGE_BUDGET_MB", 0)
+    @patch("libs.file_processing.file_processing_core.FILE_PROCESS_PAGE_SIZE", 1)
+    def test_uploads_overlap_next_page(self):
+        # pages of 1 file, real thread pools.
+        hours = [SOME_TIMESTAMP_MS, SOME_TIMESTAMP_MS + 3600 * 1000]
+        ftps = [self.upload_file("accel", hour, self.accelerometer_file(hour)) for hour in hours]
+        first_upload_started = Event()
+        last_download_started = Event()
+        downloading_while_uploading = []
+        
+        def s3_retrieve(key_path, obj, raw_path=False, number_retries=3):
+            if key_path == ftps[1].s3_file_path:
+                last_download_started.set()
+                first_upload_started.wait(5)
+            return self.s3_contents[key_path]
+        
+        def s3_upload(key_path, data_string, obj, raw_path=False):
+            if not first_upload_started.is_set():
+                first_upload_started.set()
+                downloading_while_uploading.append(last_download_started.wait(5))
+            self.s3_contents[key_path] = data_string
+        
+        with patch("libs.file_processing.file_processing_core.ThreadPool", ThreadPool), \
+                patch("libs.file_processing.file_for_processing.s3_retrieve", s3_retrieve), \
+                patch("libs.file_processing.batched_network_operations.s3_upload", s3_upload):
+            create_file_processing_tasks()
+        
+        # the first page's upload was still running when the second page's download started.
+        self.assertEqual(downloading_while_uploading, [True])
+        self.assertFalse(FileToProcess.objects.exists())
+        self.assertEqual(ChunkRegistry.objects.count(), 2)
+        for hour in hours:
+            self.assertEqual(
+                self.chunk_contents(hour).splitlines()[1].split(b",")[0], str(hour).encode()
+            )
+
+    def test_work_unit_backlogs(self):
+        now = timezone.now()
+        for data_stream_folder, hours_waiting, file_sizes in [
+            ("accel", 2, [1024]),
+            ("gyro", 3, [10 * 1024**3, None]),  # a large backlog waits longer.
+            ("gps", 1, [None]),
+        ]:
+            for i, file_size in enumerate(file_sizes):
+                ftp = self.upload_file(data_stream_folder, SOME_TIMESTAMP_MS + i, b"")
+                FileToProcess.objects.filter(pk=ftp.pk).update(
+                    created_on=now - timedelta(hours=hours_waiting), file_size=file_size
+                )
+        FileToProcess.populate_data_types()
+        backlogs = get_work_unit_backlogs()
+        self.assertEqual([backlog["data_type"] for backlog in backlogs], [ACCELEROMETER, GPS, GYRO])
+        self.assertEqual([backlog["file_count"] for backlog in backlogs], [1, 1, 2])
+        # files with unknown sizes are counted as the average size.
+        self.assertEqual([backlog["backlog_bytes"] for backlog in backlogs], [1024, 0, 20 * 1024**3])
+    
+    @patch("services.celery_data_processing.get_processing_worker_slots", lambda: 1)
+    def test_create_file_processing_tasks_worker_slots(self):
+        accel = self.upload_file("accel", SOME_TIMESTAMP_MS, self.accelerometer_file(SOME_TIMESTAMP_MS))
+        self.upload_file("gyro", SOME_TIMESTAMP_MS, self.accelerometer_file(SOME_TIMESTAMP_MS))
+        FileToProcess.objects.filter(pk=accel.pk).update(created_on=timezone.now() - timedelta(hours=1))
+        create_file_processing_tasks()
+        # only the longest waiting data was queued.
+        self.assertEqual(list(FileToProcess.objects.values_list("data_type", flat=True)), [GYRO])
+        self.assertEqual(ChunkRegistry.objects.get().data_type, ACCELEROMETER)
+
+
+@patch("services.celery_data_processing.DATA_PROCESSING_WORKER_MAX_TASKS", 3)
+@patch("services.celery_data_processing.DATA_PROCESSING_WORKER_MAX_MB", 100000)
+class TestWorkerRecycling(CommonTestCase):
+    
+    def recycles(self, tasks_run: int) -> bool:
+        with patch("services.celery_data_processing.tasks_run_by_this_process", tasks_run), \
+                patch("services.celery_data_processing.exit", create=True) as exit:
+            recycle_worker_process()
+        return exit.called
+    
+    def test_reused(self):
+        self.assertFalse(self.recycles(2))
+    
+    def test_task_limit(self):
+        self.assertTrue(self.recycles(3))
+    
+    @skipUnless(get_memory_usage_mb(), "memory usage is not available on this platform")
+    def test_memory_limit(self):
+        with patch("services.celery_data_processing.DATA_PROCESSING_WORKER_MAX_MB", 1):
+            self.assertTrue(self.recycles(1))
+
+
+class TestChunkMerge(CommonTestCase):
+    
+    @staticmethod
+    def reference_merge(chunk: bytes, new_rows: list) -> bytes:
+        # concatenate, sort everything, deduplicate everything.
+        header, old_rows = csv_to_list(chunk)
+        rows = list(old_rows) + new_rows
+        rows.sort(key=lambda row: int(row[0]))
+        return construct_csv_string(header, rows)
+    
+    def test_matches_full_sort(self):
+        random = Random(0)
+        for _ in range(50):
+            old_rows = [[b"%d" % random.randrange(100), b"%d" % random.randrange(3)] for _ in range(40)]
+            old_rows.sort(key=lambda row: int(row[0]))
+            chunk = construct_csv_string(b"timestamp,value", old_rows)
+            new_rows = [[b"%d" % random.randrange(50, 150), b"%d" % random.randrange(3)] for _ in range(20)]
+            
+            header, lines, timestamps = split_chunk_lines(chunk)
+            merged = merge_rows_into_chunk_lines(
+                lines, timestamps, [list(row) for row in new_rows], [int(row[0]) for row in new_rows]
+            )
+            self.assertEqual(header, b"timestamp,value")
+            self.assertEqual(header + b"\n" + b"\n".join(merged), self.reference_merge(chunk, new_rows))
+    
+    def test_unsorted_chunk(self):
+        chunk = b"timestamp,value\n5,a\n1,b\n5,a\nbad,c\n3,d"
+        new_rows = [[b"4", b"e"], [b"1", b"b"]]
+        header, lines, timestamps = split_chunk_lines(chunk)
+        merged = merge_rows_into_chunk_lines(lines, timestamps, new_rows, [4, 1])
+        self.assertEqual(merged, [b"1,b", b"3,d", b"4,e", b"5,a"])
+    
+    def test_sort_by_timestamp_is_stable(self):
+        rows, timestamps = sort_by_timestamp([b"a", b"b", b"c", b"d"], [2, 1, 2, 1])
+        self.assertEqual(rows, [b"b", b"d", b"a", b"c"])
+        self.assertEqual(timestamps, [1, 1, 2, 2])
+
+
+@skipUnless(vectorized_binification_available(), "numpy is not installed")
+class TestVectorizedBinification(FileProcessingTestCase):
+    
+    def assert_engines_identical(self, file_contents: bytes):
+        header, rows = csv_to_list(file_contents)
+        reference = binify_csv_rows(rows, "study", "patient", ACCELEROMETER, header)
+        vectorized = binify_csv_contents(file_contents, "study", "patient", ACCELEROMETER, header)
+        # dictionaries compare equal regardless of order, bin order has to be checked separately.
+        self.assertEqual(list(reference.items()), list(vectorized.items()))
+        return vectorized
+    
+    def test_matches_python_engine(self):
+        hour = 3600 * 1000
+        self.assert_engines_identical(
+            self.accelerometer_file(
+                SOME_TIMESTAMP_MS + hour, SOME_TIMESTAMP_MS, SOME_TIMESTAMP_MS + 2 * hour,
+                SOME_TIMESTAMP_MS + 1, SOME_TIMESTAMP_MS + hour - 1, 999, 0,
+            )
+        )
+    
+    def test_matches_python_engine_edge_cases(self):
+        binified = self.assert_engines_identical(
+            ANDROID_ACCELEROMETER_HEADER + b"\n"
+            b"1600000000000,unknown,1,2,3\n"
+            b"\n"  # empty line
+            b",unknown,1,2,3\n"  # empty timestamp
+            b"16000000000x0,unknown,1,2,3\n"  # corrupted timestamp
+            b" 1600000000002,unknown,1,2,3\n"  # whitespace, int() accepts this
+            b"-1600000000003,unknown,1,2,3\n"  # negative
+            b"1600000000004\r\n"  # no commas, windows line ending
+            b"1600000000005,unknown,1,2,3\n"  # trailing newline
+        )
+        self.assertEqual(sum(len(rows) for rows, _ in binified.values()), 5)
+    
+    def test_header_only(self):
+        self.assertEqual(self.assert_engines_identical(ANDROID_ACCELEROMETER_HEADER), {})
+        self.assertEqual(self.assert_engines_identical(ANDROID_ACCELEROMETER_HEADER + b"\n"), {})
+    
+    def test_timestamp_too_large(self):
+        contents = ANDROID_ACCELEROMETER_HEADER + b"\n 99999999999999999999,unknown,1,2,3"
+        self.assertIsNone(binify_csv_contents(contents, "study", "patient", ACCELEROMETER, b""))